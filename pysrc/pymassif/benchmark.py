@@ -0,0 +1,867 @@
+# massif/benchmark.py
+
+"""
+Benchmarks for pymassif, run on synthetic massif data.  To run all
+benchmarks, or just the named ones:
+
+    python -m pymassif.benchmark [name...]
+"""
+
+if __name__ == '__main__':
+    import sys
+    sys.path.append('..')
+
+import pymassif.heap, pymassif.heapseq, pymassif.snapshot
+import pymassif.parallel, pymassif.html, pymassif.massiffile
+import os, sys, gc, re, time, types, random, tempfile, subprocess
+
+######################################################################
+#{ Synthetic data
+######################################################################
+
+def deep_heap_tree_lines(depth, leaves_per_level=1):
+    """
+    Return a list of lines for a synthetic heap tree that is C{depth}
+    levels deep.  Each non-leaf node has C{leaves_per_level} leaf
+    children, plus one non-leaf child (except at the bottom level).
+    """
+    lines = []
+    leaf_bytes = 16
+    for level in range(depth):
+        indent = ' '*level
+        levels_below = depth-level-1
+        num_children = leaves_per_level + (levels_below > 0)
+        bytes = leaf_bytes * leaves_per_level * (levels_below+1)
+        if level == 0:
+            lines.append('%sn%d: %d (heap allocation functions) '
+                         'malloc/new/new[], --alloc-fns, etc.' %
+                         (indent, num_children, bytes))
+        else:
+            lines.append('%sn%d: %d 0x%X: ns::Klass<int>::method_%d(int) '
+                         'const (file_%d.cpp:%d)' %
+                         (indent, num_children, bytes, 0x400000+level,
+                          level, level % 10, level))
+        for i in range(leaves_per_level):
+            lines.append(' %sn0: %d 0x%X: leaf_%d_%d() (leaf.c:%d)' %
+                         (indent, leaf_bytes, 0x500000+level, level, i, i))
+    return lines
+
+def grouped_heap_tree_lines(depth, groups_per_level, leaves_per_group):
+    """
+    Return a list of lines for a synthetic heap tree that is C{depth}
+    levels deep.  Each level has C{groups_per_level} non-leaf nodes
+    with C{leaves_per_group} leaf children each, plus one non-leaf
+    child that holds the next level.
+    """
+    lines = []
+    leaf_bytes = 16
+    group_bytes = leaf_bytes * leaves_per_group
+    level_bytes = group_bytes * groups_per_level
+    for level in range(depth):
+        indent = ' '*level
+        levels_below = depth-level-1
+        num_children = groups_per_level + (levels_below > 0)
+        lines.append('%sn%d: %d 0x%X: level_%d() (level.c:%d)' %
+                     (indent, num_children, level_bytes*(levels_below+1),
+                      0x400000+level, level, level))
+        for group in range(groups_per_level):
+            lines.append(' %sn%d: %d 0x%X: group_%d() (group.c:%d)' %
+                         (indent, leaves_per_group, group_bytes,
+                          0x500000+group, group, group))
+            for leaf in range(leaves_per_group):
+                lines.append('  %sn0: %d 0x%X: leaf_%d() (leaf.c:%d)' %
+                             (indent, leaf_bytes, 0x600000+leaf, leaf, leaf))
+    return lines
+
+def synthetic_massif_file(filename, num_snapshots=200, num_sites=2000,
+                          depth=8, seed=0):
+    """
+    Write a synthetic massif output file.  Every detailed snapshot is
+    drawn from the same random call tree, with roughly C{num_sites}
+    allocation sites (leaves), whose sizes vary over time; so the
+    snapshots share most of their call sites, as they do in real
+    massif output.
+    """
+    rand = random.Random(seed)
+    funcs = ['ns%d::Klass<int, std::allocator<int> >::method_%d(int) const' %
+             (i % 13, i) for i in range(max(num_sites/4, 50))]
+    def build(depth, sites):
+        func = '%s (file_%d.cpp:%d)' % (
+            rand.choice(funcs), rand.randint(0, 9), rand.randint(1, 999))
+        if depth == 0 or sites <= 1:
+            return (func, rand.random(), rand.randint(16, 1 << 16))
+        num_children = rand.randint(2, 6)
+        return (func, [build(depth-1, sites/num_children)
+                       for i in range(num_children)])
+    root = build(depth, num_sites)
+
+    def leaf_bytes(node, snapshot):
+        phase, scale = node[1], node[2]
+        if int(snapshot*phase) % 4 == 0: return 0
+        return int(scale * (1 + (snapshot*phase) % 7))
+
+    def write_node(node, snapshot, indent, out, addr):
+        """Write the lines for node, and return its size."""
+        if len(node) == 3:
+            bytes = leaf_bytes(node, snapshot)
+            if bytes:
+                out.append('%sn0: %d 0x%X: %s' % (indent, bytes, addr,
+                                                  node[0]))
+            return bytes
+        child_lines = []
+        num_children = bytes = 0
+        for i, child in enumerate(node[1]):
+            child_bytes = write_node(child, snapshot, indent+' ',
+                                     child_lines, addr*8+i)
+            if child_bytes:
+                num_children += 1
+                bytes += child_bytes
+        if bytes:
+            out.append('%sn%d: %d 0x%X: %s' % (indent, num_children, bytes,
+                                               addr, node[0]))
+            out.extend(child_lines)
+        return bytes
+
+    with open(filename, 'wb') as out:
+        out.write('desc: --detailed-freq=1\ncmd: ./synthetic\n'
+                  'time_unit: i\n')
+        for snapshot in range(num_snapshots):
+            lines = []
+            bytes = write_node(root, snapshot, ' ', lines, 0x400000)
+            out.write('#-----------\nsnapshot=%d\n#-----------\n'
+                      'time=%d\nmem_heap_B=%d\nmem_heap_extra_B=%d\n'
+                      'mem_stacks_B=0\n' % (snapshot, snapshot*1000,
+                                              bytes, bytes/100))
+            if lines:
+                out.write('heap_tree=detailed\n')
+                out.write('n1: %d (heap allocation functions) malloc/new/'
+                          'new[], --alloc-fns, etc.\n' % bytes)
+                out.write('\n'.join(lines)+'\n')
+            else:
+                out.write('heap_tree=empty\n')
+
+def synthetic_heap_seq(num_snapshots=500, num_sites=5000, depth=6, seed=0):
+    """
+    Return a HeapSeq with roughly C{num_sites} leaves, each of which
+    has a nonzero size in about 3/4 of the C{num_snapshots} snapshots.
+    The leaves are filled in directly (rather than by merging whole
+    heap trees), so large HeapSeqs can be built quickly.
+    """
+    rand = random.Random(seed)
+    HeapNode = pymassif.heap.HeapNode
+    def build(depth, sites):
+        func = 'func_%d(int)' % rand.randint(0, 10*num_sites)
+        if depth == 0 or sites <= 1:
+            return HeapNode(None, func, 'file.cpp', str(rand.randint(1, 999)),
+                            bytes=rand.randint(16, 1 << 16))
+        num_children = rand.randint(2, 6)
+        return HeapNode(None, func, 'file.cpp', str(rand.randint(1, 999)),
+                        children=[build(depth-1, sites/num_children)
+                                  for i in range(num_children)])
+    heap_seq = pymassif.heapseq.HeapSeq([])
+    heap_seq.merge(0, HeapNode(None, HeapNode.ALLOCATION,
+                               children=[build(depth, num_sites)]))
+    leaves = []
+    stack = [heap_seq]
+    while stack:
+        node = stack.pop()
+        if node.is_leaf: leaves.append(node)
+        stack.extend(node)
+    sources = {}
+    for leaf in leaves:
+        phase, scale = rand.random(), rand.randint(16, 1 << 16)
+        for snapshot in range(1, num_snapshots):
+            if int(snapshot*phase*4) % 4 == 0: continue
+            bytes = scale * (1 + int(snapshot*phase) % 7)
+            source = sources.get(bytes)
+            if source is None:
+                source = sources[bytes] = HeapNode(None, 'leaf', bytes=bytes)
+            leaf.merge(snapshot*1000, source)
+    return heap_seq
+
+# Demangled function names of the kind found in massif output for
+# STL/boost-heavy programs.
+FUNCTION_NAME_CORPUS = [
+    'main',
+    '__libc_csu_init',
+    'foo(int)',
+    'void foo<int>(int)',
+    'operator new(unsigned long)',
+    'operator new[](unsigned long)',
+    'operator delete[](void*)',
+    'void* operator new(unsigned long, std::nothrow_t const&)',
+    'std::vector<int, std::allocator<int> >::push_back(int const&)',
+    'std::vector<std::string, std::allocator<std::string>'
+    ' >::_M_insert_aux(__gnu_cxx::__normal_iterator<std::string*,'
+    ' std::vector<std::string, std::allocator<std::string> > >,'
+    ' std::string const&)',
+    '__gnu_cxx::new_allocator<std::_Rb_tree_node<std::pair<int const,'
+    ' std::string> > >::allocate(unsigned long, void const*)',
+    'std::_Rb_tree<int, std::pair<int const, std::string>,'
+    ' std::_Select1st<std::pair<int const, std::string> >,'
+    ' std::less<int>, std::allocator<std::pair<int const, std::string>'
+    ' > >::_M_insert_unique(std::pair<int const, std::string> const&)',
+    'std::map<int, std::string, std::less<int>,'
+    ' std::allocator<std::pair<int const, std::string> >'
+    ' >::operator[](int const&)',
+    'std::basic_string<char, std::char_traits<char>,'
+    ' std::allocator<char> >::basic_string(char const*,'
+    ' std::allocator<char> const&)',
+    'std::string::_Rep::_S_create(unsigned long, unsigned long,'
+    ' std::allocator<char> const&)',
+    'std::ostream& std::operator<< <std::char_traits<char>'
+    ' >(std::ostream&, char const*)',
+    'std::basic_ostream<char, std::char_traits<char> >::operator<<(int)',
+    'bool std::operator< <int>(std::vector<int> const&,'
+    ' std::vector<int> const&)',
+    'boost::shared_ptr<foo::Bar>::shared_ptr<foo::Bar>(foo::Bar*)',
+    'boost::detail::sp_counted_impl_p<foo::Bar>::sp_counted_impl_p(foo::Bar*)',
+    'boost::unordered::detail::table<boost::unordered::detail::map<'
+    'std::allocator<std::pair<std::string const, int> >, std::string, '
+    'int, boost::hash<std::string>, std::equal_to<std::string> > >::'
+    'reserve_for_insert(unsigned long)',
+    'boost::function1<void, int>::operator()(int) const',
+    'boost::detail::function::void_function_obj_invoker1<'
+    'boost::_bi::bind_t<void, boost::_mfi::mf1<void, foo::Handler, int>, '
+    'boost::_bi::list2<boost::_bi::value<foo::Handler*>, '
+    'boost::arg<1> > >, void, int>::'
+    'invoke(boost::detail::function::function_buffer&, int)',
+    '(anonymous namespace)::Parser::parse_expression(int)',
+    'foo::(anonymous namespace)::helper(std::vector<int,'
+    ' std::allocator<int> > const&)',
+    'foo::Klass::operator bool() const',
+    'foo::Klass::operator std::string() const',
+    'foo::Klass::operator std::set<int, std::less<int>,'
+    ' std::allocator<int> >() const',
+    'foo::Klass::operator char const*() const',
+    'foo::Matrix::operator->() const',
+    'foo::Matrix::operator=(foo::Matrix const&)',
+    'foo::Matrix::operator==(foo::Matrix const&) const',
+    'foo::Matrix::operator>>=(int)',
+    'foo::Klass<int, (anonymous namespace)::Tag>::~Klass()',
+    'unsigned long foo::Hash<std::pair<int, int> >::hash<char>(char'
+    ' const*) const volatile',
+    'Heap allocation (malloc/new/etc)',
+    'Other callers (below threshold)',
+    '???',
+    '(below main)',
+]
+
+######################################################################
+#{ Reference implementations
+######################################################################
+# The implementations that earlier optimizations replaced, so that the
+# benchmarks can report the speed of the old code next to the new.
+
+_REFERENCE_LINE_RE = re.compile(
+    r'(?P<indent>\s*)n(?P<num_children>\d+): (?P<bytes>\d+) '
+    r'((?P<addr>[0-9-zA-ZxX]+): )?'
+    r'(?P<func>.+)')
+
+def reference_parse_lines(lines):
+    """
+    The heap tree parser that L{HeapNode.parse_lines()
+    <pymassif.heap.HeapNode.parse_lines>} replaced.  It builds a
+    dictionary of match groups for each line, and checks each node's
+    size by summing its whole subtree.
+    """
+    stack = [{'children': []}]
+    for lineno, line in enumerate(lines):
+        m = _REFERENCE_LINE_RE.match(line)
+        if m is None:
+            raise ValueError('Error parsing line %d of heap tree: %r' %
+                             (lineno, line))
+        indent = len(m.group('indent'))
+        assert indent < len(stack)
+        while indent < (len(stack)-1):
+            node = _reference_mk_heap_node(**stack.pop())
+            stack[-1].setdefault('children',[]).append(node)
+        stack.append( m.groupdict() )
+    while len(stack)>1:
+        node = _reference_mk_heap_node(**stack.pop())
+        stack[-1].setdefault('children',[]).append(node)
+    assert len(stack[0]['children']) == 1
+    return stack[0]['children'][0]
+
+def _reference_mk_heap_node(indent, num_children, bytes, addr, func,
+                            children=None):
+    """Helper for reference_parse_lines()."""
+    HeapNode = pymassif.heap.HeapNode
+    m = re.match('^(.*) \((\S+):(\d+)\)$', func)
+    if m is None:
+        m = re.match('^(.*) \(in (\S+)\)$', func)
+        if m is None:
+            source_file = source_line = None
+        else:
+            func, source_file = m.groups()
+            source_line = None
+    else:
+        func, source_file, source_line = m.groups()
+    if func == ('(heap allocation functions) '
+                'malloc/new/new[], --alloc-fns, etc.'):
+        func = HeapNode.ALLOCATION
+    if re.match('in \d+ places?, (all )?below massif.*', func):
+        func = HeapNode.OTHER_CALLERS
+    if children is not None:
+        assert int(bytes) == sum(_reference_bytes(c) for c in children)
+        assert int(num_children) == len(children)
+        return HeapNode(addr, func, source_file, source_line,
+                        children=children)
+    else:
+        assert int(num_children) == 0
+        return HeapNode(addr, func, source_file, source_line,
+                        bytes=int(bytes))
+
+def _reference_bytes(node):
+    """
+    Return the size of node by summing its leaves, as HeapNode.bytes
+    did before subtree totals were cached.
+    """
+    total = 0
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        if node.is_leaf:
+            total += node.bytes
+        else:
+            stack.extend(node)
+    return total
+
+_REFERENCE_FUNC_RE = re.compile(r"""
+    (?P<rtype>              ([^<>\(\)]    | <[^<>]*> )+  \s  )?
+    (?P<context>          ( ([^<>\(\)\s:] | <[^<>]*> )+ ::)+ )?
+    (?P<name>               ([^<>\(\)\s:]            )+      )
+    (?P<template_args>                      <[^<>]*>         )?
+    (?P<args>             \( [^\(\)]* \)                     )
+    (?P<qualifiers>       (\s\w+)+                           )?
+    $""", re.VERBOSE)
+
+def reference_decompose(function_string):
+    """
+    The function name parser that L{FunctionName._decompose()
+    <pymassif.heap.FunctionName._decompose>} replaced: the name is
+    rewritten (with L{_reference_mangle()}) so that a single regexp
+    can split it, and then each piece is restored.  Return a tuple
+    C{(rtype, context, name, template_args, args, qualifiers)}.
+    """
+    FunctionName = pymassif.heap.FunctionName
+    unparsed = (None, None, function_string, None, None, None)
+    for special in FunctionName.SPECIAL_FUNCTIONS:
+        if function_string.startswith(special):
+            return unparsed
+    if FunctionName._IDENTIFIER_RE.match(function_string):
+        return unparsed
+    m = _REFERENCE_FUNC_RE.match(_reference_mangle(function_string))
+    if not m:
+        return unparsed
+    (rtype, context, name, template_args, args, qualifiers) = [
+        _reference_restore(m.group(group)) for group in
+        ('rtype', 'context', 'name', 'template_args', 'args',
+         'qualifiers')]
+    if rtype: rtype = rtype.strip()
+    if qualifiers: qualifiers = qualifiers.strip()
+    return (rtype, context, name, template_args, args, qualifiers)
+
+def _reference_mangle_typecast_type(m):
+    s = m.group()
+    s = s.replace('::', '@COLON@@COLON@')
+    s = s.replace('<', '{').replace('>', '}')
+    return s
+
+def _reference_mangle(s):
+    """
+    Helper for reference_decompose(): make various changes to the
+    function name 's' that make it easier to parse with a regexp.
+    """
+    if 'operator' in s:
+        s = re.sub(r'\b(operator ?)\(\)', r'\1@CALL@', s)
+        s = re.sub(r'\b(operator ?)<<',   r'\1@LT@@LT@', s)
+        s = re.sub(r'\b(operator ?)<',    r'\1@LT@', s) # also covers <=
+        s = re.sub(r'\b(operator ?)>>',   r'\1@GT@@GT@', s)
+        s = re.sub(r'\b(operator ?)>',    r'\1@GT@', s) # also covers >=
+        s = re.sub(r'\b(operator ?)->',   r'\1-@GT@', s) # also covers ->*
+        s = re.sub(r'\b(operator )',      r'operator@SPACE@', s)
+        s = s.replace('@ ', '@@SPACE@') # eg space after operator<<.
+        s = re.sub(r'\boperator@SPACE@\w[^\(]+\(',
+                   _reference_mangle_typecast_type, s)
+    s = s.replace('(anonymous namespace)', '@ANONYMOUS_NAMESPACE@')
+    # Replace the '<' and '>' characters in nested template argument
+    # lists with '{' and '}'.
+    template_depth = [0]
+    def subfunc(m):
+        if m.group()=='<':
+            template_depth[0]+=1
+            if template_depth[0]>1: return '{'
+        elif m.group()=='>':
+            template_depth[0]-=1
+            if template_depth[0]>=1: return '}'
+        return m.group()
+    return re.sub(r'[<>]|[^<>]+', subfunc, s)
+
+def _reference_restore(s):
+    """Helper for reference_decompose(): undo _reference_mangle()."""
+    if s is None: return None
+    s = s.replace('{', '<').replace('}', '>')
+    s = s.replace('@ANONYMOUS_NAMESPACE@', '(anonymous namespace)')
+    s = s.replace('@CALL@', '()')
+    s = s.replace('@SPACE@', ' ')
+    s = s.replace('@LT@', '<')
+    s = s.replace('@GT@', '>')
+    s = s.replace('@COLON@', ':')
+    return s
+
+######################################################################
+#{ Benchmarks
+######################################################################
+
+def _best_time(func, repeat=3):
+    """Return the best wall-clock time of C{repeat} calls to func()."""
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        if best is None or elapsed < best: best = elapsed
+    return best
+
+def _temp_filename(suffix):
+    """
+    Create a new empty temporary file, and return its name.  The
+    caller is responsible for removing it.
+    """
+    fd, filename = tempfile.mkstemp(suffix=suffix)
+    os.close(fd)
+    return filename
+
+def _report(name, count, unit, seconds):
+    print '  %-40s %12.0f %s/sec  (%.3fs)' % (name, count/seconds,
+                                               unit, seconds)
+
+def _deep_sizeof(obj):
+    """
+    Return the total size in bytes of obj and every object reachable
+    from it, excluding classes, modules and functions.
+    """
+    seen = set()
+    total = 0
+    stack = [obj]
+    skip = (type, types.ModuleType, types.FunctionType)
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen or isinstance(obj, skip): continue
+        seen.add(id(obj))
+        total += sys.getsizeof(obj)
+        stack.extend(gc.get_referents(obj))
+    return total
+
+def bench_heap_parse(depth=400, leaves_per_level=4):
+    """Parse a deep synthetic heap tree."""
+    lines = deep_heap_tree_lines(depth, leaves_per_level)
+    parse_lines = pymassif.heap.HeapNode.parse_lines
+    _report('reference_parse_lines()', len(lines), 'nodes',
+            _best_time(lambda: reference_parse_lines(lines)))
+    for validate in (False, True):
+        seconds = _best_time(lambda: parse_lines(lines, validate=validate))
+        _report('HeapNode.parse_lines(validate=%s)' % validate,
+                len(lines), 'nodes', seconds)
+
+def bench_heap_tree(depths=(100, 200), groups_per_level=10,
+                    leaves_per_group=49):
+    """Size, print, and merge deep heap trees with ~50k and ~100k nodes."""
+    # If these operations are linear in the size of the tree, then
+    # the rate (nodes/sec) is about the same for each tree.
+    for depth in depths:
+        lines = grouped_heap_tree_lines(depth, groups_per_level,
+                                        leaves_per_group)
+        tree = pymassif.heap.HeapNode.parse_lines(lines)
+        print '  %d nodes:' % len(lines)
+        def sizes():
+            stack = [tree]
+            while stack:
+                node = stack.pop()
+                node.bytes
+                stack.extend(node)
+        _report('HeapNode.bytes (every node)', len(lines), 'nodes',
+                _best_time(sizes))
+        _report('HeapNode.print_massif_tree()', len(lines), 'nodes',
+                _best_time(tree.print_massif_tree))
+        def merge():
+            heap_seq = pymassif.heapseq.HeapSeq([])
+            heap_seq.merge(0, tree)
+        _report('HeapSeqNode.merge()', len(lines), 'nodes',
+                _best_time(merge))
+
+def bench_deep_tree(depth=200, leaves_per_level=4, num_snapshots=20):
+    """Copy and pickle a HeapSeq as deep as massif allows (--depth=200)."""
+    import cPickle
+    tree = pymassif.heap.HeapNode.parse_lines(
+        deep_heap_tree_lines(depth, leaves_per_level))
+    heap_seq = pymassif.heapseq.HeapSeq([])
+    for snapshot in range(num_snapshots):
+        heap_seq.merge(snapshot, tree)
+    num_nodes = 0
+    max_depth = 0
+    stack = [(heap_seq, 0)]
+    while stack:
+        node, node_depth = stack.pop()
+        num_nodes += 1
+        max_depth = max(max_depth, node_depth)
+        stack.extend((c, node_depth+1) for c in node)
+    # Both of these used to recurse once per level, and failed on
+    # trees this deep.
+    def copy():
+        assert heap_seq.copy().bytes_seq == heap_seq.bytes_seq
+    def pickle():
+        clone = cPickle.loads(cPickle.dumps(heap_seq, 2))
+        assert clone.bytes_seq == heap_seq.bytes_seq
+    _report('HeapSeqNode.copy() (depth %d)' % max_depth, num_nodes,
+            'nodes', _best_time(copy))
+    _report('pickle and unpickle (depth %d)' % max_depth, num_nodes,
+            'nodes', _best_time(pickle))
+
+def bench_compact_tree(num_snapshots=20, num_sites=20000):
+    """Memory used by HeapNode trees vs CompactHeapTrees."""
+    filename = _temp_filename('.massif')
+    try:
+        synthetic_massif_file(filename, num_snapshots, num_sites)
+        for compact in (False, True):
+            def read():
+                reader = pymassif.snapshot.MassifReader(filename, compact)
+                return [s for s in reader if s.heap_tree is not None]
+            snapshots = read()
+            num_nodes = 0
+            stack = [s.heap_tree for s in snapshots]
+            while stack:
+                num_nodes += 1
+                stack.extend(stack.pop())
+            # Count each compact tree (not just the root view).
+            trees = [getattr(s.heap_tree, '_tree', s.heap_tree)
+                     for s in snapshots]
+            size = _deep_sizeof(trees)
+            name = 'MassifReader(compact=%s)' % compact
+            _report(name, num_nodes, 'nodes', _best_time(read, 1))
+            print '  %-40s %12.1f bytes/node' % (name, size/float(num_nodes))
+    finally:
+        if os.path.exists(filename): os.remove(filename)
+
+def bench_time_series(num_snapshots=500, num_sites=5000):
+    """Query the time series of a HeapSeq with many snapshots."""
+    heap_seq = synthetic_heap_seq(num_snapshots, num_sites)
+    times = sorted(heap_seq.bytes_seq)
+    top = heap_seq.sorted()[0]
+    num_nodes = 0
+    stack = [heap_seq]
+    while stack:
+        num_nodes += 1
+        stack.extend(stack.pop())
+    for name, func, repeat in [
+        ('bytes_seq', lambda: heap_seq.bytes_seq, 3),
+        ('peak_time', lambda: heap_seq.peak_time, 3),
+        ('max_bytes', lambda: heap_seq.max_bytes, 3),
+        ('pprint(depth=3)', lambda: heap_seq.pprint(depth=3), 1),
+        ('to_javascript()', lambda: top.to_javascript(times), 1)]:
+        _report('HeapSeqNode.%s' % name, num_nodes, 'nodes',
+                _best_time(func, repeat))
+
+def bench_html(num_snapshots=500, num_sites=5000):
+    """Write an html page for a HeapSeq with many snapshots."""
+    heap_seq = synthetic_heap_seq(num_snapshots, num_sites)
+    times = sorted(heap_seq.bytes_seq)
+    filename = _temp_filename('.html')
+    try:
+        for name, tree in [('write_html_page_for(heap_seq)', heap_seq),
+                           ('write_html_page_for(inverted)',
+                            heap_seq.inverted())]:
+            tree = tree.copy()
+            num_nodes = 0
+            stack = [tree]
+            while stack:
+                num_nodes += 1
+                stack.extend(stack.pop())
+            seconds = _best_time(lambda: pymassif.html.write_html_page_for(
+                tree, filename, times), 1)
+            _report(name, num_nodes, 'nodes', seconds)
+    finally:
+        if os.path.exists(filename): os.remove(filename)
+
+def bench_wide_merge(num_snapshots=500, fan_out=5000, seed=0):
+    """Merge snapshots whose allocation node has a very wide fan-out."""
+    rand = random.Random(seed)
+    HeapNode = pymassif.heap.HeapNode
+    sites = [HeapNode(None, 'caller_%d(int)' % i, 'file.cpp', str(i),
+                      bytes=rand.randint(16, 1 << 16))
+             for i in range(fan_out)]
+    # A few different snapshots, each with most of the sites in a
+    # different order.
+    trees = []
+    for i in range(10):
+        children = rand.sample(sites, fan_out*9/10)
+        trees.append(HeapNode(None, HeapNode.ALLOCATION, children=children))
+    def run():
+        heap_seq = pymassif.heapseq.HeapSeq([])
+        for snapshot in range(num_snapshots):
+            heap_seq.merge(snapshot*1000, trees[snapshot % len(trees)])
+    _report('HeapSeqNode.merge()', num_snapshots, 'snapshots',
+            _best_time(run, 1))
+
+_INGEST_SCRIPTS = [
+    ('Snapshot.parse_all() + HeapSeq()',
+     'snapshots = pymassif.snapshot.Snapshot.parse_all(open(%r).read())\n'
+     'pymassif.heapseq.HeapSeq(snapshots)'),
+    ('HeapSeqBuilder(MassifReader())',
+     'builder = pymassif.heapseq.HeapSeqBuilder()\n'
+     'builder.add_all(pymassif.snapshot.MassifReader(%r))'),
+    ('HeapSeqBuilder(coarsening=...)',
+     'import pymassif.coarsen\n'
+     'policy = pymassif.coarsen.CoarseningPolicy(min_fraction=0.001,\n'
+     '                                           max_nodes=1000)\n'
+     'builder = pymassif.heapseq.HeapSeqBuilder(coarsening=policy)\n'
+     'builder.add_all(pymassif.snapshot.MassifReader(%r))'),
+    ]
+
+def bench_ingest(num_snapshots=100, num_sites=5000):
+    """Peak memory used while building a HeapSeq from a file."""
+    filename = _temp_filename('.massif')
+    pysrc = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    try:
+        synthetic_massif_file(filename, num_snapshots, num_sites)
+        for name, script in _INGEST_SCRIPTS:
+            # Run each one in a fresh process, so its peak memory use
+            # can be measured.  (On Linux, ru_maxrss is inherited
+            # across fork and exec, so it would report our own peak;
+            # VmHWM is the peak of the new process only.)
+            script = ('import sys, time\n'
+                      'sys.path.insert(0, %r)\n'
+                      'import pymassif.snapshot, pymassif.heapseq\n'
+                      'start = time.time()\n%s\n'
+                      'print time.time()-start, [\n'
+                      '    line.split()[1] for line in\n'
+                      '    open("/proc/self/status")\n'
+                      '    if line.startswith("VmHWM:")][0]' %
+                      (pysrc, script % filename))
+            process = subprocess.Popen([sys.executable, '-c', script],
+                                       stdout=subprocess.PIPE)
+            seconds, max_rss = process.communicate()[0].split()
+            _report(name, num_snapshots, 'snapshots', float(seconds))
+            print '  %-40s %12.1f MB peak' % (name, int(max_rss)/1024.)
+    finally:
+        if os.path.exists(filename): os.remove(filename)
+
+def bench_pushdown(num_snapshots=200, num_sites=2000):
+    """Read selected snapshots from a file, skipping the others."""
+    filename = _temp_filename('.massif')
+    try:
+        synthetic_massif_file(filename, num_snapshots, num_sites)
+        with pymassif.massiffile.MassifFile(filename, False) as massif_file:
+            times = list(massif_file.times)
+        window = (times[num_snapshots//2], times[num_snapshots//2 + 10])
+        for name, options in [
+            ('all snapshots', {}),
+            ('detailed_only=True', dict(detailed_only=True)),
+            ('time_range=(10 snapshots)', dict(time_range=window)),
+            ('peak_only=True', dict(peak_only=True))]:
+            def read():
+                reader = pymassif.snapshot.MassifReader(filename, **options)
+                pymassif.heapseq.HeapSeq(reader)
+            _report('MassifReader(%s)' % name, num_snapshots, 'snapshots',
+                    _best_time(read, 1))
+    finally:
+        if os.path.exists(filename): os.remove(filename)
+
+def bench_function_names(repeat=200):
+    """Parse a corpus of demangled C++ function names."""
+    for name, decompose in [
+        ('reference_decompose()', reference_decompose),
+        ('FunctionName._decompose()', pymassif.heap.FunctionName._decompose)]:
+        def run():
+            for i in range(repeat):
+                for function_string in FUNCTION_NAME_CORPUS:
+                    decompose(function_string)
+        _report(name, repeat*len(FUNCTION_NAME_CORPUS), 'names',
+                _best_time(run))
+
+def bench_parallel(num_snapshots=100, num_sites=2000):
+    """Build a HeapSeq from a synthetic file with 1/2/4/8 workers."""
+    filename = _temp_filename('.massif')
+    try:
+        synthetic_massif_file(filename, num_snapshots, num_sites)
+        def serial():
+            reader = pymassif.snapshot.MassifReader(filename)
+            pymassif.heapseq.HeapSeq(reader)
+        _report('HeapSeq(MassifReader(...))', num_snapshots, 'snapshots',
+                _best_time(serial, 1))
+        for workers in (1, 2, 4, 8):
+            def run():
+                pymassif.parallel.heap_seq_parallel(filename, workers)
+            _report('heap_seq_parallel(workers=%d)' % workers,
+                    num_snapshots, 'snapshots', _best_time(run, 1))
+    finally:
+        for f in (filename, filename+'.idx'):
+            if os.path.exists(f): os.remove(f)
+
+def bench_diff(num_snapshots=50, num_sites=100000):
+    """Diff two HeapSeqs with 100k sites each."""
+    # The same seed gives both trees the same shape, but the leaf sizes
+    # (and snapshot times) differ.
+    base = synthetic_heap_seq(num_snapshots, num_sites, depth=12)
+    candidate = synthetic_heap_seq(num_snapshots+10, num_sites, depth=12)
+    num_nodes = 0
+    stack = [base]
+    while stack:
+        num_nodes += 1
+        stack.extend(stack.pop())
+    _report('HeapSeqNode.diff()', num_nodes, 'nodes',
+            _best_time(lambda: base.diff(base, candidate), 1))
+    result = base.diff(base, candidate)
+    _report('HeapSeqDiff.report()', num_nodes, 'nodes',
+            _best_time(result.report, 1))
+    _report('HeapSeqDiff.delta_heap_seq()', num_nodes, 'nodes',
+            _best_time(result.delta_heap_seq, 1))
+
+def bench_query(num_snapshots=50, num_sites=100000):
+    """Top-K queries over a HeapSeq with 100k sites."""
+    heap_seq = synthetic_heap_seq(num_snapshots, num_sites, depth=12)
+    index = heap_seq.query_index()
+    _report('HeapSeqIndex()', len(index), 'nodes',
+            _best_time(heap_seq.query_index, 1))
+    times = index.times
+    for name, func in [
+        ('at(t)', lambda: index.at(times[len(times)//2])),
+        ('at(t, inclusive=False)',
+         lambda: index.at(times[len(times)//2], inclusive=False)),
+        ('at_peak()', lambda: index.at_peak()),
+        ('growth(t1, t2)', lambda: index.growth(times[1], times[-1])),
+        ('average()', lambda: index.average()),
+        ('at_peak(by_site=True)', lambda: index.at_peak(by_site=True)),
+        ('at_peak(False, by_site=True)',
+         lambda: index.at_peak(inclusive=False, by_site=True))]:
+        _report('HeapSeqIndex.%s' % name, len(index), 'nodes',
+                _best_time(func))
+    _report('sorted() at every level (for comparison)', len(index), 'nodes',
+            _best_time(lambda: _sort_all(heap_seq), 1))
+
+def bench_restructure(num_snapshots=20, num_sites=50000):
+    """Promote and collapse the nodes of a HeapSeq that match regexps."""
+    heap_seq = synthetic_heap_seq(num_snapshots, num_sites, depth=10)
+    num_nodes = 0
+    stack = [heap_seq]
+    while stack:
+        num_nodes += 1
+        stack.extend(stack.pop())
+    # About one function in ten matches.
+    regexp = r'func_\d*7\('
+    for name in ['promote_if_parent_matches', 'collapse_if_func_matches',
+                 'discard_empty_nodes']:
+        tree = heap_seq.copy()
+        args = () if name == 'discard_empty_nodes' else (regexp,)
+        _report('HeapSeqNode.%s()' % name, num_nodes, 'nodes',
+                _best_time(lambda: getattr(tree, name)(*args), 1))
+
+def bench_coarsen_restructure(num_snapshots=40, num_sites=2000):
+    """Restructure a coarsened HeapSeq, and then copy, pickle and extend it."""
+    import cPickle, pymassif.coarsen
+    filename = _temp_filename('.massif')
+    try:
+        synthetic_massif_file(filename, num_snapshots, num_sites)
+        snapshots = list(pymassif.snapshot.MassifReader(filename))
+    finally:
+        if os.path.exists(filename): os.remove(filename)
+    expected = pymassif.heapseq.HeapSeq(snapshots).bytes_seq
+    policy = pymassif.coarsen.CoarseningPolicy(
+        min_fraction=0.01, max_children=3, interval=4)
+    builder = pymassif.heapseq.HeapSeqBuilder(coarsening=policy)
+    half = len(snapshots)/2
+    builder.add_all(snapshots[:half])
+    heap_seq = builder.heap_seq(copy=False)
+    num_nodes = 0
+    stack = [heap_seq]
+    while stack:
+        num_nodes += 1
+        stack.extend(stack.pop())
+
+    def check_child_indices():
+        # Every child index entry (including those for the sites that
+        # were folded into a coarsened 'Other' leaf) must be for one
+        # of the node's children.
+        stack = [heap_seq]
+        while stack:
+            node = stack.pop()
+            if node._child_index is not None:
+                assert all(child._parent is node for child in
+                           node._child_index.itervalues())
+            stack.extend(node)
+
+    # Promoting moves the coarsened 'Other' leaves away from the
+    # parents whose folded sites they hold.
+    _report('promote_if_parent_matches()', num_nodes, 'nodes',
+            _best_time(lambda: heap_seq.promote_if_parent_matches(
+                r'ns\d+::'), 1))
+    check_child_indices()
+    _report('HeapSeqNode.copy()', num_nodes, 'nodes',
+            _best_time(heap_seq.copy))
+    clone = cPickle.loads(cPickle.dumps(heap_seq, 2))
+    assert clone.bytes_seq == heap_seq.bytes_seq
+    builder.add_all(snapshots[half:])
+    assert heap_seq.bytes_seq == expected
+    check_child_indices()
+
+def bench_pipeline(num_snapshots=20, num_sites=50000):
+    """Apply transform pipelines, and the same methods one at a time."""
+    import pymassif.pipeline
+    heap_seq = synthetic_heap_seq(num_snapshots, num_sites, depth=10)
+    heap_seq.series()
+    num_nodes = 0
+    stack = [heap_seq]
+    while stack:
+        num_nodes += 1
+        stack.extend(stack.pop())
+    specs = [pymassif.html.PAGE_PIPELINE,
+             'collapse_to_depth(6), collapse_if_smaller_than(1024), '
+             'discard_empty_nodes, reset_uids(0)']
+    for spec in specs:
+        def run_methods():
+            for stage in pymassif.pipeline._parse_spec(spec):
+                getattr(tree, stage[0])(*stage[1:])
+        def run_pipeline():
+            pipeline.run(tree)
+        pipeline = pymassif.pipeline.Pipeline.from_spec(spec)
+        print '  %s (%d passes)' % (spec, len(pipeline.passes()))
+        for name, func in [('methods', run_methods),
+                           ('Pipeline.run()', run_pipeline)]:
+            best = None
+            for i in range(3):
+                tree = heap_seq.copy()
+                tree.series()
+                seconds = _best_time(func, 1)
+                if best is None or seconds < best: best = seconds
+            _report(name, num_nodes, 'nodes', best)
+
+def _sort_all(node):
+    for child in node.sorted():
+        _sort_all(child)
+
+BENCHMARKS = [('heap_parse', bench_heap_parse),
+              ('heap_tree', bench_heap_tree),
+              ('deep_tree', bench_deep_tree),
+              ('compact_tree', bench_compact_tree),
+              ('time_series', bench_time_series),
+              ('html', bench_html),
+              ('wide_merge', bench_wide_merge),
+              ('ingest', bench_ingest),
+              ('pushdown', bench_pushdown),
+              ('function_names', bench_function_names),
+              ('parallel', bench_parallel),
+              ('diff', bench_diff),
+              ('query', bench_query),
+              ('restructure', bench_restructure),
+              ('coarsen_restructure', bench_coarsen_restructure),
+              ('pipeline', bench_pipeline)]
+
+def main(names):
+    for (name, bench) in BENCHMARKS:
+        if names and name not in names: continue
+        print '%s: %s' % (name, bench.__doc__.strip())
+        bench()
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
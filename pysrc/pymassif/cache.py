@@ -0,0 +1,168 @@
+# massif/cache.py
+
+"""
+A persistent on-disk cache of the HeapSeq built from a massif output
+file, so that opening the same file again does not require parsing
+it.  The cache file is stored next to the massif output file (with the
+suffix C{.heapseq}), and contains:
+
+  - A header, which records the format version and the input file's
+    path, size, modification time, and content hash.
+  - The HeapSeq's site table, listing each distinct (func,
+    source_file, source_line) call site once; and a list of the
+    distinct addresses.
+  - The tree structure, as a preorder list of (site id, address id,
+    number of children) triples, where leaves are marked with -1
+    children.
+  - The list of snapshot times (the HeapSeq's time axis), and the row
+    of byte counts for each leaf node, one per time.
+
+If the cache file is missing, out of date, or was written by a
+different version of pymassif, then it is silently ignored and the
+massif output file is parsed instead.
+"""
+
+import pymassif.heapseq, pymassif.heap, pymassif.snapshot
+import os, sys, array, marshal, hashlib
+
+FORMAT_VERSION = 3
+CACHE_SUFFIX = '.heapseq'
+
+def load_heap_seq(filename, include_overhead=True, include_stacks=True,
+                  cache_filename=None):
+    """
+    Return a HeapSeq for the given massif output file.  If an up to
+    date cache file exists, then load the HeapSeq from it; otherwise,
+    parse the massif output file, and save the result to the cache
+    file (if possible).
+    """
+    if cache_filename is None:
+        cache_filename = filename + CACHE_SUFFIX
+    key = cache_key(filename, include_overhead, include_stacks)
+    heap_seq = read_cache(cache_filename, key)
+    if heap_seq is None:
+        with pymassif.snapshot.MassifReader(filename) as reader:
+            heap_seq = pymassif.heapseq.HeapSeq(reader, include_overhead,
+                                                include_stacks)
+        try:
+            write_cache(heap_seq, cache_filename, key)
+        except (IOError, OSError):
+            pass # eg read-only directory
+    return heap_seq
+
+def cache_key(filename, include_overhead=True, include_stacks=True):
+    """
+    Return a dictionary identifying the given massif output file (and
+    the options used to build its HeapSeq).  A cache file is only used
+    if its key matches exactly.
+    """
+    st = os.stat(filename)
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), ''):
+            sha1.update(block)
+    return dict(version=FORMAT_VERSION, python=sys.version_info[:2],
+                path=os.path.abspath(filename), size=st.st_size,
+                mtime=st.st_mtime, sha1=sha1.hexdigest(),
+                include_overhead=include_overhead,
+                include_stacks=include_stacks)
+
+######################################################################
+#{ Writing
+######################################################################
+
+def write_cache(heap_seq, cache_filename, key):
+    """Write heap_seq to the given cache file."""
+    sites = [(str(func), source_file, source_line)
+             for (func, source_file, source_line) in heap_seq.site_table]
+    addrs = []
+    addr_ids = {}
+    structure = array.array('l')
+    leaf_lengths = array.array('l')
+    leaf_bytes = array.array('l')
+    times = heap_seq.time_axis.times
+
+    stack = [heap_seq]
+    while stack:
+        node = stack.pop()
+        addr_id = addr_ids.get(node.addr)
+        if addr_id is None:
+            addr_id = addr_ids[node.addr] = len(addrs)
+            addrs.append(node.addr)
+        structure.append(node.site_id)
+        structure.append(addr_id)
+        if node.is_leaf:
+            structure.append(-1)
+            leaf_lengths.append(len(node._row))
+            leaf_bytes.extend(node._row)
+        else:
+            structure.append(len(node))
+            stack.extend(reversed(node._children))
+
+    tmp_filename = cache_filename + '.tmp'
+    with open(tmp_filename, 'wb') as f:
+        marshal.dump(key, f)
+        marshal.dump((sites, addrs, times, structure.tostring(),
+                      leaf_lengths.tostring(), leaf_bytes.tostring()), f)
+    os.rename(tmp_filename, cache_filename)
+
+######################################################################
+#{ Reading
+######################################################################
+
+def read_cache(cache_filename, key):
+    """
+    Read a HeapSeq from the given cache file, and return it; or return
+    None if the file does not exist, or if its key does not match
+    C{key}.
+    """
+    try:
+        with open(cache_filename, 'rb') as f:
+            if marshal.load(f) != key:
+                return None
+            body = marshal.load(f)
+        return _decode(*body)
+    except (IOError, OSError, EOFError, ValueError, TypeError, IndexError):
+        return None
+
+def _decode(sites, addrs, times, structure, leaf_lengths, leaf_bytes):
+    """Helper for read_cache(): rebuild a HeapSeq from its encoding."""
+    structure = _array(structure)
+    leaf_lengths = _array(leaf_lengths)
+    leaf_bytes = _array(leaf_bytes)
+    HeapSeqNode = pymassif.heapseq.HeapSeqNode
+    time_axis = pymassif.heapseq.TimeAxis(times)
+    site_table = pymassif.heap.SiteTable()
+    for site in sites:
+        site_table.intern(*site)
+
+    root = None
+    stack = [] # [node, number of children still to read]
+    leaf = pos = 0
+    for i in range(0, len(structure), 3):
+        func, source_file, source_line = site_table[structure[i]]
+        addr = addrs[structure[i+1]]
+        num_children = structure[i+2]
+        node = HeapSeqNode(addr, func, source_file, source_line,
+                           num_children < 0, time_axis, site_table)
+        if num_children < 0:
+            node._row = leaf_bytes[pos:pos+leaf_lengths[leaf]]
+            pos += leaf_lengths[leaf]
+            leaf += 1
+        if stack:
+            parent = stack[-1]
+            parent[0]._add_child(node)
+            parent[1] -= 1
+            if parent[1] == 0: stack.pop()
+        else:
+            root = node
+        if num_children > 0:
+            stack.append([node, num_children])
+    if root is None or stack:
+        raise ValueError('Corrupt heap seq cache')
+    return root
+
+def _array(s):
+    a = array.array('l')
+    a.fromstring(s)
+    return a
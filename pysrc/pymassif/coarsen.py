@@ -0,0 +1,256 @@
+# massif/coarsen.py
+
+"""
+Bound the size of a HeapSeq while it is being built, by folding small
+subtrees into 'Other Allocations' nodes as snapshots are merged.
+
+The methods that simplify a finished HeapSeq (such as
+L{collapse_if_smaller_than()
+<pymassif.heapseq.HeapSeqNode.collapse_if_smaller_than>} and
+L{group_small_nodes()
+<pymassif.heapseq.HeapSeqNode.group_small_nodes>}) can only be used
+once the whole tree has been built; and for a large capture, that
+tree holds every call site that was seen in any snapshot.  A
+L{CoarseningPolicy} is instead given to a L{HeapSeqBuilder
+<pymassif.heapseq.HeapSeqBuilder>}, which applies it as snapshots are
+added:
+
+  - Nodes deeper than C{max_depth} are never created: the builder
+    merges each snapshot's subtree at that depth into a single leaf.
+  - Every C{interval} snapshots, the builder folds each subtree whose
+    peak size is below C{min_fraction} of the tree's peak size so
+    far, and each child beyond the C{max_children} largest children
+    of its parent; and then, if the tree still has more than
+    C{max_nodes} nodes, the smallest remaining subtrees.
+
+A subtree is folded by adding its sizes to an 'Other Allocations
+(coarsened)' leaf under its parent, so the size of every remaining
+node, at every time, is unchanged.  The parent remembers the folded
+call site, and its sizes in later snapshots are added to the same
+leaf; so folded subtrees are not built again, and the tree's size
+stays bounded.  (A call site that is small early in the run, and only
+grows later, therefore stays folded.)
+
+    >>> policy = CoarseningPolicy(min_fraction=0.001, max_nodes=10000)
+    >>> heap_seq = HeapSeq(MassifReader('massif.out.1234'),
+    ...                    coarsening=policy)
+"""
+
+import pymassif.heap, pymassif.heapseq
+import array, collections, itertools, operator
+
+class CoarseningPolicy(object):
+    """
+    The limits used to bound the size of a HeapSeq as it is built
+    (see L{pymassif.coarsen}).  Each limit is optional.  A policy can
+    also be applied to an existing HeapSeq, with L{coarsen()}.
+    """
+    #: The name of the leaf that holds the folded children of a node.
+    OTHER = pymassif.heap.HeapNode.OTHER_ALLOCATIONS + ' (coarsened)'
+
+    def __init__(self, max_depth=None, min_fraction=None, max_children=None,
+                 max_nodes=None, interval=16):
+        """
+        @param max_depth: The depth of the deepest nodes (where the
+            root is at depth 0).  Nodes at this depth are leaves.
+        @param min_fraction: Fold the subtrees whose peak size is
+            smaller than this fraction of the whole tree's peak size
+            (eg 0.001 for 0.1%).
+        @param max_children: The maximum number of children of each
+            node, including its 'Other' leaf.
+        @param max_nodes: The maximum number of nodes in the whole
+            tree, after the policy is applied.
+        @param interval: The number of snapshots that a
+            L{HeapSeqBuilder <pymassif.heapseq.HeapSeqBuilder>} adds
+            between applications of the policy.
+        """
+        for name, value in [('max_depth', max_depth),
+                            ('max_children', max_children),
+                            ('max_nodes', max_nodes),
+                            ('interval', interval)]:
+            if value is not None and value < 1:
+                raise ValueError('%s must be at least 1' % name)
+        if min_fraction is not None and not 0 <= min_fraction <= 1:
+            raise ValueError('min_fraction must be between 0 and 1')
+        self.max_depth = max_depth
+        self.min_fraction = min_fraction
+        self.max_children = max_children
+        self.max_nodes = max_nodes
+        self.interval = interval
+
+    def __repr__(self):
+        limits = ['%s=%r' % (name, getattr(self, name))
+                  for name in ('max_depth', 'min_fraction', 'max_children',
+                               'max_nodes')
+                  if getattr(self, name) is not None]
+        return '<CoarseningPolicy %s>' % (', '.join(limits) or 'unlimited')
+
+    def coarsen(self, heap_seq):
+        """
+        Fold the subtrees of the given HeapSeq that are outside this
+        policy's limits (in place).  This does not change the size of
+        any node that is kept.
+        """
+        other = heap_seq.site_table.intern(self.OTHER, None, None)
+        peaks = self._peak_sizes(heap_seq)
+        if self.min_fraction:
+            cutoff = peaks[heap_seq] * self.min_fraction
+        else:
+            cutoff = 0
+
+        # Fold the small children of each node, top-down, so that
+        # the children of folded nodes are never visited.
+        stack = [(heap_seq, 0)]
+        while stack:
+            node, depth = stack.pop()
+            if node.is_leaf:
+                continue
+            if depth == self.max_depth:
+                node.collapse()
+                continue
+            children = [c for c in node._children if not
+                        self._is_other(c, other)]
+            keep = [c for c in children if peaks[c] >= cutoff]
+            if self.max_children is not None:
+                has_other = (len(keep) < len(children) or
+                             node._child_index.get(other) is not None)
+                if len(keep) + has_other > self.max_children:
+                    keep.sort(key=lambda c: -peaks[c])
+                    del keep[self.max_children-1:]
+            if len(keep) < len(children):
+                kept = set(keep)
+                self._fold(node, [c for c in children if c not in kept],
+                           other)
+            stack.extend((c, depth+1) for c in keep)
+
+        if self.max_nodes is not None:
+            self._fold_smallest(heap_seq, other, peaks)
+
+    def _peak_sizes(self, heap_seq):
+        """
+        Return a dictionary mapping each node in heap_seq to its peak
+        size.  Unlike C{HeapSeqNode.bytes}, this does not cache the
+        series of every node: each node's series is added to its
+        parent's, and then discarded, so only the series of one path
+        of ancestors are kept at once.
+        """
+        n = len(heap_seq.time_axis)
+        nodes = []
+        stack = [heap_seq]
+        while stack:
+            node = stack.pop()
+            nodes.append(node)
+            stack.extend(node._children)
+        peaks = {}
+        sums = {}
+        add = operator.add
+        # In reverse preorder, each node comes after its descendants.
+        for node in reversed(nodes):
+            if node._row is not None:
+                series = node._row.tolist()
+                series.extend([0] * (n-len(series)))
+            else:
+                series = sums.pop(node, None) or [0] * n
+            peaks[node] = max(series or [0])
+            parent = node._parent
+            if node is not heap_seq:
+                if parent in sums:
+                    sums[parent] = map(add, sums[parent], series)
+                else:
+                    sums[parent] = series
+        return peaks
+
+    def _fold_smallest(self, heap_seq, other, peaks):
+        """
+        Fold the subtrees with the smallest peak sizes, until the tree
+        has at most C{max_nodes} nodes (or only the root and its
+        'Other' leaf are left).
+        """
+        nodes = [] # (node, depth), in preorder.
+        stack = [(heap_seq, 0)]
+        while stack:
+            node, depth = stack.pop()
+            nodes.append((node, depth))
+            stack.extend((c, depth+1) for c in node._children)
+        size = {} # The number of nodes in each subtree.
+        for node, depth in reversed(nodes):
+            size[node] = 1 + sum(size[c] for c in node._children)
+        count = size[heap_seq]
+        if count <= self.max_nodes:
+            return
+
+        # A subtree is never larger than its parent; so when they are
+        # visited smallest first (and deepest first, for ties), no
+        # node is visited after one of its ancestors has been folded.
+        candidates = sorted((peaks[node], -depth, i)
+                            for i, (node, depth) in enumerate(nodes)
+                            if depth > 0 and not self._is_other(node, other))
+        has_other = set(node for (node, depth) in nodes if not node.is_leaf
+                        and node._child_index.get(other) is not None)
+        folds = collections.defaultdict(list)
+        for (bytes, neg_depth, i) in candidates:
+            if count <= self.max_nodes:
+                break
+            node = nodes[i][0]
+            parent = node._parent
+            delta = -size[node]
+            if parent not in has_other:
+                has_other.add(parent)
+                delta += 1
+            folds[-neg_depth-1, parent].append(node)
+            count += delta
+            while parent is not None:
+                size[parent] += delta
+                parent = parent._parent
+
+        # Fold the deepest nodes first, so that any folded subtree of
+        # a folded node is included in its sizes.
+        for (depth, parent) in sorted(folds, key=lambda k: -k[0]):
+            self._fold(parent, folds[depth, parent], other)
+
+    def _fold(self, node, children, other):
+        """
+        Remove the given children from node, and add their sizes to
+        node's 'Other' leaf (creating it if necessary).
+        """
+        bucket = node._child_index.get(other)
+        if bucket is None:
+            bucket = pymassif.heapseq.HeapSeqNode(
+                None, self.OTHER, None, None, True, node.time_axis,
+                node.site_table)
+        # Add up the rows of the folded leaves (rather than using the
+        # children's series, which would be cached in every folded
+        # node); and unlink the folded subtrees, so that they can be
+        # freed as soon as they are removed.
+        rows = [bucket._row]
+        stack = list(children)
+        while stack:
+            child = stack.pop()
+            child._parent = None
+            if child._row is not None:
+                rows.append(child._row)
+            else:
+                stack.extend(child._children)
+                child._children = []
+                child._child_index = {}
+        bucket._row = array.array('l', map(sum, itertools.izip_longest(
+            fillvalue=0, *rows)))
+        folded = set(children)
+        old_index = node._child_index
+        node._set_children([c for c in node._children if c not in folded
+                            and c is not bucket] + [bucket])
+        # Map the folded sites (including any that were folded before)
+        # to the 'Other' leaf, so that their sizes in later snapshots
+        # are merged into it, rather than creating new children.
+        index = node._child_index
+        for site, child in old_index.iteritems():
+            if child is bucket or child in folded:
+                index.setdefault(site, bucket)
+        # This does not change node's series, but it does change the
+        # max_bytes of node and its ancestors.
+        bucket._clear_cache()
+        node._invalidate()
+
+    @staticmethod
+    def _is_other(node, other):
+        return node._site == other and node.is_leaf
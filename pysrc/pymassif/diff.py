@@ -0,0 +1,376 @@
+# massif/diff.py
+
+"""
+Compare the HeapSeqs of two massif runs (a I{base} run and a
+I{candidate} run, eg before and after a change), to find the call
+sites whose memory usage has changed.
+
+The two trees are joined by call site: the root nodes are paired, and
+then the children of each pair of nodes are paired by their (func,
+source_file, source_line), using a hash index of one side's children.
+Each node is visited once, so the join takes time linear in the size
+of the trees.  A node that is only present in one of the trees is
+paired with None.
+
+For each pair, two sizes are compared:
+
+  - The size at the peak: the node's size in the snapshot where its
+    tree's total size is largest.
+  - The time-weighted average size: the node's size in each
+    snapshot, weighted by the time until the next snapshot.
+
+The runs do not need to share snapshot times.  The diff can be
+printed as text, or converted into a HeapSeq of the growth (or
+shrinkage) of each node on a time axis of normalized progress (see
+L{pymassif.multirun.normalize_progress}), which can be displayed by
+the usual html views.
+
+Usage::
+
+    python -m pymassif.diff [options] BASE CANDIDATE
+"""
+
+if __name__ == '__main__':
+    import sys
+    sys.path.append('..')
+
+import pymassif.heap, pymassif.heapseq, pymassif.multirun, pymassif.util
+import array, itertools, operator
+
+def diff(base, candidate):
+    """
+    Compare two HeapSeqs, and return a L{HeapSeqDiff} for their root
+    nodes.
+    """
+    base_stats = _node_stats(base)
+    candidate_stats = _node_stats(candidate)
+    base_keys = _site_keys(base.site_table)
+    if candidate.site_table is base.site_table:
+        candidate_keys = base_keys
+    else:
+        candidate_keys = _site_keys(candidate.site_table)
+
+    def mk_diff(b, c):
+        node = HeapSeqDiff(b, c)
+        node.base_peak, node.base_avg = base_stats.get(b, (0, 0))
+        node.candidate_peak, node.candidate_avg = (
+            candidate_stats.get(c, (0, 0)))
+        return node
+
+    root = mk_diff(base, candidate)
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        b, c = node.base, node.candidate
+        # Index the base node's children by site.
+        index = {}
+        if b is not None:
+            for child in b:
+                index.setdefault(base_keys[child.site_id], []).append(child)
+        if c is not None:
+            for child in c:
+                matches = index.get(candidate_keys[child.site_id])
+                node.children.append(
+                    mk_diff(matches.pop(0) if matches else None, child))
+        if b is not None:
+            for child in b:
+                matches = index.get(base_keys[child.site_id])
+                if matches and matches[0] is child:
+                    node.children.append(mk_diff(matches.pop(0), None))
+        stack.extend(node.children)
+    return root
+
+class HeapSeqDiff(object):
+    """
+    A pair of corresponding nodes from two HeapSeqs, along with their
+    sizes at the peak and time-weighted average sizes.  Either node
+    may be None, if the call site is only present in one of the trees.
+    """
+    __slots__ = ('base', 'candidate', 'children', 'base_peak',
+                 'candidate_peak', 'base_avg', 'candidate_avg')
+
+    def __init__(self, base, candidate):
+        self.base = base
+        self.candidate = candidate
+        self.children = []
+        self.base_peak = self.candidate_peak = 0
+        self.base_avg = self.candidate_avg = 0
+
+    # Read-only attributes:
+    node = property(lambda self: self.base if self.candidate is None
+                    else self.candidate)
+    func = property(lambda self: self.node.func)
+    source_file = property(lambda self: self.node.source_file)
+    source_line = property(lambda self: self.node.source_line)
+    peak_delta = property(lambda self: self.candidate_peak-self.base_peak)
+    avg_delta = property(lambda self: self.candidate_avg-self.base_avg)
+
+    def __len__(self):
+        return len(self.children)
+    def __iter__(self):
+        return iter(self.children)
+
+    def walk(self):
+        """Generate this node and all of its descendants, in preorder."""
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            yield node
+            stack.extend(reversed(node.children))
+
+    def sorted(self):
+        """Return the children, largest change at the peak first."""
+        return sorted(self.children, key=lambda c: -abs(c.peak_delta))
+
+    def top(self, n=20, key='peak'):
+        """
+        Return the C{n} descendants whose size changed the most.
+
+        @param key: C{'peak'} to compare the sizes at the peak, or
+            C{'avg'} to compare the time-weighted average sizes.
+        """
+        delta = operator.attrgetter(key+'_delta')
+        nodes = itertools.islice(self.walk(), 1, None)
+        return sorted(nodes, key=lambda c: -abs(delta(c)))[:n]
+
+    ######################################################################
+    #{ Display/Output
+    ######################################################################
+
+    def __repr__(self):
+        return '<HeapSeqDiff: %s>' % _pprint_delta(self.peak_delta)
+
+    def __str__(self):
+        return self.pprint()
+
+    def describe(self):
+        """Return a one-line description of this node's change."""
+        return '%s  peak %s (%s -> %s)  avg %s (%s -> %s)' % (
+            self.func,
+            _pprint_delta(self.peak_delta),
+            pymassif.util.pprint_size(self.base_peak),
+            pymassif.util.pprint_size(self.candidate_peak),
+            _pprint_delta(self.avg_delta),
+            pymassif.util.pprint_size(self.base_avg),
+            pymassif.util.pprint_size(self.candidate_avg))
+
+    def pprint(self, depth=-1, min_delta=1):
+        """
+        Return a tree showing the change in each node whose size at
+        the peak or average size changed by at least C{min_delta}
+        bytes.
+        """
+        lines = []
+        stack = [(self, '', depth)]
+        while stack:
+            node, indent, depth = stack.pop()
+            if indent:
+                lines.append('%s+- %s' % (indent[:-2], node.describe()))
+            else:
+                lines.append(node.describe())
+            if depth == 0: continue
+            children = [c for c in node.sorted()
+                        if abs(c.peak_delta) >= min_delta or
+                        abs(c.avg_delta) >= min_delta]
+            for i, child in reversed(list(enumerate(children))):
+                if i < len(children)-1:
+                    stack.append((child, indent+'| ', depth-1))
+                else:
+                    stack.append((child, indent+'  ', depth-1))
+        return '\n'.join(lines)
+
+    def report(self, n=20, key='peak'):
+        """
+        Return a table of the C{n} call sites whose size changed the
+        most (see L{top()}).
+        """
+        lines = ['Total: ' + self.describe()]
+        for node in self.top(n, key):
+            lines.append('  %s' % node.describe())
+        return '\n'.join(lines)
+
+    ######################################################################
+    #{ Javascript Serialization
+    ######################################################################
+
+    def delta_heap_seq(self, resolution=100, growth=None):
+        """
+        Return a new HeapSeq with the change in each node's size, on a
+        time axis of normalized progress (with the times
+        C{0...resolution}).
+
+        @param growth: If None, then the sizes are the (signed)
+            differences between the candidate and base sizes.  If
+            true, then only increases are kept (decreases become
+            zero); and if false, then the sizes are the amounts by
+            which nodes decreased.  The html views can only display
+            the latter two.
+        """
+        progress_columns = pymassif.multirun.progress_columns
+        site_table = pymassif.heap.SiteTable()
+        time_axis = pymassif.heapseq.TimeAxis(range(resolution+1))
+        base_columns = candidate_columns = None
+        if self.base is not None:
+            base_columns = progress_columns(self.base.time_axis.times,
+                                            resolution)
+        if self.candidate is not None:
+            candidate_columns = progress_columns(
+                self.candidate.time_axis.times, resolution)
+
+        zeros = [0] * (resolution+1)
+        sub = operator.sub
+
+        def mk_node(diff):
+            b, c = diff.base, diff.candidate
+            src = diff.node
+            # If either side is a leaf, then the other is collapsed.
+            is_leaf = ((b is not None and b.is_leaf) or
+                       (c is not None and c.is_leaf))
+            node = pymassif.heapseq.HeapSeqNode(
+                src.addr, src.func, src.source_file, src.source_line,
+                is_leaf, time_axis, site_table)
+            if is_leaf:
+                if c is not None:
+                    row = _sizes(c, candidate_columns)
+                    if b is not None:
+                        row = map(sub, row, _sizes(b, base_columns))
+                else:
+                    row = map(operator.neg, _sizes(b, base_columns))
+                if growth is not None:
+                    if not growth: row = map(operator.neg, row)
+                    row = map(max, row, zeros)
+                node._row = array.array('l', row)
+            return node
+
+        root = mk_node(self)
+        stack = [(self, root)]
+        while stack:
+            diff, node = stack.pop()
+            if node.is_leaf: continue
+            for child in diff.children:
+                dst = mk_node(child)
+                node._add_child(dst)
+                stack.append((child, dst))
+        return root
+
+    def to_javascript(self, growth=True, resolution=100, indent=''):
+        """
+        Return the javascript for the growth (or, if C{growth} is
+        false, the shrinkage) of each node, in the same format as
+        L{HeapSeqNode.to_javascript()
+        <pymassif.heapseq.HeapSeqNode.to_javascript>}, so that it can
+        be displayed by the html views.
+        """
+        heap_seq = self.delta_heap_seq(resolution, bool(growth))
+        heap_seq.discard_empty_nodes()
+        heap_seq.reset_uids(0)
+        return heap_seq.to_javascript(indent=indent)
+
+######################################################################
+#{ Helpers
+######################################################################
+
+def _site_keys(site_table):
+    """
+    Return a list mapping each site id in site_table to a key that
+    identifies its site in any site table.
+    """
+    return [(str(func), source_file, source_line)
+            for (func, source_file, source_line) in site_table]
+
+def _node_stats(heap_seq):
+    """
+    Return a dictionary mapping each node in heap_seq to a tuple
+    C{(peak, avg)} of its size at the peak and its time-weighted
+    average size.  The sizes of the leaves are computed from their
+    rows, and then summed up the tree.
+    """
+    times = heap_seq.time_axis.times
+    n = len(times)
+    nodes = []
+    rows = []
+    stack = [heap_seq]
+    while stack:
+        node = stack.pop()
+        nodes.append(node)
+        if node._row is not None:
+            rows.append(node._row)
+        else:
+            stack.extend(node._children)
+    total = map(sum, itertools.izip_longest(fillvalue=0, *rows))
+    peak = max(range(len(total)), key=total.__getitem__) if total else -1
+
+    # The weight of each snapshot is the time until the next one.
+    weights = [0] * n
+    order = sorted(range(n), key=times.__getitem__)
+    for c, next_c in zip(order, order[1:]):
+        weights[c] = times[next_c] - times[c]
+    duration = float(sum(weights))
+    if not duration and n:
+        weights[order[-1]] = duration = 1.0
+
+    stats = {}
+    mul = operator.mul
+    for node in reversed(nodes):
+        row = node._row
+        if row is not None:
+            stats[node] = (row[peak] if 0 <= peak < len(row) else 0,
+                           sum(itertools.imap(mul, row, weights))/duration
+                           if duration else 0)
+        else:
+            node_peak = node_avg = 0
+            for child in node._children:
+                child_peak, child_avg = stats[child]
+                node_peak += child_peak
+                node_avg += child_avg
+            stats[node] = (node_peak, node_avg)
+    return stats
+
+def _sizes(node, columns):
+    """
+    Return a list of node's sizes at the given columns of its time
+    axis (as returned by L{pymassif.multirun.progress_columns()}).
+    """
+    series = node._row if node.is_leaf else node._series()
+    # Rows may be shorter than the time axis; pad them with zeros.
+    needed = len(node.time_axis)
+    if len(series) < needed:
+        series = list(series) + [0] * (needed-len(series))
+    if needed == 0:
+        return [0] * len(columns)
+    return map(series.__getitem__, columns)
+
+def _pprint_delta(bytes):
+    if bytes < 0:
+        return '-' + pymassif.util.pprint_size(-bytes)
+    return '+' + pymassif.util.pprint_size(bytes)
+
+######################################################################
+#{ Command line
+######################################################################
+
+def main(args=None):
+    import optparse, pymassif.cache
+    parser = optparse.OptionParser(
+        usage='%prog [options] BASE CANDIDATE',
+        description='Compare the massif output files from two runs, and '
+        'list the call sites whose memory usage changed the most.')
+    parser.add_option('-n', '--num-sites', type='int', default=20,
+                      help='number of call sites to list [default: %default]')
+    parser.add_option('-k', '--key', default='peak', choices=['peak', 'avg'],
+                      help='compare sizes at the peak ("peak") or '
+                      'time-weighted averages ("avg") [default: %default]')
+    parser.add_option('-t', '--tree', action='store_true', default=False,
+                      help='print the tree of changes, rather than a list')
+    options, args = parser.parse_args(args)
+    if len(args) != 2:
+        parser.error('expected BASE and CANDIDATE')
+    base, candidate = [pymassif.cache.load_heap_seq(f) for f in args]
+    result = diff(base, candidate)
+    if options.tree:
+        print result.pprint()
+    else:
+        print result.report(options.num_sites, options.key)
+
+if __name__ == '__main__':
+    main()
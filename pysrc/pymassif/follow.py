@@ -0,0 +1,198 @@
+# massif/follow.py
+
+"""
+Follow a directory of massif snapshot files, such as the files
+written by C{vgdb snapshot} while a program is running under massif,
+and keep the html output up to date as new files appear.
+
+The directory is polled (no external dependencies are needed).  Each
+new file is parsed once, by a pool of worker threads, and its
+snapshots are merged into a single L{HeapSeqBuilder
+<pymassif.heapseq.HeapSeqBuilder>}; so the cost of reading and
+merging depends only on the files that are new since the last poll,
+not on the number of files seen so far.  The html pages are only
+rewritten after a poll that added at least one snapshot.  Every page
+shows the whole time axis, so each of them changes whenever a
+snapshot is added; rewriting them costs time in proportion to the
+size of the merged tree (but the tree itself is not copied).  The
+auxiliary files used by the pages are only copied once.
+
+Usage::
+
+    python -m pymassif.follow [options] DIRECTORY OUTDIR
+"""
+
+if __name__ == '__main__':
+    import sys
+    sys.path.append('..')
+
+import pymassif.heapseq, pymassif.snapshot, pymassif.html
+import os, sys, fnmatch, time
+from multiprocessing.pool import ThreadPool
+
+class DirectoryFollower(object):
+    """
+    Watches a directory for new massif snapshot files, and merges
+    them into an incrementally updated HeapSeq:
+
+        >>> follower = DirectoryFollower('snapshots', 'html')
+        >>> follower.run() # poll until interrupted
+
+    A file is only read once its size and modification time have not
+    changed between two polls, so that files which are still being
+    written are not read early.  Each file is read once; files that
+    are later modified are not read again.
+    """
+    def __init__(self, directory, outdir=None, pattern='massif.out*',
+                 workers=4, include_overhead=True, include_stacks=True):
+        """
+        @param directory: The directory to watch.
+        @param outdir: The directory where the html output is written.
+            If None, then no html output is written.
+        @param pattern: A glob pattern for the names of the files to
+            read.
+        @param workers: The number of threads used to read new files.
+        @param include_overhead: See L{HeapSeqBuilder.__init__()
+            <pymassif.heapseq.HeapSeqBuilder.__init__>}.
+        @param include_stacks: See L{HeapSeqBuilder.__init__()
+            <pymassif.heapseq.HeapSeqBuilder.__init__>}.
+        """
+        self.directory = directory
+        self.outdir = outdir
+        self.pattern = pattern
+        self.builder = pymassif.heapseq.HeapSeqBuilder(include_overhead,
+                                                       include_stacks)
+        self._pool = ThreadPool(workers)
+        self._pending = {} # filename -> (size, mtime) at the last poll
+        self._seen = set()
+        self._aux_files_copied = False
+
+    def poll(self):
+        """
+        Check the directory once, read any new files whose contents
+        are complete, and (if any snapshots were added) rewrite the
+        html output.  Return the list of files that were read.
+        Errors while writing the html output are reported, and do not
+        stop later polls.
+        """
+        ready = self._ready_files()
+        counts = self._pool.map(self._ingest, ready)
+        if sum(counts) and self.outdir is not None:
+            try:
+                self.write_html()
+            except Exception, e:
+                sys.stderr.write('Could not write html output to %s: '
+                                 '%s: %s\n' % (self.outdir,
+                                               e.__class__.__name__, e))
+        return ready
+
+    def run(self, interval=1.0, max_polls=None):
+        """
+        Poll the directory every C{interval} seconds, until
+        interrupted (or until C{max_polls} polls have been done).
+        """
+        polls = 0
+        while max_polls is None or polls < max_polls:
+            if polls: time.sleep(interval)
+            self.poll()
+            polls += 1
+
+    def close(self):
+        """Stop the worker threads."""
+        self._pool.close()
+        self._pool.join()
+
+    def heap_seq(self):
+        """Return a copy of the HeapSeq for the files read so far."""
+        return self.builder.heap_seq()
+
+    def write_html(self):
+        """Write html output for the files read so far to C{outdir}."""
+        if not self._aux_files_copied:
+            if not os.path.exists(self.outdir):
+                os.makedirs(self.outdir)
+            pymassif.html.copy_aux_files(self.outdir)
+            self._aux_files_copied = True
+        # write_html_pages() does not modify the HeapSeq it is given,
+        # so it can use the builder's own HeapSeq, rather than a copy.
+        # (poll() only calls this once every new file has been merged.)
+        pymassif.html.write_html_pages(self.builder.heap_seq(copy=False),
+                                       self.outdir)
+
+    def _ready_files(self):
+        """
+        Return a sorted list of the files in the directory that have
+        not been read yet, and whose size and modification time are
+        the same as at the last poll.
+        """
+        pending = {}
+        ready = []
+        for name in sorted(os.listdir(self.directory)):
+            if name in self._seen or not fnmatch.fnmatch(name, self.pattern):
+                continue
+            filename = os.path.join(self.directory, name)
+            try:
+                st = os.stat(filename)
+            except OSError:
+                continue # eg removed since listdir()
+            stamp = (st.st_size, st.st_mtime)
+            if self._pending.get(name) == stamp:
+                self._seen.add(name)
+                ready.append(filename)
+            else:
+                pending[name] = stamp
+        self._pending = pending
+        return ready
+
+    def _ingest(self, filename):
+        """
+        Read a single file, and add its snapshots to the builder.
+        Return the number of snapshots added.  This is run by the
+        worker threads: the snapshots are parsed concurrently, and
+        the builder serializes the merges.
+        """
+        try:
+            with pymassif.snapshot.MassifReader(filename) as reader:
+                snapshots = list(reader)
+        except (IOError, ValueError), e:
+            sys.stderr.write('Skipping %s: %s\n' % (filename, e))
+            return 0
+        self.builder.add_all(snapshots)
+        return len(snapshots)
+
+######################################################################
+#{ Command line
+######################################################################
+
+def main(args=None):
+    import optparse
+    parser = optparse.OptionParser(
+        usage='%prog [options] DIRECTORY OUTDIR',
+        description='Watch DIRECTORY for massif snapshot files, and '
+        'keep the html output in OUTDIR up to date.')
+    parser.add_option('-p', '--pattern', default='massif.out*',
+                      help='glob pattern for snapshot file names '
+                      '[default: %default]')
+    parser.add_option('-i', '--interval', type='float', default=1.0,
+                      help='seconds between polls [default: %default]')
+    parser.add_option('-j', '--workers', type='int', default=4,
+                      help='number of reader threads [default: %default]')
+    parser.add_option('--no-overhead', dest='include_overhead',
+                      action='store_false', default=True)
+    parser.add_option('--no-stacks', dest='include_stacks',
+                      action='store_false', default=True)
+    options, args = parser.parse_args(args)
+    if len(args) != 2:
+        parser.error('expected DIRECTORY and OUTDIR')
+    follower = DirectoryFollower(args[0], args[1], options.pattern,
+                                 options.workers, options.include_overhead,
+                                 options.include_stacks)
+    try:
+        follower.run(options.interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        follower.close()
+
+if __name__ == '__main__':
+    main()
@@ -3,7 +3,7 @@
 A data structure that encodes the contents of a single massif heap dump.
 """
 
-import re
+import re, collections, array
 import pymassif.util
 
 def HeapTree(s):
@@ -28,7 +28,13 @@ class HeapNode(object):
     directly contain some number of bytes.  Non-leaf nodes have one or
     more children, and their size is defined as the sum of their
     childrens' sizes.
+
+    Heap trees are immutable, so the size of each non-leaf node is
+    computed once, when it is constructed.
     """
+    __slots__ = ('_addr', '_func', '_source_file', '_source_line',
+                 '_children', '_bytes', '_uid')
+
     _uid_counter = 0
     def __init__(self, addr, func, source_file=None, source_line=None,
                  children=(), bytes=None):
@@ -36,8 +42,11 @@ class HeapNode(object):
         assert children==() or bytes is None
         self._addr = addr
         self._func = FunctionName.parse(func)
-        self._children = list(children)
-        self._bytes = bytes
+        self._children = tuple(children)
+        if self._children:
+            self._bytes = sum(c._bytes for c in self._children)
+        else:
+            self._bytes = bytes or 0
         self._source_file = source_file
         self._source_line = source_line
         self._uid = self.__class__._uid_counter
@@ -53,14 +62,8 @@ class HeapNode(object):
     source_file = property(lambda self: self._source_file)
     source_line = property(lambda self: self._source_line)
     uid = property(lambda self: self._uid)
-    is_leaf = property(lambda self: self._bytes is not None)
-    
-    @property
-    def bytes(self):
-        if self.is_leaf:
-            return self._bytes
-        else:
-            return sum(c.bytes for c in self._children)
+    is_leaf = property(lambda self: not self._children)
+    bytes = property(lambda self: self._bytes)
 
     def __getitem__(self, index):
         return self._children[index]
@@ -74,26 +77,32 @@ class HeapNode(object):
     ######################################################################
 
     def print_massif_line(self):
-        s = 'n%d: %d ' % (len(self._children), self.bytes)
+        s = 'n%d: %d ' % (len(self), self.bytes)
         if self.addr is not None:
             s += '%s: ' % self.addr
-        s += self.func
+        s += str(self.func)
         if self.source_file is not None:
-            s += ' (in %s' % self.source_file
-            if self.source_line is not None: s += ':%d' % self.source_line
-            s += ')'
+            if self.source_line is not None:
+                s += ' (%s:%s)' % (self.source_file, self.source_line)
+            else:
+                s += ' (in %s)' % self.source_file
         return s
-        
+
     def print_massif_tree(self, indent='', depth=-1):
-        s = '%s%s' % (indent, self.print_massif_line())
-        if depth == 0: return s
-        for child in sorted(self._children, key=lambda c:-c.bytes):
-            s += '\n' + child.print_massif_tree(indent+' ', depth-1)
-        return s
+        lines = []
+        stack = [(self, indent, depth)]
+        while stack:
+            node, indent, depth = stack.pop()
+            lines.append(indent + node.print_massif_line())
+            if depth == 0: continue
+            children = sorted(node, key=lambda c:-c.bytes)
+            for child in reversed(children):
+                stack.append((child, indent+' ', depth-1))
+        return '\n'.join(lines)
 
     def __repr__(self):
         return '<HeapNode for %r: %s>' % (
-            self.func, pymassif.util.pprint_size(self.bytes))
+            str(self.func), pymassif.util.pprint_size(self.bytes))
 
     def __str__(self):
         return self.print_massif_tree()
@@ -106,77 +115,433 @@ class HeapNode(object):
     ######################################################################
     
     @classmethod
-    def parse(cls, s):
+    def parse(cls, s, validate=False):
         """
         Parse a string containing a Heap Tree and return it as a tree
-        of HeapNode objects.
+        of HeapNode objects.  See L{parse_lines()}.
         """
-        s = s.rstrip()
-        lines = s.split('\n')
-        stack = [{'children': []}]
+        return cls.parse_lines(s.rstrip().split('\n'), validate)
+
+    @classmethod
+    def parse_lines(cls, lines, validate=False):
+        """
+        Parse a sequence of lines (with or without trailing newlines)
+        that make up a Heap Tree, and return it as a tree of HeapNode
+        objects.
+
+        The tree structure is reconstructed from the child count at
+        the start of each line.  If C{validate} is true, then also
+        check that each line's indentation matches its depth, and
+        that each non-leaf node's size is the sum of its children's
+        sizes; and raise a ValueError if not.
+        """
+        match = cls._HEAP_TREE_LINE_RE.match
+        mk_heap_node = cls._mk_heap_node
+        roots = []
+        # Each stack entry describes a non-leaf node whose children
+        # have not all been read yet: [line_groups, children,
+        # children_bytes].
+        stack = []
         for lineno, line in enumerate(lines):
-            m = cls._HEAP_TREE_LINE_RE.match(line)
+            m = match(line)
             if m is None:
                 raise ValueError('Error parsing line %d of heap tree: %r' %
                                  (lineno, line))
-            #if m.group('bytes') == '0':
-            #    print 'Warning: zero byte allocation on line %d' % lineno
-            indent = len(m.group('indent'))
-            assert indent < len(stack)
-            while indent < (len(stack)-1):
-                node = cls._mk_heap_node(**stack.pop())
-                stack[-1].setdefault('children',[]).append(node)
-            stack.append( m.groupdict() )
-        while len(stack)>1:
-            node = cls._mk_heap_node(**stack.pop())
-            stack[-1].setdefault('children',[]).append(node)
-        assert len(stack[0]['children']) == 1
-        heap_tree = stack[0]['children'][0]
-        #assert heap_tree.print_massif_tree() == s
-        return heap_tree
+            groups = m.groups()
+            if validate and len(groups[0]) != len(stack):
+                raise ValueError('Bad indentation on line %d of heap '
+                                 'tree: %r' % (lineno, line))
+            if groups[1] != '0':
+                stack.append([groups, [], 0])
+                continue
+            node = mk_heap_node(groups, None)
+            node_bytes = node._bytes
+            # Add the node to its parent; and build any parents whose
+            # children are now complete.
+            while stack:
+                entry = stack[-1]
+                children = entry[1]
+                children.append(node)
+                entry[2] += node_bytes
+                if len(children) < int(entry[0][1]):
+                    break
+                stack.pop()
+                node_bytes = int(entry[0][2])
+                if validate and node_bytes != entry[2]:
+                    raise ValueError('Heap tree node size %d does not match '
+                                     'the sum of its children (%d): %r' %
+                                     (node_bytes, entry[2], entry[0][4]))
+                node = mk_heap_node(entry[0], children)
+            else:
+                roots.append(node)
+        if stack:
+            raise ValueError('Heap tree is truncated')
+        if len(roots) != 1:
+            raise ValueError('Expected exactly one heap tree root; got %d' %
+                             len(roots))
+        return roots[0]
 
     ALLOCATION = 'Heap allocation (malloc/new/etc)'
     OTHER_CALLERS = 'Other callers (below threshold)'
     UNKNOWN_FUNC = '???'
     BELOW_MAIN = '(below main)'
     OTHER_ALLOCATIONS = 'Other Allocations'
+    _MASSIF_ALLOCATION = ('(heap allocation functions) '
+                          'malloc/new/new[], --alloc-fns, etc.')
+
     @classmethod
-    def _mk_heap_node(cls, indent, num_children, bytes, addr,
-                      func, children=None):
-        """Helper for HeapTree()"""
-        # Extract the source file & source line, if present.
-        m = re.match('^(.*) \((\S+):(\d+)\)$', func)
-        if m is None:
-            m = re.match('^(.*) \(in (\S+)\)$', func)
-            if m is None:
-                source_file = source_line = None
-            else:
-                func, source_file = m.groups()
-                source_line = None
+    def _mk_heap_node(cls, groups, children):
+        """
+        Helper for parse_lines(): build a node from the groups of a
+        _HEAP_TREE_LINE_RE match.
+        """
+        addr, func, source_file, source_line = cls._parse_site(groups)
+        if children is not None:
+            return cls(addr, func, source_file, source_line,
+                       children=children)
         else:
-            func, source_file, source_line = m.groups()
+            return cls(addr, func, source_file, source_line,
+                       bytes=int(groups[2]))
+
+    @classmethod
+    def _parse_site(cls, groups):
+        """
+        Return a tuple C{(addr, func, source_file, source_line)} for
+        the groups of a _HEAP_TREE_LINE_RE match, where C{func} is the
+        (normalized) function string.
+        """
+        func = groups[4]
+        # Extract the source file & source line, if present.
+        source_file = source_line = None
+        i = func.rfind(' (')
+        if i > 0:
+            m = cls._SOURCE_RE.match(func, i)
+            if m is not None:
+                func = func[:i]
+                source_file, source_line, in_file = m.groups()
+                if source_file is None: source_file = in_file
         # Normalize the function name
-        if func == ('(heap allocation functions) '
-                    'malloc/new/new[], --alloc-fns, etc.'):
+        if func == cls._MASSIF_ALLOCATION:
             func = HeapNode.ALLOCATION
-        if re.match('in \d+ places?, (all )?below massif.*', func):
+        elif func.startswith('in ') and cls._BELOW_MASSIF_RE.match(func):
             func = HeapNode.OTHER_CALLERS
-        # Build the node.
-        if children is not None:
-            assert int(bytes) == sum(c.bytes for c in children)
-            assert int(num_children) == len(children)
-            return cls(addr, func, source_file, source_line, children=children)
-        else:
-            assert int(num_children) == 0
-            return cls(addr, func, source_file, source_line, bytes=int(bytes))
+        return groups[3], func, source_file, source_line
 
+    # Groups: indent, num_children, bytes, addr, func
     _HEAP_TREE_LINE_RE = re.compile(
-        r'(?P<indent>\s*)n(?P<num_children>\d+): (?P<bytes>\d+) '
-        r'((?P<addr>[0-9-zA-ZxX]+): )?'
-        r'(?P<func>.+)')
+        r'(\s*)n(\d+): (\d+) '
+        r'(?:([0-9-zA-ZxX]+): )?'
+        r'(.+?)\r?$')
+    # Groups: source_file, source_line, source_file (for "(in file)")
+    _SOURCE_RE = re.compile(r' \((?:(\S+):(\d+)|in (\S+))\)$')
+    _BELOW_MASSIF_RE = re.compile(r'in \d+ places?, (all )?below massif')
 
 
 
+class SiteTable(object):
+    """
+    A table that interns call sites, and assigns each one an integer
+    site id.  A call site is a C{(func, source_file, source_line)}
+    tuple, where C{func} is a L{FunctionName}; nodes from different
+    trees that have the same call site are considered to match (so
+    their sizes are combined when the trees are merged).
+
+    A single SiteTable is normally shared by every tree built from
+    the same massif run, so that each call site is only stored once,
+    and so that nodes can be matched by comparing their site ids.
+    """
+    def __init__(self):
+        self._sites = []
+        self._ids = {}
+
+    def intern(self, func, source_file=None, source_line=None):
+        """
+        Return the site id for the given call site, adding it to the
+        table if necessary.
+
+        @param func: A function name string or L{FunctionName}.
+        """
+        key = (str(func), source_file, source_line)
+        site_id = self._ids.get(key)
+        if site_id is None:
+            site_id = self._ids[key] = len(self._sites)
+            if not isinstance(func, FunctionName):
+                func = FunctionName.parse(func)
+            self._sites.append((func, source_file, source_line))
+        return site_id
+
+    def site_id(self, node):
+        """
+        Return the site id for the given node (a HeapNode,
+        CompactHeapNode, or HeapSeqNode), adding its call site to the
+        table if necessary.  If the node already uses this table, then
+        just return its site id.
+        """
+        if getattr(node, 'site_table', None) is self:
+            return node.site_id
+        return self.intern(node.func, node.source_file, node.source_line)
+
+    def __getitem__(self, site_id):
+        """
+        Return the call site with the given id, as a tuple
+        C{(func, source_file, source_line)}.
+        """
+        return self._sites[site_id]
+
+    def __len__(self):
+        return len(self._sites)
+
+    def __iter__(self):
+        return iter(self._sites)
+
+    def __repr__(self):
+        return '<SiteTable (%d sites)>' % len(self)
+
+class CompactHeapTree(object):
+    """
+    A compact representation of a heap tree, which stores its nodes in
+    parallel arrays rather than as one HeapNode object per node.  The
+    nodes are numbered in preorder (so the root is node 0, and the
+    first child of node C{i} is node C{i+1}), and for each node we
+    record:
+
+      - C{site}: the id of the node's call site in a L{SiteTable},
+        which may be shared by many trees (eg all of the snapshots in
+        a file).
+      - C{addr}: the node's address.
+      - C{end}: the index just past the node's subtree.  This is also
+        the index of the node's next sibling, if it has one.
+      - C{parent}: the index of the node's parent (or -1 for the root).
+      - C{bytes}: the node's size.
+
+    Use L{root} (or L{node()}) to get a L{CompactHeapNode} view of a
+    node, which provides the same read-only interface as HeapNode, and
+    can be used anywhere a HeapNode is expected (eg by
+    L{HeapSeqNode.merge() <pymassif.heapseq.HeapSeqNode.merge>} and
+    L{HeapNode.print_massif_tree()}).
+
+        >>> tree = CompactHeapTree.parse_lines(lines)
+        >>> print tree.root.print_massif_tree()
+    """
+    def __init__(self, site_table=None):
+        """
+        Create a new empty tree.  Use L{parse_lines()} or
+        L{from_heap_node()} to build a tree.
+
+        @param site_table: The SiteTable used to intern this tree's
+            call sites.  If not specified, a new SiteTable is used.
+        """
+        if site_table is None:
+            site_table = SiteTable()
+        self._site_table = site_table
+        self._site = array.array('i')
+        self._addr = []
+        self._end = array.array('i')
+        self._parent = array.array('i')
+        self._bytes = array.array('l')
+
+    ######################################################################
+    #{ Accessors
+    ######################################################################
+
+    root = property(lambda self: CompactHeapNode(self, 0), doc="""
+        A view of the root node of this tree.""")
+    site_table = property(lambda self: self._site_table)
+
+    def node(self, index):
+        """Return a view of the node with the given preorder index."""
+        if not 0 <= index < len(self._site):
+            raise IndexError('node index out of range')
+        return CompactHeapNode(self, index)
+
+    def __len__(self):
+        """Return the number of nodes in this tree."""
+        return len(self._site)
+
+    def __repr__(self):
+        return '<CompactHeapTree (%d nodes)>' % len(self)
+
+    ######################################################################
+    #{ Construction
+    ######################################################################
+
+    def _add_node(self, addr, site_id, parent, bytes):
+        """
+        Append a node to the tree, and return its index.  Its end index
+        must be set once all of its descendants have been added.
+        """
+        index = len(self._site)
+        self._site.append(site_id)
+        # Addresses are shared by many nodes (and trees).
+        self._addr.append(addr if addr is None else intern(addr))
+        self._end.append(index+1)
+        self._parent.append(parent)
+        self._bytes.append(bytes)
+        return index
+
+    @classmethod
+    def parse(cls, s, validate=False, site_table=None):
+        """
+        Parse a string containing a Heap Tree and return it as a
+        CompactHeapTree.  See L{parse_lines()}.
+        """
+        return cls.parse_lines(s.rstrip().split('\n'), validate,
+                               site_table)
+
+    @classmethod
+    def parse_lines(cls, lines, validate=False, site_table=None):
+        """
+        Parse a sequence of lines that make up a Heap Tree, and return
+        it as a CompactHeapTree.  The lines are interpreted exactly as
+        they are by L{HeapNode.parse_lines()}.
+
+        @param site_table: The SiteTable used to intern the tree's
+            call sites.  If not specified, a new SiteTable is used.
+        """
+        tree = cls(site_table)
+        match = HeapNode._HEAP_TREE_LINE_RE.match
+        parse_site = HeapNode._parse_site
+        intern_site = tree._site_table.intern
+        add_node = tree._add_node
+        end = tree._end
+        node_bytes = tree._bytes
+        # Each stack entry describes a non-leaf node whose children
+        # have not all been read yet: [index, line_groups,
+        # num_children_left, children_bytes].
+        stack = []
+        for lineno, line in enumerate(lines):
+            m = match(line)
+            if m is None:
+                raise ValueError('Error parsing line %d of heap tree: %r' %
+                                 (lineno, line))
+            groups = m.groups()
+            if validate and len(groups[0]) != len(stack):
+                raise ValueError('Bad indentation on line %d of heap '
+                                 'tree: %r' % (lineno, line))
+            if stack:
+                parent = stack[-1][0]
+            elif lineno == 0:
+                parent = -1
+            else:
+                raise ValueError('Expected exactly one heap tree root')
+            num_children = int(groups[1])
+            addr, func, source_file, source_line = parse_site(groups)
+            index = add_node(addr, intern_site(func, source_file,
+                                               source_line),
+                             parent, 0 if num_children else int(groups[2]))
+            if num_children:
+                stack.append([index, groups, num_children, 0])
+                continue
+            # Record the node's size in its parent; and finish any
+            # parents whose children are now complete.
+            bytes = node_bytes[index]
+            while stack:
+                entry = stack[-1]
+                entry[2] -= 1
+                entry[3] += bytes
+                if entry[2]:
+                    break
+                stack.pop()
+                bytes = entry[3]
+                if validate and int(entry[1][2]) != bytes:
+                    raise ValueError('Heap tree node size %s does not match '
+                                     'the sum of its children (%d): %r' %
+                                     (entry[1][2], bytes, entry[1][4]))
+                node_bytes[entry[0]] = bytes
+                end[entry[0]] = len(end)
+        if stack:
+            raise ValueError('Heap tree is truncated')
+        if not end:
+            raise ValueError('Expected exactly one heap tree root; got 0')
+        return tree
+
+    @classmethod
+    def from_heap_node(cls, heap_node, site_table=None):
+        """
+        Return a CompactHeapTree containing a copy of the tree rooted
+        at C{heap_node} (a HeapNode or CompactHeapNode).
+
+        @param site_table: The SiteTable used to intern the tree's
+            call sites.  If not specified, a new SiteTable is used.
+        """
+        tree = cls(site_table)
+        # Each stack entry is (heap_node, parent_index); or (None,
+        # index) to mark where the subtree of node index ends.
+        stack = [(heap_node, -1)]
+        while stack:
+            node, parent = stack.pop()
+            if node is None:
+                tree._end[parent] = len(tree._end)
+                continue
+            index = tree._add_node(node.addr,
+                                   tree._site_table.site_id(node),
+                                   parent, node.bytes)
+            stack.append((None, index))
+            stack.extend((child, index) for child in reversed(list(node)))
+        return tree
+
+class CompactHeapNode(HeapNode):
+    """
+    A read-only view of a single node in a L{CompactHeapTree}, which
+    provides the same interface as HeapNode.  Views are created on
+    demand, and hold a reference to their tree.  A node's C{uid} is
+    its preorder index within the tree.  Its C{site_id} is the id of
+    its call site in the tree's C{site_table}.
+    """
+    __slots__ = ('_tree', '_index')
+
+    def __init__(self, tree, index):
+        self._tree = tree
+        self._index = index
+
+    ######################################################################
+    #{ Accessors
+    ######################################################################
+
+    def _site(self):
+        return self._tree._site_table[self._tree._site[self._index]]
+
+    # Read-only attributes:
+    addr = property(lambda self: self._tree._addr[self._index])
+    func = property(lambda self: self._site()[0])
+    source_file = property(lambda self: self._site()[1])
+    source_line = property(lambda self: self._site()[2])
+    uid = property(lambda self: self._index)
+    site_id = property(lambda self: self._tree._site[self._index])
+    site_table = property(lambda self: self._tree._site_table)
+    is_leaf = property(lambda self:
+                       self._tree._end[self._index] == self._index+1)
+    bytes = property(lambda self: self._tree._bytes[self._index])
+
+    @property
+    def parent(self):
+        """A view of this node's parent, or None for the root."""
+        parent = self._tree._parent[self._index]
+        if parent < 0: return None
+        return CompactHeapNode(self._tree, parent)
+
+    def __getitem__(self, index):
+        return list(self)[index]
+    def __len__(self):
+        return sum(1 for child in self._child_indices())
+    def __iter__(self):
+        tree = self._tree
+        for child in self._child_indices():
+            yield CompactHeapNode(tree, child)
+
+    def _child_indices(self):
+        end = self._tree._end
+        child = self._index+1
+        stop = end[self._index]
+        while child < stop:
+            yield child
+            child = end[child]
+
+    def __repr__(self):
+        return '<CompactHeapNode for %r: %s>' % (
+            str(self.func), pymassif.util.pprint_size(self.bytes))
+
+
 class FunctionName(object):
     """
     A class used to parse a function name into its component piece.
@@ -193,51 +558,61 @@ class FunctionName(object):
 
     Special names, such as \"(below main)\", are stored as the 'name'
     field and the remaining fields are left blank.
+
+    The function string is only decomposed into these pieces the
+    first time that one of them is accessed.  Comparison and hashing
+    use the function string itself, so FunctionNames can be used as
+    keys without ever being decomposed.
+
+    FunctionName objects are immutable.  L{parse()} interns the
+    objects it returns in a bounded LRU cache, so parsing the same
+    function string twice returns the same shared object (unless it
+    was evicted in between).  Use L{set_cache_size()} and
+    L{cache_info()} to configure and monitor the cache.
     """
+    __slots__ = ('_string', '_pieces')
+
     SPECIAL_FUNCTIONS = (HeapNode.ALLOCATION,
                          HeapNode.OTHER_CALLERS,
                          HeapNode.UNKNOWN_FUNC,
                          HeapNode.BELOW_MAIN,
                          HeapNode.OTHER_ALLOCATIONS)
 
-    def __init__(self, rtype, context, name, template_args, args, qualifiers):
-        self.rtype = rtype
-        self.context = context
-        self.name = name
-        self.template_args = template_args
-        self.args = args
-        self.qualifiers = qualifiers
-        if self.rtype:
-            assert not re.search(r'\boperator\b', self.rtype)
-        if self.context:
-            assert not re.search(r'\boperator\b', self.context)
+    def __init__(self, function_string):
+        self._string = function_string.strip()
+        self._pieces = None
+
+    # Read-only attributes:
+    rtype = property(lambda self: self.pieces()[0])
+    context = property(lambda self: self.pieces()[1])
+    name = property(lambda self: self.pieces()[2])
+    template_args = property(lambda self: self.pieces()[3])
+    args = property(lambda self: self.pieces()[4])
+    qualifiers = property(lambda self: self.pieces()[5])
 
     def __repr__(self):
         raise ValueError('shoudl this really be called?')
 
     def __str__(self):
-        s = ''
-        if self.rtype: s += self.rtype+' '
-        if self.context: s += self.context
-        if self.name: s += self.name
-        if self.template_args: s += self.template_args
-        if self.args: s += self.args
-        if self.qualifiers: s += ' '+self.qualifiers
-        return s
+        return self._string
 
     def __cmp__(self, other):
         return (cmp(self.__class__, other.__class__) or
-                cmp(self.pieces(), other.pieces()))
+                cmp(self._string, other._string))
 
     def __eq__(self, other):
         return (self.__class__ is other.__class__ and
-                self.pieces()==other.pieces())
+                self._string == other._string)
 
     def __ne__(self, other):
         return not self.__eq__(other)
 
     def __hash__(self):
-        return hash(self.pieces())
+        return hash(self._string)
+
+    def __reduce__(self):
+        # Unpickled (and copied) FunctionNames are interned.
+        return (_parse_function_name, (self._string,))
 
     def pieces(self):
         """
@@ -245,131 +620,184 @@ class FunctionName(object):
         this function.  The tuple has the form:
         (rtype, context, name, template_args, args, qualifiers)
         """
-        return (self.rtype, self.context, self.name,
-                self.template_args, self.args, self.qualifiers)
+        if self._pieces is None:
+            self._pieces = self._decompose(self._string)
+        return self._pieces
 
-    # anonymous namespace?
-    _IDENTIFIER_RE = re.compile(r'^\w+$')
-    _FUNC_RE = re.compile(r"""
-        (?P<rtype>              ([^<>\(\)]    | <[^<>]*> )+  \s  )?
-        (?P<context>          ( ([^<>\(\)\s:] | <[^<>]*> )+ ::)+ )?
-        (?P<name>               ([^<>\(\)\s:]            )+      )
-        (?P<template_args>                      <[^<>]*>         )?
-        (?P<args>             \( [^\(\)]* \)                     )
-        (?P<qualifiers>       (\s\w+)+                           )?
-        $""", re.VERBOSE)
+    ######################################################################
+    #{ Interning cache
+    ######################################################################
+
+    _cache = collections.OrderedDict()
+    _cache_size = 10000
+    _cache_hits = 0
+    _cache_misses = 0
+
+    CacheInfo = collections.namedtuple('CacheInfo',
+                                       'hits misses maxsize currsize')
 
     @classmethod
-    def _mangle_typecast_type(cls, m):
-        s = m.group()
-        s = s.replace('::', '@COLON@@COLON@')
-        s = s.replace('<', '{').replace('>', '}')
-        return s
+    def parse(cls, function_string):
+        """
+        Return a FunctionName for a function string.  Results are
+        interned in an LRU cache; see L{set_cache_size()}.
+        """
+        cache = FunctionName._cache
+        try:
+            result = cache.pop(function_string)
+        except KeyError:
+            FunctionName._cache_misses += 1
+            result = cls(function_string)
+            if FunctionName._cache_size <= 0:
+                return result
+            if len(cache) >= FunctionName._cache_size:
+                cache.popitem(last=False)
+        else:
+            FunctionName._cache_hits += 1
+        cache[function_string] = result
+        return result
 
     @classmethod
-    def _mangle(cls, s):
-        """
-        Make various changes to the function name 's' that make it
-        easier to parse with a regexp.  You can reverse these changes
-        with _restore(s).
-        """
-        # Replace various 'operator xyz' function names, since they're
-        # hard to parse.
-        if 'operator' in s:
-            s = re.sub(r'\b(operator ?)\(\)', r'\1@CALL@', s)
-            s = re.sub(r'\b(operator ?)<<',   r'\1@LT@@LT@', s)
-            s = re.sub(r'\b(operator ?)<',    r'\1@LT@', s) # also covers <=
-            s = re.sub(r'\b(operator ?)>>',   r'\1@GT@@GT@', s)
-            s = re.sub(r'\b(operator ?)>',    r'\1@GT@', s) # also covers >=
-            s = re.sub(r'\b(operator ?)->',   r'\1-@GT@', s) # also covers ->*
-            s = re.sub(r'\b(operator )',      r'operator@SPACE@', s)
-            s = s.replace('@ ', '@@SPACE@') # eg space after operator<<.
-
-            # type-cast operator:
-            s = re.sub(r'\boperator@SPACE@\w[^\(]+\(',
-                       cls._mangle_typecast_type, s)
-
-        # WARNING: type casting operators that contain :: or <...> are
-        # not handled yet.  E.g.: operator std::set<int>().
-
-        # Replace "(anonymous namespace)" so we don't get confused by
-        # the parenthases.
-        s = s.replace('(anonymous namespace)', '@ANONYMOUS_NAMESPACE@')
-
-        # Replace the '<' and '>' characters in nested template
-        # argument lists with '{' and '}', respectively.  This makes
-        # it possible to parse the function name using a single
-        # regexp.  Use _restore_nested_templates() to restore the '{'
-        # and '}' back to their original '<' and '>'.
-        template_depth = [0]
-        def subfunc(m):
-            if m.group()=='<':
-                template_depth[0]+=1
-                if template_depth[0]>1: return '{'
-            elif m.group()=='>':
-                template_depth[0]-=1
-                assert template_depth[0] >= 0
-                if template_depth[0]>=1: return '}'
-            return m.group()
-        s = re.sub(r'[<>]|[^<>]+', subfunc, s)
-        assert template_depth[0] == 0
+    def set_cache_size(cls, size):
+        """
+        Set the maximum number of entries in the interning cache used
+        by L{parse()}.  If the cache is larger than C{size}, then the
+        least recently used entries are discarded.  A size of zero
+        disables the cache.
+        """
+        FunctionName._cache_size = size
+        cache = FunctionName._cache
+        while len(cache) > max(size, 0):
+            cache.popitem(last=False)
 
-        return s
+    @classmethod
+    def cache_info(cls):
+        """
+        Return a named tuple C{(hits, misses, maxsize, currsize)}
+        describing the interning cache used by L{parse()}.
+        """
+        return cls.CacheInfo(FunctionName._cache_hits,
+                             FunctionName._cache_misses,
+                             FunctionName._cache_size,
+                             len(FunctionName._cache))
 
     @classmethod
-    def _restore(cls, s):
-        """Undo the changes made by _mangle()."""
-        if s is None: return None
-        s = s.replace('{', '<').replace('}', '>')
-        s = s.replace('@ANONYMOUS_NAMESPACE@', '(anonymous namespace)')
-        s = s.replace('@CALL@', '()')
-        s = s.replace('@SPACE@', ' ')
-        s = s.replace('@LT@', '<')
-        s = s.replace('@GT@', '>')
-        s = s.replace('@COLON@', ':')
-        return s
+    def clear_cache(cls):
+        """Empty the interning cache, and reset its counters."""
+        FunctionName._cache.clear()
+        FunctionName._cache_hits = FunctionName._cache_misses = 0
+
+    ######################################################################
+    #{ Parsing
+    ######################################################################
 
-    x = set()
     @classmethod
-    def parse(cls, function_string, verbose=False):
+    def _decompose(cls, function_string):
+        """
+        Helper for pieces(): split a function string into a tuple
+        C{(rtype, context, name, template_args, args, qualifiers)}.
+        """
         # Is it a special function?
         for special in cls.SPECIAL_FUNCTIONS:
             if function_string.startswith(special):
-                return cls(None, None, function_string, None, None, None)
+                return (None, None, function_string, None, None, None)
 
         # Is it a bare function name without args (eg __libc_csu_init)?
         if cls._IDENTIFIER_RE.match(function_string):
-            return cls(None, None, function_string, None, None, None)
-
-        s = cls._mangle(function_string)
-        m = cls._FUNC_RE.match(s)
-        if not m:
-            print 'Warning: unable to parse function name:'
-            print '  %r' % function_string
-            return cls(None, None, function_string, None, None, None)
-            
-            raise ValueError('Unable to parse: %r' % function_string)
-
-        rtype = cls._restore(m.group('rtype'))
-        context = cls._restore(m.group('context'))
-        name = cls._restore(m.group('name'))
-        template_args = cls._restore(m.group('template_args'))
-        args = cls._restore(m.group('args'))
-        qualifiers = cls._restore(m.group('qualifiers'))
-        if rtype: rtype = rtype.strip()
-        if qualifiers: qualifiers = qualifiers.strip()
-        key = (rtype, context, name, template_args, args, qualifiers)
-        if verbose and key not in cls.x:
-            cls.x.add(key)
-            print function_string
-            if rtype:         print '         rtype: %s' % rtype
-            if context:       print '       context: %s' % context
-            if name:          print '          name: %s' % name
-            if template_args: print ' template_args: %s' % template_args
-            if args:          print '          args: %s' % args
-            if qualifiers:    print '    qualifiers: %s' % qualifiers
-            print
-        return cls(rtype, context, name, template_args, args, qualifiers)
+            return (None, None, function_string, None, None, None)
 
+        pieces = cls._split(function_string)
+        if pieces is None:
+            # We can't parse it; so just use the whole string as the name.
+            return (None, None, function_string, None, None, None)
+        return pieces
+
+    _IDENTIFIER_RE = re.compile(r'^\w+$')
 
+    # Operator names are always returned as a single token, so their
+    # '<', '>' and '()' characters are not mistaken for template
+    # argument lists or argument lists.  A conversion operator's name
+    # ("operator ") is followed by its type, which runs up to the
+    # argument list.  Braces (eg "{lambda()#1}") are nested like
+    # template argument lists.
+    _TOKEN_RE = re.compile(r"""
+        \boperator\b \s? (?: \(\) | [-+*/%^&|~!=<>,\[\]]+ ) [ ]?
+      | \boperator \s (?:new|delete) \b (?:\[\])?
+      | \boperator \s
+      | \(anonymous\ namespace\)
+      | :: | [<>(){}\s] | \w+ | [^\w<>(){}\s:]+ | :
+      """, re.VERBOSE)
 
+    @classmethod
+    def _split(cls, s):
+        """
+        Split a function string into a tuple C{(rtype, context, name,
+        template_args, args, qualifiers)}, using a single pass over
+        its tokens; or return None if it can not be parsed.  Only
+        tokens outside of template argument lists and argument lists
+        affect where the pieces are split.
+        """
+        pos = 0                 # Offset of the current token.
+        name_start = 0          # Offset past the last top-level space.
+        scope_end = 0           # Offset past the last top-level '::'.
+        targs_start = None      # Offset of the top-level template args.
+        args_start = None       # Offset of the argument list.
+        depth = 0               # Template argument list nesting depth.
+        parens = 0              # Argument list nesting depth.
+        conversion = False      # Are we reading a conversion operator?
+        for tok in cls._TOKEN_RE.findall(s):
+            c = tok[0]
+            if args_start is not None:
+                if tok == '(':
+                    parens += 1
+                elif tok == ')':
+                    parens -= 1
+                    if parens == 0:
+                        if not s.startswith('::', pos+1):
+                            args_end = pos + 1
+                            break
+                        # A local entity, eg "f()::{lambda()#1}::g()":
+                        # the argument list is part of the context.
+                        args_start = None
+                        conversion = False
+            elif depth:
+                if c == '<' or c == '{': depth += 1
+                elif c == '>' or c == '}': depth -= 1
+            elif c == '{':
+                depth = 1
+            elif tok == '(':
+                args_start = pos
+                parens = 1
+            elif c == '<':
+                if targs_start is None and not conversion:
+                    targs_start = pos
+                depth = 1
+            elif conversion:
+                pass
+            elif c == ' ':
+                name_start = scope_end = pos + 1
+                targs_start = None
+            elif tok == '::':
+                scope_end = pos + 2
+                targs_start = None
+            elif c == '>':
+                return None # Unbalanced template argument list.
+            elif tok == 'operator ':
+                conversion = True
+            pos += len(tok)
+        else:
+            return None # No (complete) argument list.
+
+        name_end = args_start if targs_start is None else targs_start
+        if name_end <= scope_end:
+            return None # No name.
+        return (s[:name_start].strip() or None,
+                s[name_start:scope_end] or None,
+                s[scope_end:name_end],
+                None if targs_start is None else s[targs_start:args_start],
+                s[args_start:args_end],
+                s[args_end:].strip() or None)
+
+def _parse_function_name(function_string):
+    """Used to unpickle FunctionNames (see FunctionName.__reduce__)."""
+    return FunctionName.parse(function_string)
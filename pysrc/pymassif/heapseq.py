@@ -12,26 +12,235 @@ if __name__ == '__main__':
     sys.path.append('..')
 
 import pymassif.heap
-import collections, textwrap, copy, re, random, math
-
-def HeapSeq(snapshots, include_overhead=True, include_stacks=True):
-    alloc = pymassif.heap.HeapNode.ALLOCATION
-    heap_seq = HeapSeqNode(None, alloc, None, None, False)
-    for sshot in snapshots:
-        if sshot.heap_tree is None: continue
-        heap_seq.merge(sshot.time, sshot.heap_tree)
-        overhead = sshot.mem_heap_extra
-        if include_overhead and overhead>0:
-            node = pymassif.heap.HeapNode(None, alloc, children=[
-                pymassif.heap.HeapNode(None, 'Overhead', bytes=overhead)])
-            heap_seq.merge(sshot.time, node)
-        if include_stacks and sshot.mem_stacks>0:
-            node = pymassif.heap.HeapNode(None, alloc, children=[
-                pymassif.heap.HeapNode(None, 'Stacks', bytes=sshot.mem_stacks)])
-            heap_seq.merge(sshot.time, node)
-            
-                           
-    return heap_seq
+import collections, textwrap, re, random, math, array, itertools
+import threading
+
+#: If true, then check the consistency of derived trees (such as the
+#: result of L{HeapSeqNode.inverted()}).  This is slow, so it is off
+#: by default.
+DEBUG = False
+
+def HeapSeq(snapshots, include_overhead=True, include_stacks=True,
+            site_table=None, coarsening=None):
+    builder = HeapSeqBuilder(include_overhead, include_stacks, site_table,
+                             coarsening)
+    builder.add_all(snapshots)
+    return builder.heap_seq(copy=False)
+
+class HeapSeqBuilder(object):
+    """
+    Builds a HeapSeq incrementally, from snapshots that are added one
+    at a time.  Each snapshot's heap tree is merged into the HeapSeq
+    as soon as it is added, and the builder does not keep any
+    reference to it; so when snapshots are read from a
+    L{MassifReader <pymassif.snapshot.MassifReader>}, only the merged
+    tree and the current snapshot are in memory at once:
+
+        >>> builder = HeapSeqBuilder()
+        >>> for snapshot in MassifReader('massif.out.1234'):
+        ...     builder.add(snapshot)
+        ...     print builder.heap_seq().bytes
+
+    L{heap_seq()} can be called at any time, including from another
+    thread while snapshots are being added.
+    """
+    def __init__(self, include_overhead=True, include_stacks=True,
+                 site_table=None, coarsening=None):
+        """
+        @param include_overhead: If true, then add an 'Overhead' node
+            for each snapshot's heap admin bytes.
+        @param include_stacks: If true, then add a 'Stacks' node for
+            each snapshot's stack bytes.
+        @param site_table: The SiteTable used by the HeapSeq.  If not
+            specified, a new SiteTable is used.
+        @param coarsening: A L{CoarseningPolicy
+            <pymassif.coarsen.CoarseningPolicy>} that bounds the size
+            of the HeapSeq, by folding small subtrees into 'Other
+            Allocations' nodes as snapshots are added.  If not
+            specified, then every call site is kept.
+        """
+        self.include_overhead = include_overhead
+        self.include_stacks = include_stacks
+        self.coarsening = coarsening
+        self._heap_seq = HeapSeqNode(None, pymassif.heap.HeapNode.ALLOCATION,
+                                     None, None, False,
+                                     site_table=site_table)
+        self._lock = threading.Lock()
+        self._num_snapshots = 0
+        # The number of snapshots when the policy was last applied.
+        self._num_coarsened = 0
+
+    num_snapshots = property(lambda self: self._num_snapshots, doc="""
+        The number of snapshots that have been added so far.""")
+
+    def add(self, sshot):
+        """Merge a single snapshot into the HeapSeq."""
+        with self._lock:
+            self._num_snapshots += 1
+            if sshot.heap_tree is None: return
+            alloc = pymassif.heap.HeapNode.ALLOCATION
+            heap_seq = self._heap_seq
+            policy = self.coarsening
+            if policy is None:
+                heap_seq.merge(sshot.time, sshot.heap_tree)
+            else:
+                heap_seq.merge(sshot.time, sshot.heap_tree, policy.max_depth)
+            overhead = sshot.mem_heap_extra
+            if self.include_overhead and overhead>0:
+                node = pymassif.heap.HeapNode(None, alloc, children=[
+                    pymassif.heap.HeapNode(None, 'Overhead', bytes=overhead)])
+                heap_seq.merge(sshot.time, node)
+            if self.include_stacks and sshot.mem_stacks>0:
+                node = pymassif.heap.HeapNode(None, alloc, children=[
+                    pymassif.heap.HeapNode(None, 'Stacks',
+                                           bytes=sshot.mem_stacks)])
+                heap_seq.merge(sshot.time, node)
+            if (policy is not None and self._num_snapshots -
+                self._num_coarsened >= policy.interval):
+                self._coarsen()
+
+    def add_all(self, snapshots):
+        """Merge each snapshot from an iterable into the HeapSeq."""
+        for sshot in snapshots:
+            self.add(sshot)
+
+    def heap_seq(self, copy=True):
+        """
+        Return the HeapSeq for the snapshots that have been added so
+        far.
+
+        @param copy: If true, then return a copy, which is not changed
+            by snapshots that are added later.  Otherwise, return the
+            builder's own HeapSeq, which should not be used while
+            snapshots are still being added.
+        """
+        with self._lock:
+            self._coarsen()
+            if not copy:
+                return self._heap_seq
+            return self._heap_seq.copy()
+
+    def _coarsen(self):
+        """
+        Apply the coarsening policy, if any snapshots have been added
+        since it was last applied.  The caller must hold C{_lock}.
+        """
+        if (self.coarsening is not None and
+            self._num_coarsened != self._num_snapshots):
+            self.coarsening.coarsen(self._heap_seq)
+            self._num_coarsened = self._num_snapshots
+
+class TimeAxis(object):
+    """
+    The list of snapshot times used by a HeapSeq, which assigns each
+    time a column index.  Every node in a HeapSeq shares the same
+    TimeAxis, and each leaf node stores its sizes as a row, where the
+    i-th value is the size at time C{times[i]}.  Columns are assigned
+    in the order that times are first seen (which is usually, but not
+    necessarily, sorted order).
+    """
+    def __init__(self, times=()):
+        self.times = []
+        self._columns = {}
+        for time in times:
+            self.column(time)
+
+    def column(self, time):
+        """
+        Return the column index for the given time, adding a new
+        column if necessary.
+        """
+        column = self._columns.get(time)
+        if column is None:
+            column = self._columns[time] = len(self.times)
+            self.times.append(time)
+        return column
+
+    def find(self, time):
+        """Return the column index for the given time, or None."""
+        return self._columns.get(time)
+
+    def __len__(self):
+        return len(self.times)
+
+    def __repr__(self):
+        return '<TimeAxis (%d times)>' % len(self.times)
+
+class TimeBuckets(object):
+    """
+    A division of a sorted list of times into at most C{max_times}
+    contiguous buckets, each with about the same number of times.
+    This is used to downsample the output for a HeapSeq with more
+    snapshots than can usefully be displayed (see
+    L{HeapSeqNode.time_buckets()}): a node's downsampled size in each
+    bucket is its largest size at any time in the bucket, so every
+    node keeps its largest size.
+
+    The buckets are placed using the total size at each time.  The
+    time where the total size is largest (the peak) is always in a
+    bucket of its own (unless C{max_times} is less than 3), so the
+    sizes shown for the peak are exact; and each bucket is labelled
+    with the time in it where the total size is largest.
+    """
+    def __init__(self, times, sizes, max_times):
+        """
+        @param times: A sorted list of times.
+        @param sizes: The total size at each time.
+        @param max_times: The maximum number of buckets (at least 1).
+        """
+        if max_times < 1:
+            raise ValueError('max_times must be at least 1')
+        n = len(times)
+        if n <= max_times:
+            ranges = [(i, i+1) for i in range(n)]
+        elif max_times < 3:
+            # There is no room to give the peak its own bucket.
+            ranges = [(n*i//max_times, n*(i+1)//max_times)
+                      for i in range(max_times)]
+        else:
+            # Putting the peak in its own bucket may split one bucket
+            # into three.
+            peak = max(range(n), key=sizes.__getitem__)
+            num_buckets = max_times-2
+            ranges = []
+            for i in range(num_buckets):
+                start, end = n*i//num_buckets, n*(i+1)//num_buckets
+                if start <= peak < end:
+                    ranges.extend([(start, peak), (peak, peak+1),
+                                   (peak+1, end)])
+                else:
+                    ranges.append((start, end))
+            ranges = [(start, end) for (start, end) in ranges if start < end]
+        self.buckets = [times[start:end] for (start, end) in ranges]
+        self.times = [times[max(range(start, end), key=sizes.__getitem__)]
+                      for (start, end) in ranges]
+        self._bucket_index = dict((time, i)
+                                  for (i, bucket) in enumerate(self.buckets)
+                                  for time in bucket)
+
+    def index(self, time):
+        """Return the index of the bucket that contains the given time."""
+        return self._bucket_index[time]
+
+    def strides(self, time_axis):
+        """
+        Return a list of column lists for the given time axis, where
+        the k-th list gives the column of the k-th time in each
+        bucket.  Buckets with fewer times are padded with their first
+        column, which does not change their largest size.  So a
+        node's downsampled sizes are the element-wise maximum of its
+        sizes at each list of columns.
+        """
+        width = max([len(bucket) for bucket in self.buckets] or [1])
+        return [[time_axis.find(bucket[min(k, len(bucket)-1)])
+                 for bucket in self.buckets]
+                for k in range(width)]
+
+    def __len__(self):
+        return len(self.buckets)
+
+    def __repr__(self):
+        return '<TimeBuckets (%d buckets)>' % len(self.buckets)
 
 class HeapSeqNode(object):
     """
@@ -39,62 +248,372 @@ class HeapSeqNode(object):
     subsequent snapshots) in a single tree structure.  This makes it
     easier to track how the memory usage of individual allocation
     sites changes over time.
+
+    The sizes of each leaf node are stored as a row of an array, with
+    one column per time in the L{TimeAxis} that is shared by the
+    whole tree.  A row may be shorter than the time axis, in which
+    case the missing columns are zero.
+
+    Each node's call site (C{func}, C{source_file} and C{source_line})
+    is stored as a site id in a L{SiteTable <pymassif.heap.SiteTable>}
+    that is shared by the whole tree.  Two nodes match if they have
+    the same call site.  Each non-leaf node keeps a dictionary mapping
+    the site ids of its children to the first child with that site
+    id, so that merging can find the child that matches a source node
+    without scanning all of its siblings.  (The dictionary may also
+    map the site ids of children that were folded away by a
+    L{CoarseningPolicy <pymassif.coarsen.CoarseningPolicy>} to the
+    'Other' leaf that holds their sizes.)
+
+    Each node caches its aggregates (C{series()}, C{bytes} and
+    C{max_bytes}), and knows its parent.  Any method that changes a
+    subtree must discard the cached aggregates of the nodes it
+    changes and of their ancestors (see L{_invalidate()}).
     """
+    __slots__ = ('_addr', '_site_table', '_site', '_children', '_parent',
+                 '_time_axis', '_row', '_child_index', '_cached_series',
+                 '_cached_bytes', '_cached_max_bytes', '_uid')
+
     _uid_counter = 0
-    def __init__(self, addr, func, source_file, source_line, is_leaf):
-        if isinstance(func, basestring):
-            print 'parsing: %r' % func
-            func = pymassif.heap.FunctionName.parse(func)
-        assert isinstance(func, pymassif.heap.FunctionName)
+    def __init__(self, addr, func, source_file, source_line, is_leaf,
+                 time_axis=None, site_table=None):
+        """
+        @param time_axis: The TimeAxis of the tree that this node will
+            be added to.  If not specified, a new TimeAxis is used.
+        @param site_table: The SiteTable of the tree that this node
+            will be added to.  If not specified, a new SiteTable is
+            used.
+        """
+        if site_table is None:
+            site_table = pymassif.heap.SiteTable()
         self._addr = addr
-        self._func = func
-        self._source_file = source_file
-        self._source_line = source_line
+        self._site_table = site_table
+        self._site = site_table.intern(func, source_file, source_line)
         self._children = []
+        self._parent = None
+        if time_axis is None:
+            time_axis = TimeAxis()
+        self._time_axis = time_axis
         if is_leaf:
-            self._bytes_seq = collections.defaultdict(int)
+            self._row = array.array('l')
+            self._child_index = None
         else:
-            self._bytes_seq = None
+            self._row = None
+            self._child_index = {}
+        self._clear_cache()
         self._uid = self.__class__._uid_counter
         self.__class__._uid_counter += 1
 
-    def merge(self, time, heap_node):
+    def merge(self, time, heap_node, max_depth=None):
+        """
+        Merge a heap tree (a HeapNode) for the snapshot at the given
+        time into this node.
+
+        @param max_depth: If specified, then the nodes at this depth
+            below this node are leaves: the size of each subtree of
+            C{heap_node} at that depth is merged into a single leaf,
+            and no deeper nodes are created.
+        """
+        if max_depth is not None and max_depth < 1:
+            raise ValueError('max_depth must be at least 1')
+        self._invalidate()
+        self._merge(self._time_axis.column(time), heap_node,
+                    -1 if max_depth is None else max_depth)
+
+    def _merge(self, column, heap_node, depth=-1):
+        """
+        Helper for merge().  C{depth} is the number of levels of
+        nodes that may be created below this node, or -1 for no limit.
+        """
         if heap_node.is_leaf and heap_node.bytes == 0:
             return # empty leaf node!
         # Sanity checks:
         #if self.is_leaf and time in self._bytes_seq:
         #    raise ValueError('Attempt to double-merge the same time!')
-        if self.is_leaf != heap_node.is_leaf:
+        if (self.is_leaf != heap_node.is_leaf and
+            not (self.is_leaf and depth == 0)):
             # This can happen eg if we prune one tree but not the other.
             raise ValueError('Cannot merge: incompatible heap trees')
-            
+
+        self._clear_cache()
         if self.is_leaf:
-            self._bytes_seq[time] += heap_node.bytes
+            row = self._row
+            if column >= len(row):
+                row.extend(_zeros(column+1-len(row)))
+            row[column] += heap_node.bytes
         else:
+            child_index = self._child_index
+            site_table = self._site_table
             for src_child in heap_node:
                 # If we have a child that matches the source child,
                 # then merge the source child into that child.
-                for dst_child in self:
-                    if dst_child._matches(src_child):
-                        dst_child.merge(time, src_child)
-                        break
+                site = site_table.site_id(src_child)
+                dst_child = child_index.get(site)
+                if dst_child is not None and dst_child._site == site:
+                    dst_child._merge(column, src_child, depth-1)
+                # If the site was folded into an 'Other' leaf (see
+                # pymassif.coarsen), then add the source child's size
+                # to that leaf.
+                elif dst_child is not None and dst_child._parent is self:
+                    dst_child._merge(column, src_child, 0)
                 # Otherwise, create a new child for the source child.
                 else:
-                    dst_child = HeapSeqNode(src_child.addr, src_child.func,
-                                            src_child.source_file,
-                                            src_child.source_line,
-                                            src_child.is_leaf)
-                    self._children.append(dst_child)
-                    dst_child.merge(time, src_child)
+                    func, source_file, source_line = site_table[site]
+                    dst_child = HeapSeqNode(src_child.addr, func,
+                                            source_file, source_line,
+                                            src_child.is_leaf or depth == 1,
+                                            self._time_axis, site_table)
+                    self._add_child(dst_child)
+                    child_index[site] = dst_child
+                    dst_child._merge(column, src_child, depth-1)
+
+    def merge_heap_seq(self, other, op=None):
+        """
+        Merge another HeapSeqNode (eg one that was built from a
+        different set of snapshots) into this one.  Nodes from
+        C{other} may be moved into this tree, so C{other} should not
+        be used after it has been merged.
+
+        @param op: A function used to combine the sizes of a leaf at
+            a time that appears in both trees, such as C{max}.  By
+            default, the sizes are added.
+        """
+        if other._time_axis is self._time_axis:
+            columns = None
+        else:
+            columns = [self._time_axis.column(t)
+                       for t in other._time_axis.times]
+        self._invalidate()
+        self._merge_heap_seq(other, columns, op)
+
+    def _merge_heap_seq(self, other, columns, op=None):
+        """
+        Helper for merge_heap_seq().  C{columns} maps each column of
+        C{other}'s time axis to a column of ours (or is None if the
+        time axes are the same).
+        """
+        if self.is_leaf != other.is_leaf:
+            raise ValueError('Cannot merge: incompatible heap trees')
+        self._clear_cache()
+        if self.is_leaf:
+            row = self._row
+            for column, bytes in enumerate(other._row):
+                if not bytes: continue
+                if columns is not None: column = columns[column]
+                if column >= len(row):
+                    row.extend(_zeros(column+1-len(row)))
+                if op is None:
+                    row[column] += bytes
+                else:
+                    row[column] = op(row[column], bytes)
+        else:
+            for src_child in other:
+                site = self._site_table.site_id(src_child)
+                dst_child = self._child_index.get(site)
+                if dst_child is not None and dst_child._site == site:
+                    dst_child._merge_heap_seq(src_child, columns, op)
+                else:
+                    src_child._rebase(self._time_axis, columns,
+                                      self._site_table)
+                    self._add_child(src_child)
+
+    def _rebase(self, time_axis, columns, site_table):
+        """
+        Move this subtree onto the given time axis and site table,
+        where C{columns} maps each column of our current time axis to
+        a column of the new one (or is None if the time axes are the
+        same).
+        """
+        nodes = []
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            nodes.append(node)
+            node._time_axis = time_axis
+            node._clear_cache()
+            if node.is_leaf and columns is not None:
+                row = _zeros(len(time_axis))
+                for column, bytes in enumerate(node._row):
+                    if bytes: row[columns[column]] += bytes
+                node._row = row
+            stack.extend(node._children)
+        if self._site_table is not site_table:
+            for node in nodes:
+                node._site = site_table.site_id(node)
+                node._site_table = site_table
+            # The child indices are keyed by site id.
+            for node in nodes:
+                if not node.is_leaf:
+                    node._set_children(node._children)
+
+    def _resample(self, time_axis, columns):
+        """
+        Move this tree onto a new time axis, where C{columns} gives
+        the column of our current time axis that each column of the
+        new time axis takes its sizes from (or None for a size of
+        zero).  This should only be called on a root node.
+        """
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            node._time_axis = time_axis
+            node._clear_cache()
+            if node.is_leaf:
+                row = node._row
+                n = len(row)
+                node._row = array.array('l', [
+                    row[c] if c is not None and c < n else 0
+                    for c in columns])
+            stack.extend(node._children)
 
     def _matches(self, other):
+        if getattr(other, 'site_table', None) is self._site_table:
+            return self._site == other.site_id
         return ((self.func, self.source_file, self.source_line) ==
                 (other.func, other.source_file, other.source_line))
         #return (self.addr, self.func) == (other.addr, other.func)
-    
-    def copy(self):
-        """Return a deep copy of this HeapSeqNode."""
-        return copy.deepcopy(self)
+
+    def _match_key(self):
+        """
+        Return the key used to match this node with the other nodes
+        that share its site table: its site id.
+        """
+        return self._site
+
+    def copy(self, time_axis=None):
+        """
+        Return a deep copy of the subtree rooted at this HeapSeqNode.
+        The copy shares this node's site table, and its root has no
+        parent.  The nodes are copied iteratively, so trees of any
+        depth can be copied.
+
+        @param time_axis: The TimeAxis used by the copy, which must
+            have the same columns as this node's.  If not specified,
+            then the copy uses a copy of this node's time axis, so
+            that times added to either tree later do not change the
+            other.
+        """
+        if time_axis is None:
+            time_axis = TimeAxis(self._time_axis.times)
+        root = self._copy_node(time_axis, None)
+        stack = [(self, root)]
+        while stack:
+            src, dst = stack.pop()
+            if src._child_index is None:
+                continue
+            children = [child._copy_node(time_axis, dst)
+                        for child in src._children]
+            dst._children = children
+            # Rebuild the child index (including any sites that were
+            # folded into an 'Other' leaf) from the new nodes.
+            # Entries for nodes that are not children are skipped.
+            copies = dict(zip(map(id, src._children), children))
+            dst._child_index = dict(
+                (site, copies[id(child)])
+                for (site, child) in src._child_index.iteritems()
+                if id(child) in copies)
+            stack.extend(zip(src._children, children))
+        return root
+
+    def _copy_node(self, time_axis, parent):
+        """
+        Helper for copy(): return a copy of this node (including its
+        uid and cached aggregates), with no children.
+        """
+        cls = self.__class__
+        node = cls.__new__(cls)
+        node._addr = self._addr
+        node._site_table = self._site_table
+        node._site = self._site
+        node._children = []
+        node._parent = parent
+        node._time_axis = time_axis
+        if self._row is None:
+            node._row = None
+        else:
+            node._row = array.array('l', self._row)
+        node._child_index = None
+        # Cached series are padded in place, so they are not shared.
+        if self._cached_series is None:
+            node._cached_series = None
+        else:
+            node._cached_series = list(self._cached_series)
+        node._cached_bytes = self._cached_bytes
+        node._cached_max_bytes = self._cached_max_bytes
+        node._uid = self._uid
+        return node
+
+    def __reduce__(self):
+        """
+        Pickle the subtree rooted at this node as a flat encoding
+        (like the one written by L{pymassif.cache}), rather than as
+        nested nodes, so that trees of any depth can be pickled (eg
+        to send them between processes).  The encoding lists the
+        nodes in preorder, with the site id, uid and number of
+        children (or -1, for leaves) of each; and the rows of the
+        leaves, concatenated.  The unpickled root has no parent, and
+        the cached aggregates are not pickled.
+        """
+        structure = array.array('l')
+        addrs = []
+        leaf_lengths = array.array('l')
+        leaf_bytes = array.array('l')
+        # (node number, site id, child number) for each entry in a
+        # child index that does not map a site to the first child
+        # with that site (such as those added by pymassif.coarsen).
+        redirects = []
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            structure.append(node._site)
+            structure.append(node._uid)
+            addrs.append(node._addr)
+            if node._row is not None:
+                structure.append(-1)
+                leaf_lengths.append(len(node._row))
+                leaf_bytes.extend(node._row)
+                continue
+            children = node._children
+            structure.append(len(children))
+            stack.extend(reversed(children))
+            first = {}
+            for child in children:
+                first.setdefault(child._site, child)
+            index = node._child_index
+            if len(index) != len(first) or any(
+                first.get(site) is not child
+                for (site, child) in index.iteritems()):
+                # Entries for nodes that are not children are skipped.
+                numbers = dict((id(c), i) for (i, c) in enumerate(children))
+                for (site, child) in index.iteritems():
+                    if (first.get(site) is not child and
+                        id(child) in numbers):
+                        redirects.append((len(addrs)-1, site,
+                                          numbers[id(child)]))
+        return (_unpickle_tree, (self._site_table, self._time_axis,
+                                 structure.tostring(), addrs,
+                                 leaf_lengths.tostring(),
+                                 leaf_bytes.tostring(), redirects))
+
+    @staticmethod
+    def diff(base, candidate):
+        """
+        Compare two HeapSeqs (eg from runs before and after a change),
+        and return a L{HeapSeqDiff <pymassif.diff.HeapSeqDiff>}
+        describing how the size of each call site changed.  See
+        L{pymassif.diff}.
+        """
+        import pymassif.diff
+        return pymassif.diff.diff(base, candidate)
+
+    def query_index(self):
+        """
+        Return a L{HeapSeqIndex <pymassif.query.HeapSeqIndex>} for
+        this tree, which answers top-K queries (such as the largest
+        call sites at a given time) without sorting the whole tree.
+        """
+        import pymassif.query
+        return pymassif.query.HeapSeqIndex(self)
 
     ######################################################################
     #{ Accessors
@@ -102,44 +621,208 @@ class HeapSeqNode(object):
 
     # Read-only attributes:
     addr = property(lambda self: self._addr)
-    func = property(lambda self: self._func)
-    source_file = property(lambda self: self._source_file)
-    source_line = property(lambda self: self._source_line)
+    func = property(lambda self: self._site_table[self._site][0])
+    source_file = property(lambda self: self._site_table[self._site][1])
+    source_line = property(lambda self: self._site_table[self._site][2])
     uid = property(lambda self: self._uid)
-    is_leaf = property(lambda self: self._bytes_seq is not None)
-    
+    site_id = property(lambda self: self._site)
+    site_table = property(lambda self: self._site_table)
+    is_leaf = property(lambda self: self._row is not None)
+    time_axis = property(lambda self: self._time_axis)
+
+    parent = property(lambda self: self._parent)
+
     @property
     def bytes(self):
-        return max(self.bytes_seq.values()+[0])
+        if self._cached_bytes is None:
+            self._cached_bytes = max(self._series()+[0])
+        return self._cached_bytes
 
     @property
     def max_bytes(self):
-        if self.is_leaf:
-            if self._bytes_seq:
-                return max(self._bytes_seq.values())
+        if self._cached_max_bytes is None:
+            if self.is_leaf:
+                self._cached_max_bytes = max(self._row or [0])
             else:
-                return 0
-        else:
-            return sum(c.max_bytes for c in self._children)
+                self._cached_max_bytes = sum(c.max_bytes
+                                             for c in self._children)
+        return self._cached_max_bytes
 
     @property
     def bytes_seq(self):
+        """
+        A dictionary mapping each time at which this node's size is
+        nonzero to its size.
+        """
         result = collections.defaultdict(int)
-        self._collect_bytes_seq(result)
+        for time, bytes in zip(self._time_axis.times, self._series()):
+            if bytes: result[time] = bytes
         return result
 
     @property
     def peak_time(self):
-        return max((bytes,time) for (time,bytes) in self.bytes_seq.items())[1]
+        return max((bytes,time) for (time,bytes) in
+                   zip(self._time_axis.times, self._series()) if bytes)[1]
 
-    def _collect_bytes_seq(self, result):
-        if self.is_leaf:
-            for time, bytes in self._bytes_seq.items():
-                result[time] += bytes
+    def series(self):
+        """
+        Return a list containing this node's size at each time in its
+        time axis (i.e., the sum of the rows of all leaves in this
+        subtree).
+        """
+        return list(self._series())
+
+    def _series(self):
+        """
+        Return this node's cached series (computing it, and the series
+        of any descendants whose series are not cached, if necessary).
+        The returned list must not be modified.
+        """
+        n = len(self._time_axis)
+        if self._cached_series is None:
+            # Collect the nodes that need a series, parents before
+            # children; and then compute them in reverse order.
+            nodes = []
+            stack = [self]
+            while stack:
+                node = stack.pop()
+                nodes.append(node)
+                stack.extend(c for c in node._children
+                             if c._cached_series is None)
+            for node in reversed(nodes):
+                if node._row is not None:
+                    series = node._row.tolist()
+                else:
+                    # Sum the children's series column by column.
+                    series = map(sum, itertools.izip_longest(
+                        *[c._cached_series for c in node._children],
+                        fillvalue=0))
+                node._cached_series = series
+        series = self._cached_series
+        # The time axis may have grown since the series was cached.
+        if len(series) < n:
+            series.extend([0] * (n-len(series)))
+        return series
+
+    def _clear_cache(self):
+        """Discard this node's cached aggregates."""
+        self._cached_series = None
+        self._cached_bytes = None
+        self._cached_max_bytes = None
+
+    def _invalidate(self):
+        """Discard the cached aggregates of this node and its ancestors."""
+        node = self
+        while node is not None:
+            node._clear_cache()
+            node = node._parent
+
+    def _add_child(self, child):
+        """Add a child to this node (without invalidating any caches)."""
+        child._parent = self
+        self._children.append(child)
+        self._child_index.setdefault(child._match_key(), child)
+
+    def _remove_child(self, child):
+        """
+        Remove a child from this node (without invalidating any
+        caches).
+        """
+        self._children.remove(child)
+        child._parent = None
+        # Remove every entry for the child, including any sites that
+        # were folded into it (see pymassif.coarsen).
+        index = self._child_index
+        for key in [k for (k, c) in index.iteritems() if c is child]:
+            del index[key]
+        # If another child has the same key, then index it instead.
+        key = child._match_key()
+        if key not in index:
+            for other in self._children:
+                if other._match_key() == key:
+                    index[key] = other
+                    break
+
+    def _remove_children(self, children):
+        """
+        Remove a list of children from this node (without
+        invalidating any caches).  This takes time linear in the
+        number of children this node has, however many are removed.
+        """
+        removed = set(children)
+        self._children = [c for c in self._children if c not in removed]
+        index = self._child_index
+        for child in removed:
+            child._parent = None
+        # Remove every entry for a removed child, including any sites
+        # that were folded into it (see pymassif.coarsen).
+        if not self._children:
+            index.clear()
+            return
+        for key in [k for (k, c) in index.iteritems() if c in removed]:
+            del index[key]
+        # If another child has the same key as a removed child, then
+        # index it instead.
+        for child in self._children:
+            index.setdefault(child._match_key(), child)
+
+    def _set_children(self, children):
+        """
+        Replace this node's children (without invalidating any
+        caches).
+        """
+        self._children = []
+        self._child_index = {}
+        for child in children:
+            self._add_child(child)
+
+    def _columns(self, times):
+        """
+        Return a list of the column indices for the given times, or
+        None for times that are not in our time axis.
+        """
+        return [self._time_axis.find(t) for t in times]
+
+    @staticmethod
+    def _select(series, columns):
+        """
+        Return the values of series at the given columns (as returned
+        by L{_columns()}), with zero for missing columns.
+        """
+        return [series[c] if c is not None else 0 for c in columns]
+
+    @staticmethod
+    def _select_max(series, strides):
+        """
+        Return the element-wise maximum of the values of series at
+        each list of columns in strides (see L{TimeBuckets.strides()}).
+        """
+        try:
+            selected = [map(series.__getitem__, columns)
+                        for columns in strides]
+        except TypeError: # Some columns are None.
+            selected = [HeapSeqNode._select(series, columns)
+                        for columns in strides]
+        if len(selected) == 1:
+            return selected[0]
+        return map(max, *selected)
+
+    def time_buckets(self, max_times, times=None):
+        """
+        Return a L{TimeBuckets} that divides the given times (by
+        default, the times where this node's size is nonzero) into at
+        most C{max_times} buckets, using this node's sizes as the
+        total sizes.  Pass it to L{to_javascript()} to downsample the
+        output for this node, or for any node in the same tree.
+        """
+        if times is None:
+            times = sorted(self.bytes_seq)
         else:
-            for child in self._children:
-                child._collect_bytes_seq(result)
-                
+            times = sorted(times)
+        sizes = self._select(self._series(), self._columns(times))
+        return TimeBuckets(times, sizes, max_times)
+
+
     def __getitem__(self, index):
         return self._children[index]
     def __len__(self):
@@ -151,8 +834,11 @@ class HeapSeqNode(object):
         return sorted(self._children, key=self.__class__._sort_key)
 
     def _sort_key(self):
-        return (self.func.name.startswith('Other Allocations'),
-                self.func.name==pymassif.heap.HeapNode.ALLOCATION,
+        # Special function names are never decomposed, so we can
+        # check the function string rather than its name piece.
+        func = str(self.func)
+        return (func.startswith('Other Allocations'),
+                func==pymassif.heap.HeapNode.ALLOCATION,
                 -self.bytes)
 
     ######################################################################
@@ -191,8 +877,7 @@ class HeapSeqNode(object):
         return s
 
     def _bargraph(self, indent, times, height=5):
-        bytes_seq = self.bytes_seq
-        bytes_list = [bytes_seq.get(t,0) for t in times]
+        bytes_list = self._select(self._series(), self._columns(times))
         max_bytes = max(bytes_list)
         row_bytes = max_bytes/float(height)
         rows = [indent]*height
@@ -210,8 +895,9 @@ class HeapSeqNode(object):
         return '\n'.join(reversed(rows))
     
     def _alloc_list(self, indent, times):
-        sizes = ', '.join(pymassif.util.pprint_size(self._bytes_seq.get(t,0))
-                          for t in times)
+        bytes_list = self._select(self._series(), self._columns(times))
+        sizes = ', '.join(pymassif.util.pprint_size(bytes)
+                          for bytes in bytes_list)
         return textwrap.fill(sizes,
                              initial_indent=indent+'Allocations: ',
                              subsequent_indent=indent+' '*13)
@@ -220,13 +906,24 @@ class HeapSeqNode(object):
     #{ Javascript Serialization
     ######################################################################
 
-    def to_javascript(self, times=None, indent=''):
-        if times is None: times = sorted(self.bytes_seq)
-        return self._to_javascript(times, indent, None, self._pick_colors())
-        
-    def _to_javascript(self, times, indent, parent_bytes_list, color_dict):
-        bytes_seq = self.bytes_seq
-        bytes_list = [bytes_seq.get(t,0) for t in times]
+    def to_javascript(self, times=None, indent='', buckets=None):
+        """
+        @param buckets: If specified, then output one size for each
+            bucket of this L{TimeBuckets} (the node's largest size in
+            the bucket), rather than one for each time; and ignore
+            C{times}.  This bounds the size of the output, however
+            many snapshots there are.
+        """
+        if buckets is not None:
+            strides = buckets.strides(self._time_axis)
+        else:
+            if times is None: times = sorted(self.bytes_seq)
+            strides = [self._columns(times)]
+        return self._to_javascript(strides, indent, None,
+                                   self._pick_colors())
+
+    def _to_javascript(self, strides, indent, parent_bytes_list, color_dict):
+        bytes_list = self._select_max(self._series(), strides)
         color = self._js_color(color_dict[self])
         s = 'new HeapSeqNode(%s, %r,\n%s ' % (self.uid, color, indent)
         for piece in self.func.pieces() + (self.source_file, self.source_line):
@@ -242,7 +939,8 @@ class HeapSeqNode(object):
         s += '\n%s [' % indent
         for i, child in enumerate(self.sorted()):
             if i: s += ',\n%s  ' % indent
-            s += child._to_javascript(times, indent+' ', bytes_list, color_dict)
+            s += child._to_javascript(strides, indent+' ', bytes_list,
+                                      color_dict)
         s += '])'
         return s
 
@@ -324,42 +1022,69 @@ class HeapSeqNode(object):
     ######################################################################
 
     def inverted(self, top_node_func='TOP'):
-        dst = HeapSeqNode(None, top_node_func, None, None, False)
-        self._invert(dst, [])
-        assert dst.bytes_seq == self.bytes_seq
-        return dst
+        """
+        Return an inverted (bottom-up) version of this tree: the
+        children of its root are this tree's leaves, their children
+        are the leaves' parents, and so on, down to nodes for this
+        tree's root, which are the leaves of the inverted tree.
 
-    def _invert(self, dst, ancestors):
+        The leaves of the inverted tree share their rows with the
+        leaves of this tree (rather than copying them), so this tree
+        should not be merged into while the inverted tree is in use.
         """
-        Copy an inverted version of self into dst.
+        dst = HeapSeqNode(None, top_node_func, None, None, False,
+                          self._time_axis, self._site_table)
+        self._invert(dst)
+        if DEBUG:
+            assert dst.bytes_seq == self.bytes_seq
+        return dst
 
-        @param ancestors: A list of the ancestors of this node.
+    def _invert(self, dst):
         """
-        if self.bytes == 0:
-            return # Don't bother to keep empty nodes.
-        ancestors.append(self)
-        if self.is_leaf:
-            # Find where we should go in the inverted tree.  Use existing
-            # nodes when possible, but create nodes if necessary.
-            for node in reversed(ancestors):
-                for dst_child in dst:
-                    if node._matches(dst_child):
-                        dst = dst_child
-                        break
-                else:
-                    dst._children.append(HeapSeqNode(
-                        node.addr, node.func, node.source_file,
-                        node.source_line, False))
-                    dst = dst[-1]
-            # Turn the node corresponding to the fomer root node into
-            # a leaf node.
-            assert dst._bytes_seq is None
-            assert dst._children == []
-            dst._bytes_seq = self.bytes_seq
-        else:
-            for child in self:
-                child._invert(dst, ancestors)
-        ancestors.pop()
+        Add an inverted version of self to dst.  The tree is walked
+        once, keeping the list of ancestors of the current node; and
+        the path for each leaf is found (or created) in dst using the
+        child indices, so each step takes constant time.
+        """
+        ancestors = []
+        stack = [(self, 0)]
+        while stack:
+            node, depth = stack.pop()
+            del ancestors[depth:]
+            ancestors.append(node)
+            if node._row is None:
+                stack.extend((child, depth+1)
+                             for child in reversed(node._children))
+                continue
+            if not any(node._row):
+                continue # Don't bother to keep empty nodes.
+            # Find where we should go in the inverted tree.  Use
+            # existing nodes when possible, but create nodes if
+            # necessary.
+            pos = dst
+            for src in reversed(ancestors):
+                child = pos._child_index.get(src._site)
+                if child is None:
+                    child = HeapSeqNode(src._addr, src.func,
+                                        src.source_file, src.source_line,
+                                        False, self._time_axis,
+                                        self._site_table)
+                    pos._add_child(child)
+                pos = child
+            # Turn the node corresponding to the former root node into
+            # a leaf node, which shares the source leaf's row.  If two
+            # leaves have the same path, then add their rows instead.
+            if pos._row is None:
+                assert pos._children == []
+                pos._row = node._row
+                pos._child_index = None
+            else:
+                row = array.array('l', pos._row)
+                if len(row) < len(node._row):
+                    row.extend(_zeros(len(node._row)-len(row)))
+                for column, bytes in enumerate(node._row):
+                    row[column] += bytes
+                pos._row = row
 
 #     def merged_by_func(self, merge_overloads=False, merge_templates=True):
 #         if self.is_leaf: return self
@@ -407,11 +1132,14 @@ class HeapSeqNode(object):
     # by the heap tree -- they just re-arrange it and aggregate it.
 
     def discard_empty_nodes(self):
-        for child in list(self):
-            if child.bytes==0:
-                self._children.remove(child)
-            else:
-                child.discard_empty_nodes()
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            empty = [c for c in node._children if c.bytes==0]
+            if empty:
+                # Removing an empty node does not change any sizes.
+                node._remove_children(empty)
+            stack.extend(node._children)
 
     def reset_uids(self, start=None):
         """
@@ -439,8 +1167,14 @@ class HeapSeqNode(object):
         becomes a leaf node, with size equal to the sum of the sizes
         of the removed children.
         """
-        self._bytes = self.bytes
-        self._children = ()
+        if not self.is_leaf:
+            self._row = array.array('l', self._series())
+            for child in self._children:
+                child._parent = None
+            self._children = []
+            self._child_index = None
+            # The series is unchanged, but max_bytes is not.
+            self._invalidate()
 
     def collapse_to_depth(self, depth):
         if depth<=0:
@@ -458,23 +1192,42 @@ class HeapSeqNode(object):
         children.  If the node in question has an ALLOCATIONS child,
         then it will also be put in the new 'Other Allocations' node.
         """
+        for child in self._group_small_children(cutoff_percent,
+                                                min_large_children,
+                                                min_small_children):
+            child.group_small_nodes(cutoff_percent, min_large_children,
+                                    min_small_children)
+
+    def _group_small_children(self, cutoff_percent, min_large_children,
+                              min_small_children):
+        """
+        Helper for group_small_nodes(): group this node's small
+        children, if it has enough large and small children.  Return
+        the children that should be checked next: the large children
+        if a group was added, or all of the children otherwise.
+        """
         cutoff_bytes = self.bytes * (cutoff_percent/100.0)
-        large_children = [c for c in self if c.bytes >= cutoff_bytes]
-        small_children = [c for c in self if c.bytes < cutoff_bytes]
+        large_children = []
+        small_children = []
+        for child in self._children:
+            if child.bytes >= cutoff_bytes:
+                large_children.append(child)
+            else:
+                small_children.append(child)
         if (len(large_children)>=min_large_children and
             len(small_children)>=min_small_children):
             max_pct = max(100.0*c.bytes/self.bytes for c in small_children)+.1
             func = 'Other Allocations (below %.1f%% of parent)' % max_pct
-            group = HeapSeqNode(None, func, None, None, False)
-            group._children = small_children
-            self._children = large_children + [group]
-            for child in large_children:
-                child.group_small_nodes(cutoff_percent, min_large_children,
-                                        min_small_children)
-        else:
-            for child in self:
-                child.group_small_nodes(cutoff_percent, min_large_children,
-                                        min_small_children)
+            # This does not change the size of this node (or of any
+            # of its ancestors).
+            group = HeapSeqNode(None, func, None, None, False,
+                                self._time_axis, self._site_table)
+            self._set_children(large_children)
+            for child in small_children:
+                group._add_child(child)
+            self._add_child(group)
+            return large_children
+        return self._children
 
     def collapse_if_smaller_than(self, cutoff_bytes):
         if self.bytes < cutoff_bytes:
@@ -487,23 +1240,51 @@ class HeapSeqNode(object):
         """
         Perform a depth-first search of this HeapSeq, and collapse
         any node whose function matches any of the given regexps.
+        The collapsed node is replaced by its children.
+        """
+        matches = _func_matcher(regexps)
+        # Children are processed before their parents.
+        changed = [node for node in reversed(self._preorder())
+                   if node._collapse_matching_children(matches)]
+        _invalidate_all(changed)
+
+    def _collapse_matching_children(self, matches):
+        """
+        Helper for collapse_if_func_matches(): replace each non-leaf
+        child for which C{matches(child)} is true by its children
+        (without invalidating any caches).  Return true if any child
+        was replaced.
         """
-        for child in list(self):
-            child.collapse_if_func_matches(*regexps)
-            if (any(re.match(r, child.func) for r in regexps) and
-                not child.is_leaf):
-                self._children.extend(child._children)
-                self._children.remove(child)
+        collapsed = [c for c in self._children
+                     if not c.is_leaf and matches(c)]
+        if not collapsed:
+            return False
+        # This does not change the size of this node.
+        grandchildren = []
+        for child in collapsed:
+            grandchildren.extend(child._children)
+            child._children = []
+            child._child_index = {}
+        self._remove_children(collapsed)
+        for grandchild in grandchildren:
+            self._add_child(grandchild)
+        return True
 
     def promote(self, descendent):
         """
         Move a descendent of this HeapSeq to be a direct child of
         this HeapSeq instead.
         """
-        if not self._remove(descendent):
+        # Check that we are one of the descendent's ancestors.
+        ancestor = descendent._parent
+        while ancestor is not None and ancestor is not self:
+            ancestor = ancestor._parent
+        if ancestor is None:
             raise ValueError('Node is not a descendent!')
-        assert not self.is_leaf
-        self._children.append(descendent)
+        old_parent = descendent._parent
+        old_parent._remove_child(descendent)
+        old_parent._invalidate()
+        self._add_child(descendent)
 
     def promote_if_parent_matches(self, *regexps):
         """
@@ -512,23 +1293,114 @@ class HeapSeqNode(object):
         regexps, then promote that descendent to be a direct child of
         this node.  Children are checked before their parents.
         """
-        self._promote_if_parent_matches(regexps, self)
-            
-    def _promote_if_parent_matches(self, regexps, root):
-        for child in list(self):
-            child._promote_if_parent_matches(regexps, root)
-        if any(re.match(r,self.func) for r in regexps):
-            for child in list(self):
-                root.promote(child)
-            
-    def _remove(self, node):
-        """Helper used by promote()"""
-        if node in self._children:
-            self._children.remove(node)
-            return True
-        for child in self._children:
-            if child._remove(node): return True
-        return False
+        matches = _func_matcher(regexps)
+        promoted = []
+        changed = []
+        for node in reversed(self._preorder()):
+            if node is self or not node._children or not matches(node):
+                continue
+            promoted.extend(node._children)
+            node._remove_children(node._children)
+            changed.append(node)
+        for child in promoted:
+            self._add_child(child)
+        _invalidate_all(changed)
+
+    def _preorder(self):
+        """
+        Return a list of the nodes in this subtree, in preorder, with
+        each node's children in reverse order.  So the reverse of the
+        list visits the nodes in postorder.
+        """
+        nodes = []
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            nodes.append(node)
+            stack.extend(node._children)
+        return nodes
+
+def _zeros(n):
+    """Return an array of n zeros, for use as (part of) a leaf row."""
+    return array.array('l', [0]) * n
+
+def _unpickle_tree(site_table, time_axis, structure, addrs, leaf_lengths,
+                   leaf_bytes, redirects):
+    """
+    Rebuild a tree from the encoding made by L{HeapSeqNode.__reduce__()},
+    and return its root.
+    """
+    structure = _from_string(structure)
+    leaf_lengths = _from_string(leaf_lengths)
+    leaf_bytes = _from_string(leaf_bytes)
+    nodes = []
+    stack = [] # [node, number of children still to read]
+    leaf = pos = 0
+    for i in range(0, len(structure), 3):
+        node = HeapSeqNode.__new__(HeapSeqNode)
+        node._addr = addrs[i/3]
+        node._site_table = site_table
+        node._site = structure[i]
+        node._uid = structure[i+1]
+        node._children = []
+        node._parent = None
+        node._time_axis = time_axis
+        node._clear_cache()
+        num_children = structure[i+2]
+        if num_children < 0:
+            node._row = leaf_bytes[pos:pos+leaf_lengths[leaf]]
+            node._child_index = None
+            pos += leaf_lengths[leaf]
+            leaf += 1
+        else:
+            node._row = None
+            node._child_index = {}
+        if stack:
+            parent = stack[-1]
+            parent[0]._add_child(node)
+            parent[1] -= 1
+            if parent[1] == 0: stack.pop()
+        if num_children > 0:
+            stack.append([node, num_children])
+        nodes.append(node)
+    for (i, site, child) in redirects:
+        nodes[i]._child_index[site] = nodes[i]._children[child]
+    return nodes[0]
+
+def _from_string(s):
+    a = array.array('l')
+    a.fromstring(s)
+    return a
+
+def _invalidate_all(nodes):
+    """
+    Discard the cached aggregates of the given nodes and of their
+    ancestors.  Each ancestor is only visited once, however many of
+    the given nodes it has below it.
+    """
+    cleared = set()
+    for node in nodes:
+        while node is not None and node not in cleared:
+            node._clear_cache()
+            cleared.add(node)
+            node = node._parent
+
+def _func_matcher(regexps):
+    """
+    Return a function that checks whether a node's function matches
+    any of the given regexps (with C{re.match}).  The regexps are
+    compiled once; and since many nodes share the same call site, the
+    result is cached by site id.
+    """
+    regexps = [re.compile(r) for r in regexps]
+    cache = {}
+    def matches(node):
+        result = cache.get(node._site)
+        if result is None:
+            func = str(node.func)
+            result = cache[node._site] = any(r.match(func) for r in regexps)
+        return result
+    return matches
 
 # def _strip_func(func, keep_templates=False, keep_args=False, keep_rtype=False):
 #     # If it's a special symbol, return it as-is.
@@ -12,6 +12,7 @@ if __name__ == '__main__':
 import os, sys, re, math, random, time
 from collections import defaultdict
 from pymassif.heapseq import HeapSeq
+from pymassif.pipeline import Pipeline
 from pymassif.heap import HeapNode
 from pymassif.util import copy_websrc_file, load_websrc_file, pprint_size
 
@@ -19,27 +20,67 @@ MERGE_LINENOS = True
 MERGE_OVERLOADS = False
 MERGE_TEMPLATES = False
 
-def write_html_output(heap_seq, outdir):
+#: The maximum number of times shown in a page.  The output for
+#: HeapSeqs with more snapshots than this is downsampled (see
+#: L{TimeBuckets <pymassif.heapseq.TimeBuckets>}), so that the size of
+#: the page does not depend on the number of snapshots.
+MAX_TIMES = 200
+
+#: The transforms that are applied to the tree for each page, before
+#: it is written, as a pipeline spec (see L{Pipeline.from_spec()
+#: <pymassif.pipeline.Pipeline.from_spec>}).
+PAGE_PIPELINE = 'group_small_nodes, discard_empty_nodes, reset_uids(0)'
+
+def write_html_output(heap_seq, outdir, max_times=MAX_TIMES,
+                      pipeline=PAGE_PIPELINE):
     print 'Writing to %s...' % outdir
     if not os.path.exists(outdir):
         os.makedirs(outdir)
     copy_aux_files(outdir)
+    return write_html_pages(heap_seq, outdir, max_times, pipeline)
+
+def write_html_pages(heap_seq, outdir, max_times=MAX_TIMES,
+                     pipeline=PAGE_PIPELINE):
+    """
+    Write the html pages for heap_seq to outdir, without copying the
+    auxiliary files that they use (see L{copy_aux_files()}).  The
+    pipeline is applied to an inverted tree and to a copy of the
+    subtree that is shown, so heap_seq is not modified; but heap_seq
+    should not be merged into while the pages are being written.
 
+    @param max_times: The maximum number of times shown in each page,
+        or None to show every snapshot.
+    @param pipeline: The transforms that are applied to the tree for
+        each page: a L{Pipeline <pymassif.pipeline.Pipeline>}, or a
+        pipeline spec.
+    """
     times = sorted(heap_seq.bytes_seq)
+    buckets = None
+    if max_times is not None and len(times) > max_times:
+        buckets = heap_seq.time_buckets(max_times, times)
     # Bottom-up page:
     #print '  - Bottom-up alloc page'
     #bu_heap = heap_seq.copy()
     #bu_heap.promote_if_parent_matches('std::', '__gnu_cxx::', 'boost::')
     #write_html_page_for(bu_heap, os.path.join(outdir, 'bu_alloc.html'), times)
     #print '  - Top-down top page'
-    write_html_page_for(heap_seq.inverted(),os.path.join(outdir, 'td_top.html'), times)
+    write_html_page_for(heap_seq.inverted(),os.path.join(outdir, 'td_top.html'), times,
+                        buckets, pipeline)
     node = heap_seq
-    node = node.sorted()[1]
+    # Show the second largest child (or the largest, if there is
+    # only one).
+    children = node.sorted()
+    if children:
+        node = children[min(1, len(children)-1)]
+    # Copy just the subtree that is shown, since the pipeline
+    # modifies it.
+    node = node.copy(node.time_axis)
     #for i in range(1): node = node.sorted()[0]
     #node = heap_seq.inverted()
     #node = node.sorted()[0]
     #node = node.sorted()[1]
-    write_html_page_for(node, os.path.join(outdir, 'td_test.html'), times)
+    write_html_page_for(node, os.path.join(outdir, 'td_test.html'), times,
+                        buckets, pipeline)
     return node
 
 def copy_aux_files(outdir):
@@ -58,22 +99,25 @@ var massifData = new MassifData({
   });
 """
 
-def write_html_page_for(heap_seq, filename, times=None):
+def write_html_page_for(heap_seq, filename, times=None, buckets=None,
+                        pipeline=PAGE_PIPELINE):
     #heap_seq = heap_seq.merged_by_func(True, True)
 #     if MERGE_LINENOS:
 #         heap_seq = heap_seq.merged_by_func(MERGE_OVERLOADS,
 #                                            MERGE_TEMPLATES)
     #heap_seq.collapse_to_depth(20)
     #heap_seq.collapse_if_smaller_than(heap_seq.bytes*0.005)
-    heap_seq.group_small_nodes()
-    heap_seq.discard_empty_nodes()
-    heap_seq.reset_uids(0)
+    Pipeline.from_spec(pipeline).run(heap_seq)
 
     # Generate the javascript code that defines the data arrays.
+    if buckets is None:
+        labels, peak_time = times, times.index(heap_seq.peak_time)
+    else:
+        labels, peak_time = buckets.times, buckets.index(heap_seq.peak_time)
     javascript = MASSIF_DATA_DEF % dict(
-        times = ','.join(('%d' % t) for t in times),
-        peak_time = times.index(heap_seq.peak_time),
-        heap_seq = heap_seq.to_javascript(times, '  '))
+        times = ','.join(('%d' % t) for t in labels),
+        peak_time = peak_time,
+        heap_seq = heap_seq.to_javascript(times, '  ', buckets))
 
     # Generate the html page,
     html = load_websrc_file('massif.html') % dict(
@@ -0,0 +1,348 @@
+# massif/massiffile.py
+
+"""
+Random access to the snapshots in a massif output file.  The file is
+memory-mapped, and a single fast pass records the location and header
+fields of every snapshot, without parsing any heap trees.  Heap trees
+are then parsed on demand, only for the snapshots that are actually
+requested.
+"""
+
+import pymassif.snapshot, pymassif.heap
+import os, mmap, array, bisect
+
+# Values for the 'tree_kind' index field:
+_EMPTY, _DETAILED, _PEAK = 0, 1, 2
+_TREE_KINDS = {'empty': _EMPTY, 'detailed': _DETAILED, 'peak': _PEAK}
+
+class MassifFile(object):
+    """
+    A memory-mapped massif output file, which provides random access
+    to its snapshots:
+
+        >>> mf = MassifFile('massif.out.1234')
+        >>> mf[0]                        # the first snapshot
+        >>> mf.by_number(7)              # snapshot number 7
+        >>> mf.peak()                    # the peak snapshot
+        >>> mf.time_slice(1000, 5000)    # snapshots with 1000<=time<5000
+
+    Snapshots (and their heap trees) are parsed every time they are
+    requested; only the snapshot offset index is kept in memory.  The
+    index is saved to a file next to the input file (with the suffix
+    C{.idx}), so that reopening the same file does not require
+    rescanning it.  The saved index is ignored if the input file's
+    size or modification time has changed.
+
+    The file's header is available via the C{desc}, C{cmd}, and
+    C{time_unit} attributes.
+    """
+    INDEX_VERSION = 1
+    INDEX_SUFFIX = '.idx'
+    _INDEX_FIELDS = ('num', 'time', 'mem_heap', 'mem_heap_extra',
+                     'mem_stacks', 'tree_kind', 'tree_start', 'tree_end')
+
+    def __init__(self, filename, use_index_file=True, compact=False,
+                 site_table=None, validate=False):
+        """
+        @param filename: The name of the massif output file.
+        @param use_index_file: If true, then load the snapshot offset
+            index from the index file if it is up to date; and save it
+            there after building it otherwise.
+        @param compact: If true, then parse heap trees into
+            L{CompactHeapTree <pymassif.heap.CompactHeapTree>}s.
+        @param site_table: The L{SiteTable <pymassif.heap.SiteTable>}
+            shared by the compact heap trees.  See L{MassifReader
+            <pymassif.snapshot.MassifReader>}.
+        @param validate: If true, then check each heap tree's
+            indentation and node sizes as it is parsed.  See
+            L{MassifReader <pymassif.snapshot.MassifReader>}.
+        """
+        self.filename = filename
+        self._compact = compact
+        self._validate = validate
+        if site_table is None:
+            site_table = pymassif.heap.SiteTable()
+        self.site_table = site_table
+        self.index_filename = filename + self.INDEX_SUFFIX
+        with open(filename, 'rb') as f:
+            st = os.fstat(f.fileno())
+            if st.st_size == 0:
+                raise ValueError('Empty massif file: %r' % filename)
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._size = st.st_size
+        self._mtime = st.st_mtime
+
+        first = self._mmap.find('\n#')
+        header_lines = self._mmap[:max(first, 0)].split('\n')
+        header, _ = pymassif.snapshot.read_header(header_lines)
+        self.desc = header.get('desc')
+        self.cmd = header.get('cmd')
+        self.time_unit = header.get('time_unit')
+
+        if not (use_index_file and self.load_index()):
+            self._build_index()
+            if use_index_file:
+                try: self.save_index()
+                except (IOError, OSError): pass # eg read-only directory
+
+    ######################################################################
+    #{ Index
+    ######################################################################
+
+    def _build_index(self):
+        """
+        Scan the file, and record the location and header fields of
+        each snapshot.
+        """
+        index = dict((field, array.array('l')) for field in
+                     self._INDEX_FIELDS)
+        mm = self._mmap
+        find = mm.find
+        size = self._size
+        start = self._next_snapshot(0)
+        while start is not None:
+            tree_line = find('\nheap_tree=', start)
+            if tree_line < 0:
+                raise ValueError('Error parsing snapshot at offset %d' % start)
+            eol = find('\n', tree_line+1)
+            if eol < 0: eol = size
+            fields = {}
+            for line in mm[start:eol].split('\n'):
+                key, sep, value = line.partition('=')
+                if sep: fields[key] = value.strip()
+            try:
+                values = dict(num=int(fields['snapshot']),
+                              time=int(fields['time']),
+                              mem_heap=int(fields['mem_heap_B']),
+                              mem_heap_extra=int(fields['mem_heap_extra_B']),
+                              mem_stacks=int(fields['mem_stacks_B']),
+                              tree_kind=_TREE_KINDS[fields['heap_tree']])
+            except KeyError, e:
+                raise ValueError('Error parsing snapshot at offset %d: '
+                                 'bad or missing %s' % (start, e))
+            # The heap tree runs until the next separator line.
+            tree_start = min(eol+1, size)
+            tree_end = find('\n#', eol)
+            if tree_end < 0: tree_end = size
+            else: tree_end += 1
+            start = self._next_snapshot(tree_end)
+            values.update(tree_start=tree_start, tree_end=tree_end)
+            for field in self._INDEX_FIELDS:
+                index[field].append(values[field])
+        self._index = index
+
+    def _next_snapshot(self, pos):
+        """
+        Return the offset of the first "snapshot=" line at or after
+        pos, or None if there is none.
+        """
+        if pos == 0 and self._mmap[:9] == 'snapshot=':
+            return 0
+        pos = self._mmap.find('\nsnapshot=', max(pos-1, 0))
+        if pos < 0: return None
+        return pos+1
+
+    def load_index(self):
+        """
+        Load the snapshot offset index from the index file.  Return
+        True if it was loaded; or False if the index file does not
+        exist, or is out of date.
+        """
+        try:
+            with open(self.index_filename, 'rb') as f:
+                header = f.readline().split()
+                expected = ['pymassif-index', str(self.INDEX_VERSION),
+                            str(array.array('l').itemsize),
+                            str(self._size), repr(self._mtime)]
+                if header[:-1] != expected:
+                    return False
+                count = int(header[-1])
+                index = {}
+                for field in self._INDEX_FIELDS:
+                    index[field] = array.array('l')
+                    index[field].fromfile(f, count)
+        except (IOError, OSError, ValueError, EOFError, IndexError):
+            return False
+        self._index = index
+        return True
+
+    def save_index(self):
+        """Write the snapshot offset index to the index file."""
+        with open(self.index_filename, 'wb') as f:
+            f.write('pymassif-index %d %d %d %r %d\n' % (
+                self.INDEX_VERSION, array.array('l').itemsize,
+                self._size, self._mtime, len(self)))
+            for field in self._INDEX_FIELDS:
+                self._index[field].tofile(f)
+
+    ######################################################################
+    #{ Accessors
+    ######################################################################
+
+    @property
+    def times(self):
+        """The time of each snapshot (in the file's time_unit)."""
+        return self._index['time']
+
+    @property
+    def mem_heap(self):
+        """The number of heap bytes (mem_heap_B) of each snapshot."""
+        return self._index['mem_heap']
+
+    def __len__(self):
+        return len(self._index['num'])
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._snapshot(i) for i in
+                    range(*index.indices(len(self)))]
+        if index < 0: index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('Snapshot index out of range')
+        return self._snapshot(index)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self._snapshot(i)
+
+    def by_number(self, num):
+        """
+        Return the snapshot whose number is C{num}.  (Indexing gives
+        the snapshots by their position in the file, which differs
+        from their numbers if the file does not start with snapshot
+        0.)  Raise an IndexError if there is no such snapshot.
+        """
+        nums = self._index['num']
+        i = bisect.bisect_left(nums, num)
+        if i == len(nums) or nums[i] != num:
+            raise IndexError('No snapshot number %d' % num)
+        return self._snapshot(i)
+
+    def time_slice(self, start=None, end=None):
+        """
+        Return a list of the snapshots whose time is greater than or
+        equal to C{start} and less than C{end}.
+        """
+        times = self._index['time']
+        if start is None: lo = 0
+        else: lo = bisect.bisect_left(times, start)
+        if end is None: hi = len(times)
+        else: hi = bisect.bisect_left(times, end)
+        return self[lo:hi]
+
+    def select(self, time_range=None, snapshots=None, peak_only=False,
+               detailed_only=False):
+        """
+        Return a list of the snapshots selected by the given options,
+        which have the same meanings as for L{MassifReader
+        <pymassif.snapshot.MassifReader>}.  The options are checked
+        using the snapshot offset index, so only the heap trees of
+        the selected snapshots are parsed.
+        """
+        return [self._snapshot(i) for i in self.select_indices(
+            time_range, snapshots, peak_only, detailed_only)]
+
+    def select_indices(self, time_range=None, snapshots=None,
+                       peak_only=False, detailed_only=False):
+        """
+        Return a list of the indices of the snapshots selected by the
+        given options.  See L{select()}.
+        """
+        index = self._index
+        times = index['time']
+        start, end = time_range or (None, None)
+        if start is None: lo = 0
+        else: lo = bisect.bisect_left(times, start)
+        if end is None: hi = len(times)
+        else: hi = bisect.bisect_left(times, end)
+        indices = range(lo, hi)
+        if snapshots is not None:
+            snapshots = frozenset(snapshots)
+            nums = index['num']
+            indices = [i for i in indices if nums[i] in snapshots]
+        kinds = index['tree_kind']
+        if detailed_only or peak_only:
+            indices = [i for i in indices if kinds[i] != _EMPTY]
+        if peak_only and indices:
+            peaks = [i for i in indices if kinds[i] == _PEAK]
+            mem_heap = index['mem_heap']
+            indices = peaks or [max(indices, key=mem_heap.__getitem__)]
+        return indices
+
+    def peak_index(self):
+        """
+        Return the index of the peak snapshot: the snapshot marked by
+        massif as the peak if there is one, or the snapshot with the
+        most heap bytes otherwise.
+        """
+        kinds = self._index['tree_kind']
+        for i in range(len(kinds)):
+            if kinds[i] == _PEAK: return i
+        mem_heap = self._index['mem_heap']
+        return max(range(len(mem_heap)), key=mem_heap.__getitem__)
+
+    def peak(self):
+        """Return the peak snapshot.  See L{peak_index()}."""
+        return self._snapshot(self.peak_index())
+
+    def _snapshot(self, i):
+        """Parse and return the i-th snapshot."""
+        index = self._index
+        if index['tree_kind'][i] == _EMPTY:
+            heap_tree = None
+        else:
+            lines = self._tree_lines(index['tree_start'][i],
+                                     index['tree_end'][i])
+            if self._compact:
+                heap_tree = pymassif.heap.CompactHeapTree.parse_lines(
+                    lines, self._validate, self.site_table).root
+            else:
+                heap_tree = pymassif.heap.HeapNode.parse_lines(
+                    lines, self._validate)
+        return pymassif.snapshot.Snapshot(
+            num=index['num'][i], time=index['time'][i],
+            mem_heap=index['mem_heap'][i],
+            mem_heap_extra=index['mem_heap_extra'][i],
+            mem_stacks=index['mem_stacks'][i],
+            heap_tree=heap_tree)
+
+    def _tree_lines(self, start, end):
+        """
+        Generate the lines of the heap tree between the given offsets,
+        reading each one straight from the mapping, so that the tree's
+        text is never copied as a whole.  Trailing blank lines are
+        skipped.  (Lines are found with C{find()} rather than
+        C{readline()}, so the mapping's file position is not used, and
+        snapshots can still be read from several threads at once.)
+        """
+        mm = self._mmap
+        find = mm.find
+        blank_lines = 0
+        while start < end:
+            eol = find('\n', start, end)
+            if eol < 0: eol = end
+            line = mm[start:eol]
+            start = eol+1
+            if line.strip():
+                for i in range(blank_lines): yield ''
+                blank_lines = 0
+                yield line
+            else:
+                blank_lines += 1
+
+    ######################################################################
+    #{ Cleanup
+    ######################################################################
+
+    def close(self):
+        """Unmap the massif file."""
+        self._mmap.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __repr__(self):
+        return '<MassifFile %r (%d snapshots)>' % (self.filename, len(self))
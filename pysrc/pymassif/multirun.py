@@ -0,0 +1,250 @@
+# massif/multirun.py
+
+"""
+Merge the massif output files from many separate runs (eg the shards
+of a test suite) into a single aggregated picture of where memory is
+allocated.
+
+Snapshot times from different runs are not comparable, so each run's
+HeapSeq is first moved onto a common time axis of normalized progress:
+with the default resolution of 100, time C{p} is the point C{p}% of
+the way from the run's first snapshot to its last, and each node's
+size at that point is its size in the last snapshot taken at or
+before it.  The normalized runs are then combined into a
+L{RunAggregate}, which keeps the sum and the maximum (and so the
+mean) of each call site's size, across runs, at each point.
+
+The runs are read and combined by a pool of worker processes: each
+worker reads its share of the files one at a time, folding each into
+a partial aggregate, so that only one run per worker is in memory at
+once; and the partial aggregates are then combined pairwise, in a
+tree reduction.
+
+Usage::
+
+    python -m pymassif.multirun [options] OUTDIR FILE...
+"""
+
+if __name__ == '__main__':
+    import sys
+    sys.path.append('..')
+
+import pymassif.heapseq, pymassif.snapshot
+import bisect, multiprocessing
+
+class RunAggregate(object):
+    """
+    The combined HeapSeqs of a set of runs, whose time axes have been
+    normalized by L{normalize_progress()}.  Two HeapSeqs are kept:
+
+      - C{sum}: the sum of each node's size across runs.
+      - C{max}: the maximum of each call site's size across runs.
+        This is the maximum for each leaf; the size of a non-leaf
+        node is the sum of the maxima of its leaves.
+
+    L{mean()} returns the mean of each node's size across runs.
+    """
+    def __init__(self, heap_seq=None):
+        """
+        @param heap_seq: A normalized HeapSeq for a single run, which
+            becomes part of the aggregate.  If not specified, then
+            the aggregate is initially empty.
+        """
+        self.sum = None
+        self.max = None
+        self.num_runs = 0
+        if heap_seq is not None:
+            self.add(heap_seq)
+
+    def add(self, heap_seq):
+        """
+        Add a normalized HeapSeq for a single run.  Its nodes may be
+        moved into the aggregate, so it should not be used afterwards.
+        """
+        if self.num_runs == 0:
+            self.sum = heap_seq
+            self.max = heap_seq.copy()
+        else:
+            self.max.merge_heap_seq(heap_seq.copy(), max)
+            self.sum.merge_heap_seq(heap_seq)
+        self.num_runs += 1
+
+    def merge(self, other):
+        """
+        Combine another RunAggregate into this one.  Its nodes may be
+        moved into this aggregate, so it should not be used
+        afterwards.
+        """
+        if other.num_runs == 0:
+            return
+        if self.num_runs == 0:
+            self.sum, self.max = other.sum, other.max
+        else:
+            self.sum.merge_heap_seq(other.sum)
+            self.max.merge_heap_seq(other.max, max)
+        self.num_runs += other.num_runs
+
+    def mean(self):
+        """
+        Return a new HeapSeq giving the mean of each node's size
+        across runs (rounded to the nearest byte).
+        """
+        if self.num_runs == 0:
+            return None
+        n = self.num_runs
+        mean = self.sum.copy()
+        stack = [mean]
+        while stack:
+            node = stack.pop()
+            node._clear_cache()
+            if node.is_leaf:
+                row = node._row
+                for column, bytes in enumerate(row):
+                    if bytes: row[column] = (bytes + n//2) // n
+            stack.extend(node)
+        return mean
+
+    def get(self, aggregate):
+        """
+        Return the HeapSeq for the named aggregate: C{'sum'},
+        C{'max'}, or C{'mean'}.
+        """
+        if aggregate == 'mean':
+            return self.mean()
+        elif aggregate in ('sum', 'max'):
+            return getattr(self, aggregate)
+        raise ValueError('Unknown aggregate %r' % aggregate)
+
+    def __repr__(self):
+        return '<RunAggregate of %d runs>' % self.num_runs
+
+def normalize_progress(heap_seq, resolution=100):
+    """
+    Move the given HeapSeq (in place) onto a time axis of normalized
+    progress, with the times C{0...resolution}; and return it.  Time
+    C{p} is the point C{p/resolution} of the way from the first
+    snapshot to the last, and each node's size at time C{p} is its
+    size in the last snapshot taken at or before that point.
+    """
+    columns = progress_columns(heap_seq.time_axis.times, resolution)
+    time_axis = pymassif.heapseq.TimeAxis(range(resolution+1))
+    heap_seq._resample(time_axis, columns)
+    return heap_seq
+
+def progress_columns(times, resolution=100):
+    """
+    Return a list that gives, for each time C{p} in C{0...resolution}
+    (see L{normalize_progress()}), the index in C{times} of the last
+    snapshot taken at or before that point; or None for each time, if
+    C{times} is empty.
+    """
+    order = sorted(range(len(times)), key=times.__getitem__)
+    sorted_times = [times[c] for c in order]
+    if not sorted_times:
+        return [None] * (resolution+1)
+    start = sorted_times[0]
+    span = sorted_times[-1] - start
+    return [order[bisect.bisect_right(
+                sorted_times, start + span*float(p)/resolution) - 1]
+            for p in range(resolution+1)]
+
+def load_run(filename, resolution=100, include_overhead=True,
+             include_stacks=True):
+    """
+    Read a massif output file, and return its HeapSeq, normalized by
+    L{normalize_progress()}.
+    """
+    builder = pymassif.heapseq.HeapSeqBuilder(include_overhead,
+                                              include_stacks)
+    with pymassif.snapshot.MassifReader(filename) as reader:
+        builder.add_all(reader)
+    return normalize_progress(builder.heap_seq(copy=False), resolution)
+
+def merge_runs(filenames, workers=None, resolution=100,
+               include_overhead=True, include_stacks=True):
+    """
+    Read the massif output files for a set of runs, and return a
+    L{RunAggregate} combining them.
+
+    @param workers: The number of worker processes to use.  Defaults
+        to the number of CPUs.
+    @param resolution: The number of steps in the normalized time
+        axis; see L{normalize_progress()}.
+    """
+    filenames = list(filenames)
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    workers = max(1, min(workers, len(filenames)))
+    # Deal the files out to the workers in turn.
+    groups = [[] for i in range(workers)]
+    for i, filename in enumerate(filenames):
+        groups[i % workers].append(filename)
+    tasks = [(group, resolution, include_overhead, include_stacks)
+             for group in groups]
+    if workers == 1:
+        return _reduce_files(tasks[0])
+    pool = multiprocessing.Pool(workers)
+    try:
+        partials = pool.map(_reduce_files, tasks, chunksize=1)
+        # Combine the partial aggregates pairwise.
+        while len(partials) > 1:
+            pairs = [partials[i:i+2] for i in range(0, len(partials), 2)]
+            partials = pool.map(_combine, pairs, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    return partials[0]
+
+def _reduce_files((filenames, resolution, include_overhead,
+                   include_stacks)):
+    """
+    Helper for merge_runs(), run in a worker process: read each file
+    in turn, and fold it into a RunAggregate.
+    """
+    aggregate = RunAggregate()
+    for filename in filenames:
+        aggregate.add(load_run(filename, resolution, include_overhead,
+                               include_stacks))
+    return aggregate
+
+def _combine(aggregates):
+    """Helper for merge_runs(), run in a worker process."""
+    result = aggregates[0]
+    for aggregate in aggregates[1:]:
+        result.merge(aggregate)
+    return result
+
+######################################################################
+#{ Command line
+######################################################################
+
+def main(args=None):
+    import optparse, pymassif.html
+    parser = optparse.OptionParser(
+        usage='%prog [options] OUTDIR FILE...',
+        description='Merge the massif output files from many runs, and '
+        'write html output for the aggregate to OUTDIR.')
+    parser.add_option('-a', '--aggregate', default='mean',
+                      choices=['sum', 'max', 'mean'],
+                      help='sum, max or mean across runs '
+                      '[default: %default]')
+    parser.add_option('-r', '--resolution', type='int', default=100,
+                      help='number of progress steps [default: %default]')
+    parser.add_option('-j', '--workers', type='int', default=None,
+                      help='number of worker processes '
+                      '[default: number of CPUs]')
+    parser.add_option('--no-overhead', dest='include_overhead',
+                      action='store_false', default=True)
+    parser.add_option('--no-stacks', dest='include_stacks',
+                      action='store_false', default=True)
+    options, args = parser.parse_args(args)
+    if len(args) < 2:
+        parser.error('expected OUTDIR and at least one FILE')
+    aggregate = merge_runs(args[1:], options.workers, options.resolution,
+                           options.include_overhead, options.include_stacks)
+    print 'Merged %d runs' % aggregate.num_runs
+    pymassif.html.write_html_output(aggregate.get(options.aggregate),
+                                    args[0])
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+# massif/parallel.py
+
+"""
+Parse a massif output file using a pool of worker processes.  The
+file is split at snapshot boundaries (using the snapshot offset index
+of L{pymassif.massiffile.MassifFile}) into one contiguous chunk per
+worker, with roughly the same number of heap tree bytes in each.
+"""
+
+import pymassif.massiffile, pymassif.heapseq
+import multiprocessing
+
+def parse_parallel(filename, workers=None):
+    """
+    Parse all snapshots in a massif output file, using C{workers}
+    processes, and return them as a list of Snapshot objects, in their
+    original order.
+
+    @param workers: The number of worker processes to use.  Defaults
+        to the number of CPUs.
+    """
+    return sum(_map(_parse_chunk, filename, workers), [])
+
+def heap_seq_parallel(filename, workers=None, include_overhead=True,
+                      include_stacks=True):
+    """
+    Build a HeapSeq for a massif output file, using C{workers}
+    processes.  Each worker builds a partial HeapSeq for its chunk of
+    snapshots, so only the (compact) partial HeapSeqs are sent back to
+    this process, where they are merged into the result.
+
+    @param workers: The number of worker processes to use.  Defaults
+        to the number of CPUs.
+    """
+    partials = _map(_heap_seq_chunk, filename, workers,
+                    include_overhead, include_stacks)
+    heap_seq = pymassif.heapseq.HeapSeq([])
+    for partial in partials:
+        heap_seq.merge_heap_seq(partial)
+    heap_seq.reset_uids()
+    return heap_seq
+
+def split_chunks(massif_file, num_chunks):
+    """
+    Return a list of up to C{num_chunks} C{(start, stop)} pairs, which
+    divide the snapshots of the given MassifFile into contiguous
+    ranges, each with roughly the same number of heap tree bytes.
+    """
+    index = massif_file._index
+    sizes = [end-start+1 for (start, end) in
+             zip(index['tree_start'], index['tree_end'])]
+    total = float(sum(sizes))
+    chunks = []
+    start = done = 0
+    for i, size in enumerate(sizes):
+        done += size
+        if done >= total*(len(chunks)+1)/num_chunks:
+            chunks.append((start, i+1))
+            start = i+1
+    if start < len(sizes):
+        chunks.append((start, len(sizes)))
+    return chunks
+
+def _map(func, filename, workers, *args):
+    """
+    Call C{func(filename, start, stop, *args)} for each chunk of
+    snapshots, and return the list of results (in order).
+    """
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    # Build (or load) the offset index once, and save it, so the
+    # workers can just load it.
+    with pymassif.massiffile.MassifFile(filename) as massif_file:
+        chunks = split_chunks(massif_file, workers)
+    tasks = [(func, filename, start, stop) + args for (start, stop) in chunks]
+    if workers == 1 or len(tasks) <= 1:
+        return [_run(task) for task in tasks]
+    pool = multiprocessing.Pool(workers)
+    try:
+        return pool.map(_run, tasks, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+def _run(task):
+    """Helper for _map(), run in a worker process."""
+    return task[0](*task[1:])
+
+def _parse_chunk(filename, start, stop):
+    with pymassif.massiffile.MassifFile(filename) as massif_file:
+        return massif_file[start:stop]
+
+def _heap_seq_chunk(filename, start, stop, include_overhead,
+                    include_stacks):
+    with pymassif.massiffile.MassifFile(filename) as massif_file:
+        snapshots = (massif_file[i] for i in range(start, stop))
+        return pymassif.heapseq.HeapSeq(snapshots, include_overhead,
+                                        include_stacks)
@@ -0,0 +1,407 @@
+# massif/pipeline.py
+
+"""
+A declarative pipeline of transforms for HeapSeqs.  Each of the
+HeapSeqNode modifiers (such as L{group_small_nodes()
+<pymassif.heapseq.HeapSeqNode.group_small_nodes>} and
+L{discard_empty_nodes()
+<pymassif.heapseq.HeapSeqNode.discard_empty_nodes>}) walks the whole
+tree; so applying several of them walks the tree several times.  A
+L{Pipeline} instead applies a list of L{Stage}s, and fuses consecutive
+stages into a single traversal wherever their dependencies allow:
+
+    >>> pipeline = Pipeline.from_spec(
+    ...     'collapse_if_func_matches("std::"), group_small_nodes(1), '
+    ...     'discard_empty_nodes, reset_uids(0)')
+    >>> pipeline.run(heap_seq)
+    >>> print pipeline.report()
+
+Each stage does its work for a node in one of two hooks:
+
+  - C{enter(node, depth)} is called before the node's children are
+    visited.  It may read the sizes of the node and of its children,
+    and rewrite the node's list of children; and it returns the
+    children that the stage should be applied to next (or None for
+    all of them).
+  - C{exit(node, depth)} is called after the node's children have
+    been visited by every stage in the traversal.  It may read the
+    node's subtree, and rewrite the node's list of children.
+
+Each traversal visits a node, calls the C{enter} hooks of its stages
+in order, visits the node's children, and then calls the C{exit}
+hooks.  None of the hooks change the sizes that C{enter} hooks read,
+so stages can usually share a traversal; the exceptions are:
+
+  - A stage with an C{exit} hook ends its traversal: when it visits
+    a node, it has not yet visited the node's ancestors, which it may
+    still move or remove (eg by collapsing them).
+  - A stage that adds nodes to the tree (L{GroupSmallNodes}) starts a
+    new traversal, since the earlier stages would not have seen the
+    new nodes.
+  - L{ResetUids} ends its traversal, since the later stages may
+    remove nodes that it has numbered.
+
+So the usual page transforms (L{GroupSmallNodes},
+L{DiscardEmptyNodes} and L{ResetUids}) share a single traversal.
+"""
+
+import pymassif.heapseq
+import ast, time
+
+######################################################################
+#{ Pipeline
+######################################################################
+
+class Pipeline(object):
+    """
+    A list of L{Stage}s that are applied to a HeapSeq in order, using
+    as few traversals of the tree as their dependencies allow.
+    Pipelines can be composed with C{+}.
+    """
+    def __init__(self, stages=()):
+        self.stages = list(stages)
+        #: A list of C{(stage, seconds)} pairs giving the time taken
+        #: by each stage in the last call to L{run()}.
+        self.timings = []
+
+    @classmethod
+    def from_spec(cls, spec):
+        """
+        Return a new Pipeline for the given spec.  The spec may be a
+        string that lists the stages as calls of the corresponding
+        HeapSeqNode methods, separated by commas:
+
+            >>> Pipeline.from_spec('collapse_to_depth(20), '
+            ...                    'group_small_nodes, reset_uids(0)')
+
+        or a sequence whose elements are L{Stage}s, stage names, or
+        tuples C{(name, arg...)}.  The arguments in a string spec must
+        be python literals.  See L{STAGES} for the stage names.
+        """
+        if isinstance(spec, Pipeline):
+            return cls(spec.stages)
+        if isinstance(spec, basestring):
+            spec = _parse_spec(spec)
+        stages = []
+        for item in spec:
+            if isinstance(item, Stage):
+                stages.append(item)
+                continue
+            if isinstance(item, basestring):
+                name, args = item, ()
+            else:
+                name, args = item[0], tuple(item[1:])
+            if name not in STAGES:
+                raise ValueError('Unknown pipeline stage %r' % name)
+            stages.append(STAGES[name](*args))
+        return cls(stages)
+
+    def __add__(self, other):
+        if isinstance(other, Stage):
+            return Pipeline(self.stages + [other])
+        return Pipeline(self.stages + list(Pipeline.from_spec(other).stages))
+
+    def __len__(self):
+        return len(self.stages)
+
+    def __repr__(self):
+        return '<Pipeline: %s>' % ', '.join(repr(s) for s in self.stages)
+
+    def passes(self):
+        """
+        Return a list of the traversals that L{run()} will use, where
+        each traversal is a list of the stages that it applies.
+        """
+        passes = []
+        current = []
+        for stage in self.stages:
+            if stage.starts_pass and current:
+                passes.append(current)
+                current = []
+            current.append(stage)
+            if stage.ends_pass or stage.exit is not None:
+                passes.append(current)
+                current = []
+        if current:
+            passes.append(current)
+        return passes
+
+    def run(self, heap_seq):
+        """
+        Apply each stage to heap_seq (in place), and return it.  The
+        time taken by each stage is recorded in L{timings}.
+        """
+        seconds = dict((id(stage), 0.0) for stage in self.stages)
+        for stages in self.passes():
+            _traverse(heap_seq, stages, seconds)
+        self.timings = [(stage, seconds[id(stage)])
+                        for stage in self.stages]
+        return heap_seq
+
+    def report(self):
+        """
+        Return a description of the traversals used by this pipeline,
+        and of the time taken by each stage in the last call to
+        L{run()}.
+        """
+        seconds = dict((id(stage), t) for (stage, t) in self.timings)
+        lines = []
+        for i, stages in enumerate(self.passes()):
+            total = sum(seconds.get(id(s), 0) for s in stages)
+            lines.append('Pass %d (%.3fs)' % (i+1, total))
+            for stage in stages:
+                lines.append('  %-50s %.3fs' % (stage,
+                                                seconds.get(id(stage), 0)))
+        return '\n'.join(lines)
+
+def _traverse(root, stages, seconds):
+    """
+    Apply the given stages to the tree rooted at root, in a single
+    traversal.  The time spent in each stage is added to
+    C{seconds[id(stage)]}.
+    """
+    timer = time.time
+    times = [0.0] * len(stages)
+    for i, stage in enumerate(stages):
+        t = timer()
+        stage.begin(root)
+        times[i] += timer() - t
+    enters = [stage.enter for stage in stages]
+    exits = [stage.exit for stage in stages]
+    has_exit = any(exit is not None for exit in exits)
+    # Each entry is (node, depth, indices of active stages, exiting).
+    # Each hook is timed from the end of the previous hook (or the
+    # start of its node), so only one timer call is needed per hook.
+    stack = [(root, 0, tuple(range(len(stages))), False)]
+    while stack:
+        node, depth, active, exiting = stack.pop()
+        t = timer()
+        if exiting:
+            for i in active:
+                if exits[i] is not None:
+                    exits[i](node, depth)
+                    now = timer()
+                    times[i] += now - t
+                    t = now
+            continue
+        # Call the enter hooks, and find the stages that only apply
+        # to some of the children.
+        selected = None
+        for i in active:
+            if enters[i] is not None:
+                children = enters[i](node, depth)
+                now = timer()
+                times[i] += now - t
+                t = now
+                if children is not None:
+                    if selected is None: selected = []
+                    selected.append((i, set(children)))
+        if has_exit:
+            stack.append((node, depth, active, True))
+        if selected is None:
+            stack.extend([(child, depth+1, active, False)
+                          for child in reversed(node._children)])
+            continue
+        for child in reversed(node._children):
+            excluded = [i for (i, children) in selected
+                        if child not in children]
+            if excluded:
+                child_active = tuple(i for i in active if i not in excluded)
+            else:
+                child_active = active
+            if child_active:
+                stack.append((child, depth+1, child_active, False))
+    for i, stage in enumerate(stages):
+        t = timer()
+        stage.finish(root)
+        times[i] += timer() - t
+        seconds[id(stage)] += times[i]
+
+def _parse_spec(spec):
+    """
+    Parse a string spec (see L{Pipeline.from_spec()}) into a list of
+    tuples C{(name, arg...)}.
+    """
+    try:
+        tree = ast.parse(spec.strip(), mode='eval').body
+    except SyntaxError, e:
+        raise ValueError('Bad pipeline spec %r: %s' % (spec, e))
+    if isinstance(tree, ast.Tuple):
+        items = tree.elts
+    else:
+        items = [tree]
+    result = []
+    for item in items:
+        if isinstance(item, ast.Name):
+            result.append((item.id,))
+        elif (isinstance(item, ast.Call) and
+              isinstance(item.func, ast.Name) and not item.keywords and
+              item.starargs is None and item.kwargs is None):
+            try:
+                args = [ast.literal_eval(arg) for arg in item.args]
+            except ValueError:
+                raise ValueError('Bad pipeline spec %r: arguments must be '
+                                 'literals' % spec)
+            result.append(tuple([item.func.id] + args))
+        else:
+            raise ValueError('Bad pipeline spec %r' % spec)
+    return result
+
+######################################################################
+#{ Stages
+######################################################################
+
+class Stage(object):
+    """
+    A single transform in a L{Pipeline}.  Subclasses define
+    C{enter()} and/or C{exit()} (see L{pymassif.pipeline}); and may
+    define C{begin()} and C{finish()}, which are called with the root
+    before and after each traversal.
+    """
+    #: Called before a node's children are visited: C{enter(node,
+    #: depth)}.  Returns the children to apply the stage to next, or
+    #: None for all of them.
+    enter = None
+    #: Called after a node's children are visited: C{exit(node,
+    #: depth)}.
+    exit = None
+    #: If true, then this stage starts a new traversal.
+    starts_pass = False
+    #: If true, then this stage ends its traversal.  (Stages with an
+    #: C{exit} hook always do.)
+    ends_pass = False
+    #: The arguments shown by __repr__().
+    args = ()
+
+    def begin(self, root):
+        pass
+
+    def finish(self, root):
+        pass
+
+    def __repr__(self):
+        name = [n for (n, cls) in STAGES.items() if cls is type(self)]
+        return '%s(%s)' % (name[0] if name else self.__class__.__name__,
+                           ', '.join(repr(a) for a in self.args))
+
+class GroupSmallNodes(Stage):
+    """See L{HeapSeqNode.group_small_nodes()
+    <pymassif.heapseq.HeapSeqNode.group_small_nodes>}."""
+    starts_pass = True
+
+    def __init__(self, cutoff_percent=1, min_large_children=1,
+                 min_small_children=4):
+        self.args = (cutoff_percent, min_large_children, min_small_children)
+
+    def enter(self, node, depth):
+        children = node._group_small_children(*self.args)
+        if children is not node._children:
+            return children
+
+class DiscardEmptyNodes(Stage):
+    """See L{HeapSeqNode.discard_empty_nodes()
+    <pymassif.heapseq.HeapSeqNode.discard_empty_nodes>}."""
+    def enter(self, node, depth):
+        empty = [c for c in node._children if c.bytes==0]
+        if empty:
+            # Removing an empty node does not change any sizes.
+            node._remove_children(empty)
+
+class ResetUids(Stage):
+    """See L{HeapSeqNode.reset_uids()
+    <pymassif.heapseq.HeapSeqNode.reset_uids>}."""
+    ends_pass = True
+
+    def __init__(self, start=None):
+        self.args = (start,)
+
+    def begin(self, root):
+        self._counter = self.args[0]
+        if self._counter is None:
+            self._counter = pymassif.heapseq.HeapSeqNode._uid_counter
+
+    def enter(self, node, depth):
+        node._uid = self._counter
+        self._counter += 1
+
+    def finish(self, root):
+        cls = pymassif.heapseq.HeapSeqNode
+        cls._uid_counter = max(cls._uid_counter, self._counter)
+
+class CollapseToDepth(Stage):
+    """See L{HeapSeqNode.collapse_to_depth()
+    <pymassif.heapseq.HeapSeqNode.collapse_to_depth>}.  The depth is
+    relative to the root that the pipeline is applied to."""
+    def __init__(self, depth):
+        self.args = (depth,)
+
+    def enter(self, node, depth):
+        if depth >= self.args[0]:
+            node.collapse()
+            return ()
+
+class CollapseIfSmallerThan(Stage):
+    """See L{HeapSeqNode.collapse_if_smaller_than()
+    <pymassif.heapseq.HeapSeqNode.collapse_if_smaller_than>}."""
+    def __init__(self, cutoff_bytes):
+        self.args = (cutoff_bytes,)
+
+    def enter(self, node, depth):
+        if node.bytes < self.args[0]:
+            node.collapse()
+            return ()
+
+class CollapseIfFuncMatches(Stage):
+    """See L{HeapSeqNode.collapse_if_func_matches()
+    <pymassif.heapseq.HeapSeqNode.collapse_if_func_matches>}."""
+    def __init__(self, *regexps):
+        self.args = regexps
+
+    def begin(self, root):
+        self._matches = pymassif.heapseq._func_matcher(self.args)
+        self._changed = []
+
+    def exit(self, node, depth):
+        if node._collapse_matching_children(self._matches):
+            self._changed.append(node)
+
+    def finish(self, root):
+        pymassif.heapseq._invalidate_all(self._changed)
+        self._changed = self._matches = None
+
+class PromoteIfParentMatches(Stage):
+    """See L{HeapSeqNode.promote_if_parent_matches()
+    <pymassif.heapseq.HeapSeqNode.promote_if_parent_matches>}.  The
+    descendents are promoted to the root that the pipeline is applied
+    to, once the traversal is done."""
+    def __init__(self, *regexps):
+        self.args = regexps
+
+    def begin(self, root):
+        self._matches = pymassif.heapseq._func_matcher(self.args)
+        self._promoted = []
+        self._changed = []
+
+    def exit(self, node, depth):
+        if depth > 0 and node._children and self._matches(node):
+            self._promoted.extend(node._children)
+            node._remove_children(node._children)
+            self._changed.append(node)
+
+    def finish(self, root):
+        for child in self._promoted:
+            root._add_child(child)
+        pymassif.heapseq._invalidate_all(self._changed)
+        self._promoted = self._changed = self._matches = None
+
+#: The stages that can be used in a pipeline spec, by name.  Each
+#: name is the name of the corresponding HeapSeqNode method.
+STAGES = {
+    'group_small_nodes': GroupSmallNodes,
+    'discard_empty_nodes': DiscardEmptyNodes,
+    'reset_uids': ResetUids,
+    'collapse_to_depth': CollapseToDepth,
+    'collapse_if_smaller_than': CollapseIfSmallerThan,
+    'collapse_if_func_matches': CollapseIfFuncMatches,
+    'promote_if_parent_matches': PromoteIfParentMatches,
+    }
@@ -0,0 +1,267 @@
+# massif/query.py
+
+"""
+An index over a HeapSeq that answers "top-K" questions, such as
+which call sites held the most memory at a given time (or at the
+peak), which grew the most between two times, and which had the
+largest time-weighted average size.  Each query ranks either nodes
+(that is, call paths) or call sites; a call site that is reached by
+several call paths is ranked by the sum of their sizes.
+
+The index is built once, from the series of every node in the tree,
+which it stores by column: one array per time, holding the size of
+each node (in preorder) at that time.  A query then only needs one or
+two columns: it finds the K-th largest value with a partial selection
+(L{heapq.nlargest}), and then picks out the nodes whose values are at
+least that large; so no full sort is done, and no node's series is
+recomputed.
+
+Each query can be answered at two granularities:
+
+  - I{inclusive}: every node except the root, with the size of its
+    whole subtree.
+  - I{self}: only the leaves, which are the nodes that record sizes
+    directly.
+
+When call sites are ranked, the inclusive size of a site does not
+count any node that has an ancestor with the same site, so that the
+sizes of recursive calls are not counted twice.  Sites are aggregated
+when a query is made, from the same columns, so only the grouping of
+nodes by site is stored.
+"""
+
+import pymassif.heapseq
+import array, bisect, heapq, itertools, operator
+
+class HeapSeqIndex(object):
+    """
+    A top-K query index over a HeapSeq:
+
+        >>> index = heap_seq.query_index()
+        >>> for node, bytes in index.at_peak(20):
+        ...     print pprint_size(bytes), node.func
+        >>> for site_id, bytes in index.at_peak(20, by_site=True):
+        ...     print pprint_size(bytes), heap_seq.site_table[site_id][0]
+
+    The index describes the tree as it was when the index was built;
+    if the tree is modified, then a new index should be built.
+    """
+    # The number of nodes whose series are transposed at once, when
+    # the index is built.
+    _BLOCK = 1024
+
+    def __init__(self, heap_seq):
+        nodes = []
+        # Whether each node is the outermost node with its site on the
+        # path from the root.  The stack holds the site id of each
+        # node whose children are being visited, to mark where it
+        # leaves the path.
+        outermost = []
+        path_sites = {}
+        stack = [heap_seq]
+        while stack:
+            node = stack.pop()
+            if type(node) is int:
+                path_sites[node] -= 1
+                continue
+            site = node._site
+            nodes.append(node)
+            outermost.append(not path_sites.get(site))
+            path_sites[site] = path_sites.get(site, 0) + 1
+            stack.append(site)
+            stack.extend(reversed(node._children))
+        self.heap_seq = heap_seq
+        self.nodes = nodes
+        #: The times in the tree's time axis, in sorted order.
+        self.times = sorted(heap_seq.time_axis.times)
+        n = len(self.times)
+        axis_columns = heap_seq._columns(self.times)
+
+        # Masks that select the nodes used at each granularity.
+        self._masks = {
+            True: array.array('b', [0] + [1] * (len(nodes)-1)),
+            False: array.array('b', [node._row is not None
+                                     for node in nodes])}
+
+        # The nodes that make up each call site, at each granularity.
+        self._site_groups = {
+            True: self._group_by_site(itertools.compress(
+                itertools.count(), itertools.imap(
+                    operator.and_, self._masks[True], outermost))),
+            False: self._group_by_site(itertools.compress(
+                itertools.count(), self._masks[False]))}
+
+        # Transpose the nodes' series into one array per (sorted)
+        # time.  A row of zeros makes sure that every column is
+        # present.
+        heap_seq._series()
+        zeros = [0] * len(heap_seq.time_axis)
+        self._columns = [array.array('l') for time in self.times]
+        for start in range(0, len(nodes), self._BLOCK):
+            block = [node._series() for node in
+                     nodes[start:start+self._BLOCK]]
+            by_column = list(itertools.izip_longest(zeros, fillvalue=0,
+                                                    *block))
+            for column, axis_column in itertools.izip(self._columns,
+                                                      axis_columns):
+                column.extend(by_column[axis_column][1:])
+
+        # The time-weighted average size of each node, where the
+        # weight of each snapshot is the time until the next one.
+        weights = [next_time - time for (time, next_time) in
+                   zip(self.times, self.times[1:])] + [0]
+        duration = float(sum(weights))
+        if not duration and n:
+            weights[-1] = duration = 1.0
+        average = [0.0] * len(nodes)
+        for column, weight in zip(self._columns, weights):
+            if weight:
+                average = map(operator.add, average, map(
+                    operator.mul, column,
+                    itertools.repeat(weight/duration, len(nodes))))
+        self._average = average
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __repr__(self):
+        return '<HeapSeqIndex (%d nodes, %d times)>' % (len(self.nodes),
+                                                        len(self.times))
+
+    ######################################################################
+    #{ Queries
+    ######################################################################
+
+    def at(self, time, k=20, inclusive=True, by_site=False):
+        """
+        Return a list of C{(node, bytes)} pairs for the C{k} nodes
+        with the largest sizes at the given time, largest first.  If
+        C{time} is not a snapshot time, then the sizes in the last
+        snapshot before it are used.
+
+        @param inclusive: If true, then compare the sizes of all
+            nodes (except the root), including their subtrees;
+            otherwise, only compare the sizes of leaves.
+        @param by_site: If true, then rank call sites rather than
+            nodes, and return C{(site_id, bytes)} pairs, where
+            C{bytes} is the total size of the nodes with that site.
+            The call site for a site id is given by the tree's
+            C{site_table}.
+        """
+        column = self._column(time)
+        if column is None:
+            return []
+        return self._top(column, k, inclusive, by_site)
+
+    def at_peak(self, k=20, inclusive=True, by_site=False):
+        """
+        Return a list of C{(node, bytes)} pairs for the C{k} nodes
+        with the largest sizes at the time where the whole tree is
+        largest.  See L{at()}.
+        """
+        if not self.times:
+            return []
+        return self.at(self.heap_seq.peak_time, k, inclusive, by_site)
+
+    def growth(self, start, end, k=20, inclusive=True, by_site=False):
+        """
+        Return a list of C{(node, bytes)} pairs for the C{k} nodes
+        whose sizes grew the most from time C{start} to time C{end},
+        where C{bytes} is the increase.  See L{at()}.
+        """
+        start_column, end_column = self._column(start), self._column(end)
+        if end_column is None:
+            return []
+        if start_column is None:
+            return self._top(end_column, k, inclusive, by_site)
+        return self._top(map(operator.sub, end_column, start_column), k,
+                         inclusive, by_site)
+
+    def average(self, k=20, inclusive=True, by_site=False):
+        """
+        Return a list of C{(node, bytes)} pairs for the C{k} nodes
+        with the largest time-weighted average sizes, where the
+        weight of each snapshot is the time until the next one.  See
+        L{at()}.
+        """
+        return self._top(self._average, k, inclusive, by_site)
+
+    ######################################################################
+    #{ Helpers
+    ######################################################################
+
+    def _column(self, time):
+        """
+        Return the column of sizes for the last snapshot at or before
+        the given time, or None if there is no such snapshot.
+        """
+        i = bisect.bisect_right(self.times, time) - 1
+        if i < 0:
+            return None
+        return self._columns[i]
+
+    def _group_by_site(self, indices):
+        """
+        Group the given node indices by site.  Return a tuple
+        C{(sites, firsts, extras)}, where C{sites} lists the site ids;
+        C{firsts} gives the index of the first node with each site;
+        and C{extras} lists C{(site_position, node_index)} pairs for
+        the remaining nodes.  Most sites only have one node, so most
+        of a site column can be picked out of a node column at once.
+        """
+        positions = {}
+        sites, firsts, extras = [], [], []
+        nodes = self.nodes
+        for i in indices:
+            site = nodes[i]._site
+            j = positions.get(site)
+            if j is None:
+                positions[site] = len(sites)
+                sites.append(site)
+                firsts.append(i)
+            else:
+                extras.append((j, i))
+        return sites, firsts, extras
+
+    def _top(self, values, k, inclusive, by_site=False):
+        """
+        Return the C{(node, value)} pairs for the (at most) C{k} nodes
+        selected by the mask for C{inclusive} with the largest values;
+        or, if C{by_site} is true, the C{(site_id, value)} pairs for
+        the C{k} sites with the largest total values.
+        """
+        if by_site:
+            sites, firsts, extras = self._site_groups[bool(inclusive)]
+            site_values = map(values.__getitem__, firsts)
+            for j, i in extras:
+                site_values[j] += values[i]
+            top = self._select(site_values, k, None)
+            return [(sites[j], site_values[j]) for j in top]
+        top = self._select(values, k, self._masks[bool(inclusive)])
+        return [(self.nodes[i], values[i]) for i in top]
+
+    def _select(self, values, k, mask):
+        """
+        Return the indices of the (at most) C{k} values selected by
+        C{mask} (or of any values, if C{mask} is None) that are
+        largest, largest first.
+        """
+        if mask is None:
+            mask = itertools.repeat(1, len(values))
+            largest = heapq.nlargest(k, values)
+        else:
+            largest = heapq.nlargest(k, itertools.compress(values, mask))
+        if not largest:
+            return []
+        # Pick out the values that are at least the K-th largest value
+        # (with a full scan, if that value is so small that most
+        # values would be picked).
+        threshold = largest[-1]
+        if threshold > 0:
+            selected = itertools.compress(
+                itertools.count(), itertools.imap(
+                    operator.and_, mask, itertools.imap(
+                        operator.ge, values, itertools.repeat(threshold))))
+        else:
+            selected = itertools.compress(itertools.count(), mask)
+        return heapq.nlargest(k, selected, key=values.__getitem__)
@@ -67,6 +67,15 @@ class Snapshot(object):
         """
         return (cls._parse(m) for m in cls._SNAPSHOT_RE.finditer(s))
 
+    @classmethod
+    def read_iter(cls, source):
+        """
+        Return an iterator that generates a Snapshot object for each
+        massif snapshot in a given massif output file.  C{source} may
+        be a filename or a file object.  See L{MassifReader}.
+        """
+        return iter(MassifReader(source))
+
     @classmethod
     def _parse(cls, m):
         """Helper for parse_*() methods"""
@@ -93,4 +102,215 @@ class Snapshot(object):
         if self.heap_tree is not None:
             s += '\n' + self.heap_tree.print_massif_tree()
         return s
-    
+
+def read_header(lines):
+    """
+    Read the header lines (C{desc:}, C{cmd:} and C{time_unit:}) that
+    precede the first snapshot of a massif output file.  Return a
+    tuple C{(header, line)}, where C{header} is a dictionary mapping
+    header keys to values, and C{line} is the first line that is not
+    part of the header (or None if there are no snapshots).
+
+    @param lines: An iterator over the lines of the file.
+    """
+    header = {}
+    for line in lines:
+        if line.startswith('#'):
+            return header, line
+        key, sep, value = line.partition(':')
+        if sep:
+            header[key.strip()] = value.strip()
+    return header, None
+
+class MassifReader(object):
+    """
+    A line-oriented reader for massif output files, which generates
+    Snapshot objects one at a time as the file is read.  Unlike
+    L{Snapshot.parse_iter}, the file contents are never loaded into
+    memory all at once: only the lines of the heap tree that is
+    currently being parsed are kept.
+
+    The file's header is read when the reader is constructed, and is
+    available via the C{desc}, C{cmd}, and C{time_unit} attributes.
+
+        >>> reader = MassifReader('massif.out.1234')
+        >>> heap_seq = pymassif.heapseq.HeapSeq(reader)
+    """
+    def __init__(self, source, compact=False, site_table=None,
+                 validate=False, time_range=None, snapshots=None,
+                 peak_only=False, detailed_only=False):
+        """
+        @param source: A filename or a file object containing massif
+            output.
+        @param compact: If true, then store each heap tree as a
+            L{CompactHeapTree <pymassif.heap.CompactHeapTree>}, and set
+            each snapshot's C{heap_tree} to a view of its root node.
+            This uses much less memory when many snapshots are kept.
+        @param site_table: The L{SiteTable <pymassif.heap.SiteTable>}
+            shared by the compact heap trees.  If not specified, a new
+            SiteTable is used.  It is available as the C{site_table}
+            attribute; pass it to L{HeapSeq <pymassif.heapseq.HeapSeq>}
+            so that nodes can be matched by their site ids.
+        @param validate: If true, then check that each heap tree's
+            indentation and node sizes are consistent, and raise a
+            ValueError if not.  See L{HeapNode.parse_lines()
+            <pymassif.heap.HeapNode.parse_lines>}.
+
+        The remaining parameters select which snapshots are read.
+        They are checked using the header fields of each snapshot,
+        before its heap tree is read, so the heap trees of the
+        snapshots that are not selected are skipped without being
+        parsed.  Snapshots in a massif output file are in order of
+        number and time, so reading stops as soon as no later
+        snapshot can be selected.
+
+        @param time_range: A tuple C{(start, end)}: only read the
+            snapshots whose time is greater than or equal to
+            C{start} and less than C{end}.  Either may be None.
+        @param snapshots: A collection of snapshot numbers: only read
+            the snapshots with these numbers.
+        @param peak_only: If true, then only read the peak snapshot:
+            the snapshot marked by massif as the peak, if it is
+            selected; or the selected detailed snapshot with the most
+            heap bytes otherwise.
+        @param detailed_only: If true, then only read the snapshots
+            that have heap trees.
+        """
+        if time_range is None:
+            time_range = (None, None)
+        self._start_time, self._end_time = time_range
+        if snapshots is not None:
+            snapshots = frozenset(snapshots)
+            self._last_snapshot = max(snapshots or [-1])
+        self._snapshots = snapshots
+        self._peak_only = peak_only
+        self._detailed_only = detailed_only or peak_only
+        self._compact = compact
+        self._validate = validate
+        if site_table is None:
+            site_table = pymassif.heap.SiteTable()
+        self.site_table = site_table
+        if isinstance(source, basestring):
+            self._file = open(source, 'rb')
+            self._owns_file = True
+        else:
+            self._file = source
+            self._owns_file = False
+        self._lines = iter(self._file)
+        header, self._pending = read_header(self._lines)
+        self.desc = header.get('desc')
+        self.cmd = header.get('cmd')
+        self.time_unit = header.get('time_unit')
+
+    def __iter__(self):
+        line = self._pending
+        self._pending = None
+        lines = self._lines
+        peak = None # (mem_heap, fields, tree_lines), for peak_only
+        while line is not None:
+            # Skip to the "snapshot=..." line.
+            if not line.startswith('snapshot='):
+                line = next(lines, None)
+                continue
+            fields = {'snapshot': line[len('snapshot='):].strip()}
+            for line in lines:
+                if line.startswith('#'): continue
+                key, sep, value = line.partition('=')
+                if not sep:
+                    raise ValueError('Error parsing snapshot: %r' % line)
+                fields[key] = value.strip()
+                if key == 'heap_tree': break
+            selected = self._select(fields)
+            if selected is None:
+                break
+            if selected and self._peak_only:
+                # Only keep the heap tree of a snapshot that is
+                # larger than the largest one so far.
+                mem_heap = int(fields.get('mem_heap_B', 0))
+                selected = (fields['heap_tree'] == 'peak' or
+                            peak is None or mem_heap > peak[0])
+            line = None
+            if not selected:
+                # Skip the heap tree lines (if any).
+                for line in lines:
+                    if line[:1] == '#': break
+                else:
+                    line = None
+                continue
+            # Collect the heap tree lines (if any) until the next
+            # separator line.
+            tree_lines = []
+            append = tree_lines.append
+            for line in lines:
+                if line[:1] == '#': break
+                append(line)
+            else:
+                line = None
+            while tree_lines and not tree_lines[-1].strip():
+                tree_lines.pop()
+            if self._peak_only:
+                if fields['heap_tree'] == 'peak':
+                    peak = None
+                    yield self._mk_snapshot(fields, tree_lines)
+                    break
+                peak = (mem_heap, fields, tree_lines)
+                continue
+            yield self._mk_snapshot(fields, tree_lines)
+        if peak is not None:
+            yield self._mk_snapshot(peak[1], peak[2])
+
+    def _select(self, fields):
+        """
+        Helper for __iter__(): return True if the snapshot with the
+        given header fields is selected; False if it is not; or None
+        if neither it nor any later snapshot is selected.
+        """
+        try:
+            if self._end_time is not None or self._start_time is not None:
+                time = int(fields['time'])
+                if self._end_time is not None and time >= self._end_time:
+                    return None
+                if self._start_time is not None and time < self._start_time:
+                    return False
+            if self._snapshots is not None:
+                num = int(fields['snapshot'])
+                if num not in self._snapshots:
+                    if num > self._last_snapshot:
+                        return None
+                    return False
+            if self._detailed_only and fields['heap_tree'] == 'empty':
+                return False
+        except KeyError, e:
+            raise ValueError('Error parsing snapshot: missing %s' % e)
+        return True
+
+    def _mk_snapshot(self, fields, tree_lines):
+        """Helper for __iter__()"""
+        try:
+            if tree_lines and self._compact:
+                heap_tree = pymassif.heap.CompactHeapTree.parse_lines(
+                    tree_lines, self._validate, self.site_table).root
+            elif tree_lines:
+                heap_tree = pymassif.heap.HeapNode.parse_lines(
+                    tree_lines, self._validate)
+            else:
+                heap_tree = None
+            return Snapshot(num=int(fields['snapshot']),
+                            time=int(fields['time']),
+                            mem_heap=int(fields['mem_heap_B']),
+                            mem_heap_extra=int(fields['mem_heap_extra_B']),
+                            mem_stacks=int(fields['mem_stacks_B']),
+                            heap_tree=heap_tree)
+        except KeyError, e:
+            raise ValueError('Error parsing snapshot: missing %s' % e)
+
+    def close(self):
+        """Close the underlying file, if it was opened by this reader."""
+        if self._owns_file:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()